@@ -1,2 +1,105 @@
+# Command line entry point, used by the scheduled jobs
+#
+# Usage:
+#   python Curry.py update                                         updates all the index databases (CDI, Selic, IPCA, BRLUSD)
+#   python Curry.py update --bulk IGPM TR Poupanca                 updates catalog series of the BCB api (see bacen.series_catalog)
+#   python Curry.py export rate CDI --percent 100,110 --start 2020-01-01 --end 2022-08-31 --out cdi.csv
+#   python Curry.py export rate CDI --method b3 --start 2020-01-01 --out cdi_b3.csv      B3 truncation rules (see ir_calc.accum_methods)
+#   python Curry.py export vna --base-date 2000-07-15 --start 2022-01-01 --end 2022-08-31 --out vna.parquet
+#   python Curry.py export converted CDI --currency USD --start 2020-01-01 --end 2022-08-31
+#   python Curry.py serve --port 8765                              runs the query service (see service.py)
+# The data directory is CURRY_DATA_DIR, or --data-dir. Exports go to stdout when --out is not given
+
+import sys
+import argparse
 import pandas as pd
+import registry
+
+
+def percentages(text):
+    # Parses a comma separated list of percentages of the rate (e.g. 100,110.5) to fractions
+    return([float(percent) / 100 for percent in text.split(',')])
+
+def run_update(args):
+    if args.bulk:
+        import bacen
+        status = bacen.bulk_update(args.bulk, start_date=args.start, end_date=args.end)
+    else:
+        import updater
+        status = updater.update_all_indexes()
+
+    failed = False
+    for series_name, result in status.items():
+        failed = failed or isinstance(result, Exception)
+        print(f'{series_name}: {result}', file=sys.stderr)
+    return(1 if failed else 0)
+
+def run_export(args):
+    import export
+
+    end_date = args.end or pd.to_datetime("today").normalize()
+    if args.kind == 'rate':
+        chunks = export.rate_accum_chunks(args.series, args.percent, args.start, end_date, args.chunk_rows, args.method)
+    elif args.kind == 'vna':
+        chunks = export.ipca_vna_chunks(args.base_date, args.start, end_date, args.base_value, args.reset_day, args.accrual_type, args.chunk_rows)
+    else:
+        chunks = export.converted_accum_chunks(args.series, args.currency, args.percent, args.start, end_date, args.chunk_rows)
+
+    rows = export.write_chunks(chunks, args.out)
+    print(f'{rows} rows exported to {"stdout" if args.out == "-" else args.out}', file=sys.stderr)
+    return(0)
+
+def run_serve(args):
+    import logging
+    import service
+
+    logging.basicConfig(level=logging.INFO)
+    service.run_service(args.host, args.port, args.reload_interval, args.cache_entries, args.workers)
+    return(0)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='Curry', description='Curry Investments index databases')
+    parser.add_argument('--data-dir', default=None, help='directory of the index databases (default: CURRY_DATA_DIR)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    update = commands.add_parser('update', help='updates the index databases with the values published since the last update')
+    update.add_argument('--bulk', nargs='+', default=None, metavar='SERIES', help='catalog series of the BCB api to update in bulk')
+    update.add_argument('--start', default=None, help='first date (dd/mm/yyyy) of the series that have no database yet (bulk only)')
+    update.add_argument('--end', default=None, help='last date (dd/mm/yyyy) to fetch (bulk only, default today)')
+    update.set_defaults(run=run_update)
+
+    export = commands.add_parser('export', help='exports a derived series to a csv or parquet file, or to stdout')
+    export.add_argument('kind', choices=['rate', 'vna', 'converted'], help='rate accumulation, IPCA VNA or rate accumulation in a foreign currency')
+    export.add_argument('series', nargs='?', default='CDI', choices=['CDI', 'Selic'], help='rate series (rate and converted)')
+    export.add_argument('--percent', type=percentages, default=[1.0], help='comma separated percentages of the rate (default 100)')
+    export.add_argument('--method', default='cumprod', choices=['cumprod', 'log', 'b3'], help='accumulation method of the rate export (default cumprod)')
+    export.add_argument('--currency', default='USD', help='currency of the converted accumulation (default USD)')
+    export.add_argument('--base-date', default=None, help='base date of the VNA')
+    export.add_argument('--base-value', type=float, default=1000.0, help='VNA at the base date (default 1000)')
+    export.add_argument('--reset-day', type=int, default=15, help='IPCA reset day of the VNA (default 15)')
+    export.add_argument('--accrual-type', default='cd', choices=['cd', 'bd'], help='IPCA accrual type of the VNA (default cd)')
+    export.add_argument('--start', required=True, help='first date of the export (yyyy-mm-dd)')
+    export.add_argument('--end', default=None, help='last date of the export (yyyy-mm-dd, default today)')
+    export.add_argument('--chunk-rows', type=int, default=10000, help='dates calculated and written at a time')
+    export.add_argument('--out', default='-', help='.csv or .parquet file (default - : csv to stdout)')
+    export.set_defaults(run=run_export)
+
+    serve = commands.add_parser('serve', help='runs the query service over a local HTTP/JSON api')
+    serve.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+    serve.add_argument('--port', type=int, default=8765, help='port to listen on (default 8765)')
+    serve.add_argument('--reload-interval', type=float, default=2.0, help='seconds between the checks of the databases for new data')
+    serve.add_argument('--cache-entries', type=int, default=10000, help='responses kept in the result cache')
+    serve.add_argument('--workers', type=int, default=4, help='worker threads that calculate the queries (default 4)')
+    serve.set_defaults(run=run_serve)
+
+    args = parser.parse_args(argv)
+    if args.command == 'export' and args.kind == 'vna' and args.base_date is None:
+        parser.error('export vna needs --base-date')
+    if args.data_dir:
+        registry.set_data_dir(args.data_dir)
+
+    return(args.run(args))
+
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,27 +1,333 @@
+# This module gets the series of the BCB api (SGS) and keeps their databases
+# The series are described in series_catalog: a new series is added there, with no new module. bulk_update() downloads any
+# number of them at once and stores the new values in their databases
+
+import os
+import json
+import asyncio
+import numpy as np
 import pandas as pd
+import http_client
+import http_cache
+import instrument
+import storage
+import registry
+import ir_calc as ir
+import br_workdays as wd
 
-def get_bacen_data(series_name, start_date, end_date):
-    # Gets the values of the series with series_name, for the period start_date to end_date, from the Brazilian Central Bank api
+# Url of the BCB api (SGS - Sistema Gerenciador de Series Temporais). Can be changed to point to a local server
+bacen_api_url = 'http://api.bcb.gov.br/dados/serie/bcdata.sgs.{series_id}/dados?formato=json&dataInicial={start_date:%d/%m/%Y}&dataFinal={end_date:%d/%m/%Y}'
+
+# The api refuses queries of daily series longer than 10 years, so longer periods are split in windows of at most max_window_years
+max_window_years = 10
+
+# Values of a window that ended more than closed_after_days ago are final, so its cached response never expires
+closed_after_days = 7
 
-    # Mapping the series_name to the series_id used by BCB.
-    seriesmap = {'BRLUSD': 1, 'CDI' : 4389, 'IPCA' : 433, 'Selic': 1178}
+# Catalog of the SGS series. For each series name:
+#   id          - series id in the SGS
+#   unit        - unit of the values as published by the api
+#   percent     - True for the rates published as percentage. We store and work with them already divided by 100
+#   periodicity - 'D' (daily) or 'M' (monthly, dated on the first day of the month)
+#   storage     - how the database of the series is kept by store_series():
+#                   'rate252' - Rate and Accum columns. Daily annual rates base 252, with a placeholder row (Rate 0) on the next business day (as CDI)
+#                   'monthly' - Rate and Accum columns. Monthly rates, with a placeholder row (Rate 0) on the next month
+#                   'value'   - one column named as the series (as BRLUSD)
+#                   None      - the database is kept by its own module (IPCA, which also stores the IBGE index numbers)
+# The exchange rates are the PTAX selling rates, in BRL per unit of the foreign currency
+# TR and Poupanca are the rates of the monthly period that starts on each day
+series_catalog = {'CDI':     {'id': 4389,  'unit': '% p.a.',  'percent': True,  'periodicity': 'D', 'storage': 'rate252'},
+                  'Selic':   {'id': 1178,  'unit': '% p.a.',  'percent': True,  'periodicity': 'D', 'storage': 'rate252'},
+                  'IPCA':    {'id': 433,   'unit': '% p.m.',  'percent': True,  'periodicity': 'M', 'storage': None},
+                  'IGPM':    {'id': 189,   'unit': '% p.m.',  'percent': True,  'periodicity': 'M', 'storage': 'monthly'},
+                  'TR':      {'id': 226,   'unit': '% p.m.',  'percent': True,  'periodicity': 'D', 'storage': 'value'},
+                  'Poupanca':{'id': 195,   'unit': '% p.m.',  'percent': True,  'periodicity': 'D', 'storage': 'value'},
+                  'BRLUSD':  {'id': 1,     'unit': 'BRL/USD', 'percent': False, 'periodicity': 'D', 'storage': 'value'},
+                  'BRLEUR':  {'id': 21619, 'unit': 'BRL/EUR', 'percent': False, 'periodicity': 'D', 'storage': 'value'},
+                  'BRLGBP':  {'id': 21623, 'unit': 'BRL/GBP', 'percent': False, 'periodicity': 'D', 'storage': 'value'},
+                  'BRLJPY':  {'id': 21621, 'unit': 'BRL/JPY', 'percent': False, 'periodicity': 'D', 'storage': 'value'},
+                  'BRLCHF':  {'id': 21625, 'unit': 'BRL/CHF', 'percent': False, 'periodicity': 'D', 'storage': 'value'}}
+
+# Mapping the series_name to the series_id used by BCB
+seriesmap = {series_name: entry['id'] for series_name, entry in series_catalog.items()}
+
+# Columns stored by each kind of database
+storage_dtypes = {'rate252': {'Rate': float, 'Accum': float}, 'monthly': {'Rate': float, 'Accum': float}}
+
+def get_catalog_entry(series_name):
     try:
-        series_id = seriesmap[series_name]
+        return(series_catalog[series_name])
     except KeyError as err:
         raise KeyError(err)
-    except:
-        raise Exception(err)
 
+def get_series_id(series_name):
+    return(get_catalog_entry(series_name)['id'])
+
+def to_date(ref_date):
+    # Dates can be given as Timestamps or as strings in the format used by the api (dd/mm/yyyy)
+    if isinstance(ref_date, str):
+        return(pd.to_datetime(ref_date, format='%d/%m/%Y'))
+    return(pd.Timestamp(ref_date))
+
+def date_windows(start_date, end_date, window_years=max_window_years):
+    # Splits the period start_date to end_date in windows that the api accepts. window_years=None gives a single window
+    if window_years is None:
+        return([(start_date, end_date)] if start_date <= end_date else [])
+
+    windows = []
+    window_start = start_date
+    while window_start <= end_date:
+        window_end = min(window_start + pd.DateOffset(years=window_years) - pd.Timedelta(1, unit='D'), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + pd.Timedelta(1, unit='D')
+
+    return(windows)
+
+def bacen_requests(series_name, start_date, end_date):
+    # Returns the requests to get the values of the series with series_name, for the period start_date to end_date
+    # Each request is (url, cache key, closed), where closed tells if the values of the window can not change anymore
+    # Only the daily series are limited to max_window_years by the api
+    entry = get_catalog_entry(series_name)
+    series_id = entry['id']
+    windows = date_windows(to_date(start_date), to_date(end_date), max_window_years if entry['periodicity'] == 'D' else None)
+    closed_before = pd.to_datetime("today").normalize() - pd.Timedelta(closed_after_days, unit='D')
+
+    return([(bacen_api_url.format(series_id=series_id, start_date=window_start, end_date=window_end),
+             ('bcb', series_id, window_start.strftime('%Y%m%d'), window_end.strftime('%Y%m%d')),
+             window_end < closed_before) for window_start, window_end in windows])
+
+def parse_dates(dates):
+    # The api always sends the dates as dd/mm/yyyy, which is parsed with the fixed format. Any other format is left to pandas
     try:
-        url = f'http://api.bcb.gov.br/dados/serie/bcdata.sgs.{series_id}/dados?formato=json&dataInicial={start_date:%d/%m/%Y}&dataFinal={end_date:%d/%m/%Y}'
-        series = pd.read_json(url)
-        series['data'] = pd.to_datetime(series['data'], dayfirst=True)
-        series.set_index('data', inplace=True)
+        return(pd.to_datetime(dates, format='%d/%m/%Y'))
+    except ValueError:
+        return(pd.to_datetime(dates, dayfirst=True))
+
+def parse_bacen_data(series_name, payloads):
+    # Builds the dataframe of the series with series_name from the json payloads returned by the api (one for each window)
+    entry = get_catalog_entry(series_name)
+
+    try:
+        rows = [row for payload in payloads for row in payload]
+        dates = parse_dates([row['data'] for row in rows])
+        values = np.array([row['valor'] for row in rows], dtype=float)
+        series = pd.DataFrame({'valor': values}, index=pd.DatetimeIndex(dates, name='data'))
     except:
-        raise TypeError('Error in fetching data from BCB api')
+        raise TypeError('Error in parsing data from BCB api')
 
-    # The IPCA, Selic and CDI rates are published as percentage. We store and work whith them already divided by 100.
-    if (series_id == 433 or series_id == 1178 or series_id == 4389):
+    if entry['percent']:
         series['valor'] = series['valor'] / 100
-        
-    return series
\ No newline at end of file
+
+    return series
+
+def decode_window(url, status, body):
+    # The api answers 404 when there are no values in the window
+    if status == 404:
+        return([])
+    if status != 200:
+        raise http_client.HttpError(status, url)
+    return(json.loads(body))
+
+def fetch_window(url, key, closed):
+    status, headers, body = http_cache.fetch(url, key, closed)
+    return(decode_window(url, status, body))
+
+async def fetch_window_async(client, url, key, closed):
+    status, headers, body = await http_cache.fetch_async(client, url, key, closed)
+    return(decode_window(url, status, body))
+
+@instrument.timed('bacen.get_bacen_data')
+def get_bacen_data(series_name, start_date, end_date):
+    # Gets the values of the series with series_name, for the period start_date to end_date, from the Brazilian Central Bank api
+    requests = bacen_requests(series_name, start_date, end_date)
+
+    try:
+        payloads = [fetch_window(url, key, closed) for url, key, closed in requests]
+    except http_cache.CacheMiss:
+        raise
+    except Exception as err:
+        raise TypeError(f'Error in fetching data from BCB api: {err}')
+
+    return(parse_bacen_data(series_name, payloads))
+
+@instrument.timed('bacen.get_bacen_data_async')
+async def get_bacen_data_async(client, series_name, start_date, end_date):
+    # Asynchronous version of get_bacen_data. client is a http_client.AsyncClient. The windows of the period are fetched concurrently
+    requests = bacen_requests(series_name, start_date, end_date)
+
+    try:
+        payloads = await asyncio.gather(*[fetch_window_async(client, url, key, closed) for url, key, closed in requests])
+    except http_cache.CacheMiss:
+        raise
+    except Exception as err:
+        raise TypeError(f'Error in fetching data from BCB api: {err}')
+
+    return(parse_bacen_data(series_name, payloads))
+
+# Bulk download
+
+async def get_bacen_bulk_async(client, series_names, start_dates, end_date):
+    # Gets the values of all the series in series_names at once. The windows of all the series are fetched concurrently
+    # start_dates is a dict series name -> start date, or a single start date for all the series
+    # Returns a dict series name -> dataframe, or the exception that stopped the fetch of the series
+    if not isinstance(start_dates, dict):
+        start_dates = {series_name: start_dates for series_name in series_names}
+
+    requests = {}
+    results = {}
+    for series_name in series_names:
+        try:
+            requests[series_name] = bacen_requests(series_name, start_dates[series_name], end_date)
+        except Exception as err:
+            results[series_name] = err
+
+    windows = [(series_name, url, key, closed) for series_name, series_requests in requests.items() for url, key, closed in series_requests]
+    instrument.count('bacen.bulk_windows', len(windows))
+    payloads = await asyncio.gather(*[fetch_window_async(client, url, key, closed) for series_name, url, key, closed in windows],
+                                    return_exceptions=True)
+
+    series_payloads = {series_name: [] for series_name in requests}
+    for (series_name, url, key, closed), payload in zip(windows, payloads):
+        if isinstance(payload, Exception):
+            if not isinstance(payload, http_cache.CacheMiss):
+                payload = TypeError(f'Error in fetching data from BCB api: {payload}')
+            results.setdefault(series_name, payload)
+        else:
+            series_payloads[series_name].append(payload)
+
+    for series_name, payloads in series_payloads.items():
+        if series_name not in results:
+            try:
+                results[series_name] = parse_bacen_data(series_name, payloads)
+            except Exception as err:
+                results[series_name] = err
+
+    return(results)
+
+@instrument.timed('bacen.get_bacen_bulk')
+def get_bacen_bulk(series_names, start_dates, end_date, max_connections=8, timeout=http_client.default_timeout,
+                   retries=http_client.default_retries, backoff=http_client.default_backoff):
+    # Synchronous version of get_bacen_bulk_async, with its own client of max_connections concurrent connections
+
+    async def run():
+        async with http_client.AsyncClient(max_connections, timeout, retries, backoff) as client:
+            return(await get_bacen_bulk_async(client, series_names, start_dates, end_date))
+
+    return(asyncio.run(run()))
+
+# Databases of the catalog series
+
+def get_storage(series_name):
+    kind = get_catalog_entry(series_name)['storage']
+    if kind is None:
+        raise Exception(f'The database of {series_name} is not kept by the bacen module')
+    return(kind)
+
+def series_dtypes(series_name):
+    return(storage_dtypes.get(get_storage(series_name), {series_name: float}))
+
+@instrument.timed('bacen.load_series')
+def load_series(series_name, db_path=None, mmap=True, version=None):
+    # Reads the database of a catalog series to dataframe (Rate and Accum columns, or one column named as the series)
+    if db_path is None:
+        db_path = registry.series_path(series_name)
+    try:
+        df = storage.read_series(db_path, series_dtypes(series_name), mmap, version)
+        df.sort_index()
+    except OSError as err:
+        raise OSError(err)
+    except Exception as err:
+        raise Exception(err)
+
+    return(df)
+
+def last_stored_date(series_name, db_path=None):
+    # Returns the last date stored in the database of series_name (None if there is no database). The new values are fetched from this date on
+    if db_path is None:
+        db_path = registry.series_path(series_name)
+    if not os.path.exists(db_path):
+        return(None)
+
+    return(load_series(series_name, db_path).last_valid_index())
+
+def append_accum_monthly(df, new_rates):
+    # Monthly version of ir_calc.append_accum_r252: returns (from_row, tail) with the new rates, a placeholder on the next month and their Accum
+    from_row = df.index.searchsorted(new_rates.first_valid_index())
+    next_month = new_rates.last_valid_index() + pd.DateOffset(months=1)
+
+    tail = pd.concat([new_rates[['Rate']], pd.DataFrame(data={'Rate': [0.0]}, index=[next_month])])
+
+    if from_row == 0:
+        tail['Accum'] = np.concatenate(([1.0], ir.continue_accum(1.0, 1 + tail.Rate.values[:-1])))
+    else:
+        prev_rates = np.concatenate(([df.Rate.iloc[from_row - 1]], tail.Rate.values[:-1]))
+        tail['Accum'] = ir.continue_accum(df.Accum.iloc[from_row - 1], 1 + prev_rates)
+
+    return(from_row, tail)
+
+@instrument.timed('bacen.store_series')
+def store_series(series_name, new_values, db_path=None):
+    # Stores the values fetched from the api (valor column) in the database of series_name. Stored dates that were published
+    # again are replaced. The database is created if it does not exist
+    kind = get_storage(series_name)
+    if db_path is None:
+        db_path = registry.series_path(series_name)
+    if new_values.empty:
+        return
+
+    with storage.locked(db_path):
+        if os.path.exists(db_path):
+            df = load_series(series_name, db_path, mmap=False)
+        else:
+            df = pd.DataFrame({column: np.empty(0, dtype) for column, dtype in series_dtypes(series_name).items()}, index=pd.DatetimeIndex([]))
+
+        new_values = new_values.sort_index()
+        if kind == 'rate252':
+            from_row, new_rows = ir.append_accum_r252(df, new_values.rename(columns={'valor': 'Rate'}), wd.next_br_bday(new_values.last_valid_index()))
+        elif kind == 'monthly':
+            from_row, new_rows = append_accum_monthly(df, new_values.rename(columns={'valor': 'Rate'}))
+        else:
+            from_row = df.index.searchsorted(new_values.first_valid_index())
+            new_rows = new_values.rename(columns={'valor': series_name})[[series_name]]
+
+        # Saves the new rows to the database as a new version (or creates the database)
+        storage.commit_series(new_rows, db_path, from_row, new_values.last_valid_index())
+
+        ir.invalidate_accum_cache(series_name)
+        registry.invalidate_series(series_name)
+
+def bulk_update(series_names=None, start_date=None, end_date=None, db_paths=None, max_connections=8):
+    # Downloads the new values of the catalog series in series_names (all the series with a database kept here, if None) at once
+    # and stores them. Each series is fetched from its last stored date. Series without a database are backfilled from start_date
+    # db_paths (dict series name -> database path) overrides the databases in the registry's data directory
+    # Returns a dict with the number of values fetched for each series, or the exception that stopped its update
+    if series_names is None:
+        series_names = [series_name for series_name, entry in series_catalog.items() if entry['storage'] is not None]
+    db_paths = {series_name: (db_paths or {}).get(series_name) or registry.series_path(series_name) for series_name in series_names}
+    end_date = pd.to_datetime("today").normalize() if end_date is None else to_date(end_date)
+
+    status = {}
+    start_dates = {}
+    for series_name in series_names:
+        try:
+            get_storage(series_name)
+            last_date = last_stored_date(series_name, db_paths[series_name])
+            if last_date is None and start_date is None:
+                raise Exception(f'No database for {series_name}: a start_date is needed to backfill it')
+            start_dates[series_name] = last_date if last_date is not None else to_date(start_date)
+        except Exception as err:
+            status[series_name] = err
+
+    results = get_bacen_bulk(list(start_dates), start_dates, end_date, max_connections)
+
+    for series_name, new_values in results.items():
+        if isinstance(new_values, Exception):
+            status[series_name] = new_values
+            continue
+        try:
+            store_series(series_name, new_values, db_paths[series_name])
+            status[series_name] = len(new_values)
+        except Exception as err:
+            status[series_name] = err
+
+    return(status)
@@ -0,0 +1,271 @@
+# Benchmarks of the hot paths of the index modules: business day functions, accumulation, loading and updating the databases
+# Runs on synthetic databases (see synthetic.py) of different sizes, with no network access and no D:\ paths
+# For each benchmark and size it reports the latency (minimum and median of the repeats) and the peak memory (tracemalloc),
+# and a checksum of the results. Compared with a stored baseline, it fails when a benchmark got slower than the tolerance
+# or when its results changed
+#
+# Usage (from the root of the repository):
+#   python benchmarks/run.py --sizes 5,20 --save baseline.json
+#   python benchmarks/run.py --sizes 5,20 --baseline baseline.json
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+import registry
+import br_workdays as wd
+import ir_calc as ir
+import cdi
+import selic
+import ipca
+import fxrates
+
+num_queries = 200
+
+# Registered benchmarks: name -> (setup, function). setup(ctx) prepares the arguments of one run (not timed)
+benchmarks = {}
+
+
+def benchmark(name, setup=None):
+    def register(function):
+        benchmarks[name] = (setup, function)
+        return(function)
+    return(register)
+
+def make_context(data_dir, years, seed=0):
+    # Generates the databases of one size and the random dates used by the queries
+    synthetic.generate(data_dir, years, seed=seed)
+    registry.set_data_dir(data_dir)
+
+    rng = np.random.default_rng(seed)
+    df_cdi = cdi.load_cdi(mmap=False)
+    df_ipca = ipca.load_ipca(mmap=False)
+    first, last = df_cdi.first_valid_index(), df_cdi.last_valid_index()
+
+    days = pd.date_range(first, last)
+    st = rng.integers(0, len(days) - 1, num_queries)
+    end = np.minimum(st + rng.integers(1, 1000, num_queries), len(days) - 1)
+
+    # The first and last months of the IPCA database can not be used by accruals with a reset day (they need the month before or after)
+    ipca_days = pd.date_range(df_ipca.first_valid_index() + pd.DateOffset(months=1), df_ipca.last_valid_index() - pd.DateOffset(months=1))
+    ipca_st = rng.integers(0, len(ipca_days) - 1, num_queries)
+    ipca_end = np.minimum(ipca_st + rng.integers(1, 1000, num_queries), len(ipca_days) - 1)
+
+    return({'data_dir': data_dir, 'years': years, 'cdi': df_cdi, 'ipca': df_ipca,
+            'start_dates': days[st], 'end_dates': days[end],
+            'ipca_start_dates': ipca_days[ipca_st], 'ipca_end_dates': ipca_days[ipca_end]})
+
+# Business days
+
+@benchmark('next_br_bday')
+def bench_next_br_bday(ctx, args):
+    return(sum(wd.next_br_bday(day, 5).toordinal() for day in ctx['start_dates']))
+
+@benchmark('num_br_bdays')
+def bench_num_br_bdays(ctx, args):
+    return(sum(wd.num_br_bdays(st, end) for st, end in zip(ctx['start_dates'], ctx['end_dates'])))
+
+# Accumulation
+
+@benchmark('calc_accum_r252', setup=lambda ctx: ctx['cdi'][['Rate']].copy())
+def bench_calc_accum_r252(ctx, rate252):
+    return(ir.calc_accum_r252(rate252).Accum.iloc[-1])
+
+def clear_accum_cache(ctx):
+    ir.invalidate_accum_cache()
+
+@benchmark('cdi_accum percent 1.1', setup=clear_accum_cache)
+def bench_cdi_accum(ctx, args):
+    return(sum(cdi.cdi_accum(ctx['cdi'], st, end, 1.1) for st, end in zip(ctx['start_dates'], ctx['end_dates'])))
+
+@benchmark('ipca_accum cd')
+def bench_ipca_accum_cd(ctx, args):
+    return(sum(ipca.ipca_accum(ctx['ipca'], st, end, 15, 'cd') for st, end in zip(ctx['ipca_start_dates'], ctx['ipca_end_dates'])))
+
+@benchmark('ipca_accum bd')
+def bench_ipca_accum_bd(ctx, args):
+    return(sum(ipca.ipca_accum(ctx['ipca'], st, end, 15, 'bd') for st, end in zip(ctx['ipca_start_dates'], ctx['ipca_end_dates'])))
+
+# Loading
+
+@benchmark('load_cdi')
+def bench_load_cdi(ctx, args):
+    return(cdi.load_cdi(mmap=False).Accum.iloc[-1])
+
+@benchmark('load_selic')
+def bench_load_selic(ctx, args):
+    return(selic.load_selic(mmap=False).Accum.iloc[-1])
+
+@benchmark('load_ipca')
+def bench_load_ipca(ctx, args):
+    return(ipca.load_ipca(mmap=False).Accum.iloc[-1])
+
+@benchmark('load_brlusd')
+def bench_load_brlusd(ctx, args):
+    return(fxrates.load_brlusd(mmap=False).BRLUSD.iloc[-1])
+
+# Updating
+
+def copy_database(ctx, series_name):
+    # Copies the database of series_name to a scratch file, so each run updates the same original database
+    scratch_dir = os.path.join(ctx['data_dir'], 'scratch')
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    os.makedirs(scratch_dir)
+    db_path = os.path.join(scratch_dir, f'{series_name}.csv')
+    shutil.copy2(registry.series_path(series_name), db_path)
+    return(db_path)
+
+def new_bdays(last_date, num_days=20):
+    # The num_days business days from the last stored date on
+    return(wd.list_of_br_bdays(last_date, last_date + pd.Timedelta(2 * num_days, unit='D'))[:num_days])
+
+def setup_update_cdi(ctx):
+    # New rates for the 20 business days after the last stored rate
+    db_path = copy_database(ctx, 'CDI')
+    new_days = new_bdays(ctx['cdi'].last_valid_index())
+    return(db_path, pd.DataFrame({'valor': np.linspace(0.1, 0.11, len(new_days)).round(6)}, index=new_days))
+
+@benchmark('update_cdi_db', setup=setup_update_cdi)
+def bench_update_cdi_db(ctx, args):
+    db_path, new_rates = args
+    cdi.update_cdi_db(db_path, novos_cdi=new_rates.copy())
+    return(cdi.load_cdi(db_path, mmap=False).Accum.iloc[-1])
+
+def setup_update_selic(ctx):
+    # New rates for the 20 business days after the last stored rate
+    db_path = copy_database(ctx, 'Selic')
+    new_days = new_bdays(selic.load_selic(db_path, mmap=False).last_valid_index())
+    return(db_path, pd.DataFrame({'valor': np.linspace(0.1, 0.11, len(new_days)).round(6)}, index=new_days))
+
+@benchmark('update_selic_db', setup=setup_update_selic)
+def bench_update_selic_db(ctx, args):
+    db_path, new_rates = args
+    selic.update_selic_db(db_path, novos_selic=new_rates.copy())
+    return(selic.load_selic(db_path, mmap=False).Accum.iloc[-1])
+
+def setup_update_brlusd(ctx):
+    # New rates for the 20 business days from the last stored rate on (the last stored rate is replaced)
+    db_path = copy_database(ctx, 'BRLUSD')
+    new_days = new_bdays(fxrates.load_brlusd(db_path, mmap=False).last_valid_index())
+    return(db_path, pd.DataFrame({'valor': np.linspace(5.0, 5.2, len(new_days)).round(4)}, index=new_days))
+
+@benchmark('update_brlusd_db', setup=setup_update_brlusd)
+def bench_update_brlusd_db(ctx, args):
+    db_path, new_rates = args
+    fxrates.update_brlusd_db(db_path, novos_brlusd=new_rates.copy())
+    return(fxrates.load_brlusd(db_path, mmap=False).BRLUSD.sum())
+
+def setup_update_ipca(ctx):
+    # New rates for the 3 months after the last stored rate
+    db_path = copy_database(ctx, 'IPCA')
+    new_months = pd.date_range(ctx['ipca'].last_valid_index(), periods=3, freq='MS')
+    return(db_path, pd.DataFrame({'Num_IPCA': [1.0, 2.0, 3.0], 'IPCA': [0.004, 0.005, 0.006]}, index=new_months))
+
+@benchmark('update_ipca_db', setup=setup_update_ipca)
+def bench_update_ipca_db(ctx, args):
+    db_path, new_rates = args
+    ipca.update_ipca_db(db_path, novos_ipca=new_rates.copy(), proj_path=os.path.join(os.path.dirname(db_path), 'IPCA_proj.csv'))
+    return(ipca.load_ipca(db_path, mmap=False).Accum.iloc[-1])
+
+
+def run_benchmark(ctx, setup, function, repeat):
+    # Returns the timings of repeat runs, the peak memory of one run and the result of the function
+    args = setup(ctx) if setup else None
+    value = function(ctx, args)
+
+    timings = []
+    for _ in range(repeat):
+        args = setup(ctx) if setup else None
+        start = time.perf_counter()
+        function(ctx, args)
+        timings.append(time.perf_counter() - start)
+
+    args = setup(ctx) if setup else None
+    tracemalloc.start()
+    try:
+        function(ctx, args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return({'min': min(timings), 'median': float(np.median(timings)), 'peak_bytes': peak, 'value': float(value)})
+
+def run_all(sizes, repeat, selected=None, data_dir=None):
+    results = {}
+    for years in sizes:
+        size_dir = os.path.join(data_dir, f'{years}y')
+        ctx = make_context(size_dir, years)
+        for name, (setup, function) in benchmarks.items():
+            if selected and selected not in name:
+                continue
+            key = f'{name} [{years}y]'
+            results[key] = run_benchmark(ctx, setup, function, repeat)
+            print(f"{key:<36} min {results[key]['min'] * 1000:10.3f} ms   median {results[key]['median'] * 1000:10.3f} ms   "
+                  f"peak {results[key]['peak_bytes'] / 1024:10.1f} KiB")
+    return(results)
+
+def compare(results, baseline, tolerance):
+    # Returns the list of regressions: benchmarks slower than the baseline by more than tolerance, or with different results
+    regressions = []
+    for key, base in baseline['results'].items():
+        if key not in results:
+            continue
+        result = results[key]
+        if result['median'] > base['median'] * (1 + tolerance):
+            regressions.append(f"{key}: median {result['median'] * 1000:.3f} ms, baseline {base['median'] * 1000:.3f} ms")
+        if not math.isclose(result['value'], base['value'], rel_tol=1e-9):
+            regressions.append(f"{key}: result {result['value']!r}, baseline {base['value']!r}")
+    return(regressions)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the Curry index modules on synthetic data')
+    parser.add_argument('--sizes', default='5,20', help='years of data of each synthetic database, comma separated')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of each benchmark')
+    parser.add_argument('--select', default=None, help='runs only the benchmarks whose name contains this text')
+    parser.add_argument('--data-dir', default=None, help='directory of the synthetic databases (default: a temporary directory)')
+    parser.add_argument('--save', default=None, help='saves the results to this json file (e.g. to be used as baseline)')
+    parser.add_argument('--baseline', default=None, help='json file with the results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown over the baseline median reported as regression')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='curry_bench_')
+    try:
+        results = run_all(sizes, args.repeat, args.select, data_dir)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+              'machine': platform.machine(), 'results': results}
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(report, save_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            return(1)
+        print('No regressions against', args.baseline)
+
+    return(0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
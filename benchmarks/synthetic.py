@@ -0,0 +1,88 @@
+# Generates synthetic index databases (holidays, CDI, Selic, IPCA and BRLUSD) in the format of the real ones
+# Used by the benchmarks, so they run without network access and without the real databases
+# The data is random but reproducible: the same seed and number of years always give the same files
+
+import os
+import numpy as np
+import pandas as pd
+
+# National holidays with a fixed date, and the ones of the city of Sao Paulo (B3 calendar)
+fixed_holidays = ['01-01', '04-21', '05-01', '09-07', '10-12', '11-02', '11-15', '12-25']
+sao_paulo_holidays = ['01-25', '07-09', '11-20']
+
+
+def easter(year):
+    # Date of Easter Sunday in the Gregorian calendar (anonymous Gregorian algorithm)
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 19 * l) // 433
+    month = (h + l - 7 * m + 90) // 25
+    day = (h + l - 7 * m + 33 * month + 19) % 32
+    return(pd.Timestamp(year, month, day))
+
+def make_holidays(first_year, last_year):
+    # Bank holidays (Brazilian Real) and B3 holidays (Sao Paulo) between first_year and last_year
+    rows = []
+    for year in range(first_year, last_year + 1):
+        easter_day = easter(year)
+        # Carnival (Monday and Tuesday), Good Friday and Corpus Christi
+        movable = [easter_day + pd.Timedelta(days, unit='D') for days in (-48, -47, -2, 60)]
+        national = [pd.Timestamp(f'{year}-{month_day}') for month_day in fixed_holidays] + movable
+        for holiday in national:
+            rows.append((holiday, 'Brazilian Real'))
+            rows.append((holiday, 'Sao Paulo'))
+        for month_day in sao_paulo_holidays:
+            rows.append((pd.Timestamp(f'{year}-{month_day}'), 'Sao Paulo'))
+
+    return(pd.DataFrame(rows, columns=['event_date', 'city_name']).sort_values('event_date', kind='stable'))
+
+def make_rates(days, rng, level=0.10):
+    # Daily annual rates (base 252) following a random walk around level, rounded as published by the BCB
+    steps = rng.normal(0, 0.0005, len(days))
+    return(np.clip(level + np.cumsum(steps), 0.02, 0.30).round(6))
+
+def accum_r252(rates):
+    # Cumulative return of the daily rates. The Accum of a day uses the rates up to the previous day
+    return(np.concatenate(([1.0], np.cumprod((1 + rates[:-1]) ** (1/252)))))
+
+def generate(data_dir, years=20, last_date='2022-09-01', seed=0):
+    # Writes the synthetic databases with years of data up to last_date to data_dir. Returns data_dir
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    last_date = pd.Timestamp(last_date)
+    first_date = last_date - pd.DateOffset(years=years)
+
+    holidays = make_holidays(first_date.year - 1, last_date.year + 10)
+    holidays.to_csv(os.path.join(data_dir, 'BR_holidays.csv'), sep=';', index=False, date_format='%Y-%m-%d')
+
+    bank_holidays = pd.DatetimeIndex(holidays.loc[holidays.city_name == 'Brazilian Real', 'event_date']).values.astype('datetime64[D]')
+    days = pd.DatetimeIndex(np.arange(np.datetime64(first_date, 'D'), np.datetime64(last_date, 'D') + 1, dtype='datetime64[D]'))
+    days = days[np.is_busday(days.values.astype('datetime64[D]'), holidays=bank_holidays)]
+
+    # CDI and Selic: the last day is the placeholder of the next rate (Rate 0)
+    for series_name, level in [('CDI', 0.10), ('Selic', 0.101)]:
+        rates = make_rates(days, rng, level)
+        rates[-1] = 0.0
+        df = pd.DataFrame({'Rate': rates, 'Accum': accum_r252(rates)}, index=days)
+        df.to_csv(os.path.join(data_dir, f'{series_name}.csv'), sep=';', index_label='TradeDate')
+
+    # IPCA: monthly rates, the last month is the placeholder of the next rate
+    months = pd.date_range(first_date.to_period('M').to_timestamp(), last_date, freq='MS')
+    ipca_rates = rng.uniform(-0.002, 0.012, len(months)).round(4)
+    ipca_rates[-1] = 0.0
+    accum = np.concatenate(([1.0], np.cumprod(1 + ipca_rates[:-1])))
+    num_ipca = np.where(np.arange(len(months)) < len(months) - 1, 1000 * accum, 0.0)
+    df = pd.DataFrame({'Num_IPCA': num_ipca, 'IPCA': ipca_rates, 'Accum': accum}, index=months)
+    df.to_csv(os.path.join(data_dir, 'IPCA.csv'), sep=';', index_label='TradeDate')
+
+    # BRLUSD: daily exchange rates following a random walk
+    brlusd = 3.5 * np.exp(np.cumsum(rng.normal(0, 0.008, len(days))))
+    pd.DataFrame({'BRLUSD': brlusd}, index=days).to_csv(os.path.join(data_dir, 'BRLUSD.csv'), sep=';', index_label='TradeDate')
+
+    return(data_dir)
@@ -1,114 +1,321 @@
 # Functions to calculate business days using the brazilian holidays
+import numpy as np
 import pandas as pd
 from pandas.tseries.offsets import BDay
 
-db_path = 'D:\Investiments\Databases\Indexes\BR_holidays.csv'
-br_holidays = pd.read_csv(db_path, delimiter=';')
+import registry
+import instrument
 
-br_holidays['event_date'] = pd.to_datetime(br_holidays['event_date'],format='%Y-%m-%d')
+# The holidays and calendars are not loaded when this module is imported. The calendars are built by the registry on first use,
+# from the BR_holidays.csv file in the data directory (see registry.py)
 
-# List of holidays that affect the brazilian stock exchange B3 - used to find the days the B3 is open for trade and settlement
-b3_holidays = br_holidays.loc[(br_holidays['city_name'] == 'Sao Paulo')]
-list_b3_holidays = b3_holidays['event_date'].values
+def load_holidays(db_path, city_name):
+    # Returns the list of holidays of city_name in the holidays file db_path
+    # 'Brazilian Real' - bank holidays, used to calculate business days for interest rates (CDI, Selic)
+    # 'Sao Paulo' - holidays that affect the brazilian stock exchange B3, used to find the days the B3 is open for trade and settlement
+    try:
+        holidays = pd.read_csv(db_path, delimiter=';')
+    except Exception as err:
+        raise Exception(err)
 
-# List of bank holidays - used to calculate business days for interest rates (CDI, Selic)
-br_holidays = br_holidays.loc[(br_holidays['city_name'] == 'Brazilian Real')]
-list_br_holidays = br_holidays['event_date'].values
+    holidays['event_date'] = pd.to_datetime(holidays['event_date'],format='%Y-%m-%d')
+    return(holidays.loc[(holidays['city_name'] == city_name), 'event_date'].values)
 
+def __getattr__(name):
+    # The lists of holidays and the calendars that were module variables are still available, loaded on first access
+    if name == 'br_calendar':
+        return(registry.get_calendar('br'))
+    if name == 'b3_calendar':
+        return(registry.get_calendar('b3'))
+    if name == 'list_br_holidays':
+        return(registry.get_calendar('br').holidays.astype('datetime64[ns]'))
+    if name == 'list_b3_holidays':
+        return(registry.get_calendar('b3').holidays.astype('datetime64[ns]'))
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+class BusinessCalendar:
+    # Business day calendar built once for a set of holidays
+    # Precomputes, for every calendar day between the first and the last year of the holiday list, if the day is a business day and
+    # the number of business days before it (the business day ordinal). Lookups inside that range are array index operations.
+    # Dates outside the precomputed range fall back to numpy's busday functions using the same holidays.
+
+    def __init__(self, holidays):
+        self.holidays = np.unique(np.asarray(holidays, dtype='datetime64[D]'))
+        self.busdaycal = np.busdaycalendar(weekmask='1111100', holidays=self.holidays)
+
+        if len(self.holidays) > 0:
+            first_year = self.holidays[0].astype('datetime64[Y]')
+            last_year = self.holidays[-1].astype('datetime64[Y]')
+            self.first_day = first_year.astype('datetime64[D]')
+            self.last_day = (last_year + 1).astype('datetime64[D]') - 1
+        else:
+            self.first_day = np.datetime64('1970-01-01', 'D')
+            self.last_day = np.datetime64('1970-12-31', 'D')
+
+        days = np.arange(self.first_day, self.last_day + 1, dtype='datetime64[D]')
+
+        # bday_flags[i] tells if first_day + i is a business day
+        self.bday_flags = np.is_busday(days, busdaycal=self.busdaycal)
+        # bday_ordinals[i] is the number of business days in [first_day, first_day + i)
+        self.bday_ordinals = np.concatenate(([0], np.cumsum(self.bday_flags)))
+        # bday_dates[k] is the k-th business day of the precomputed range
+        self.bday_dates = days[self.bday_flags]
+
+        self.first_ordinal = self.first_day.astype(np.int64)
+        self.num_days = len(days)
+
+    @classmethod
+    def from_arrays(cls, holidays, bday_flags, bday_ordinals, first_day):
+        # Builds a calendar from the arrays of another one (e.g. arrays in shared memory), without recomputing them
+        calendar = cls.__new__(cls)
+        calendar.holidays = holidays
+        calendar.busdaycal = np.busdaycalendar(weekmask='1111100', holidays=holidays)
+        calendar.first_day = first_day
+        calendar.last_day = first_day + len(bday_flags) - 1
+        calendar.bday_flags = bday_flags
+        calendar.bday_ordinals = bday_ordinals
+        calendar.bday_dates = np.arange(first_day, calendar.last_day + 1, dtype='datetime64[D]')[bday_flags]
+        calendar.first_ordinal = first_day.astype(np.int64)
+        calendar.num_days = len(bday_flags)
+        return(calendar)
+
+    def _day_position(self, ref_date):
+        # Returns the position of ref_date in the precomputed range, or -1 if ref_date is outside it
+        pos = ref_date.toordinal() - 719163 - self.first_ordinal
+        if 0 <= pos < self.num_days:
+            return(pos)
+        return(-1)
+
+    def is_bday(self, ref_date):
+        # Returns if ref_date is a business day
+        pos = self._day_position(ref_date)
+        if pos >= 0:
+            return(bool(self.bday_flags[pos]))
+        return(bool(np.is_busday(np.datetime64(ref_date.date()), busdaycal=self.busdaycal)))
+
+    def next_bday(self, st_date, num_days=1):
+        # Returns the date that is num_days business days after st_date
+        if num_days < 0:
+            raise Exception('num-days must be positive')
+        if num_days == 0:
+            return(st_date)
+
+        pos = self._day_position(st_date)
+        if pos >= 0:
+            # Number of business days up to st_date (inclusive) + num_days - 1 is the position of the target in bday_dates
+            k = self.bday_ordinals[pos] + self.bday_flags[pos] + num_days - 1
+            if k < len(self.bday_dates):
+                return(pd.Timestamp(self.bday_dates[k]))
+
+        next_date = np.busday_offset(np.datetime64(st_date.date()), num_days, roll='backward', busdaycal=self.busdaycal)
+        return(pd.Timestamp(next_date))
+
+    def prev_bday(self, st_date, num_days=-1):
+        # Returns the date that is num_days business days before st_date
+        if num_days > 0:
+            num_days = -num_days
+        if num_days == 0:
+            return(st_date)
+
+        pos = self._day_position(st_date)
+        if pos >= 0:
+            k = self.bday_ordinals[pos] + num_days
+            if k >= 0:
+                return(pd.Timestamp(self.bday_dates[k]))
+
+        prev_date = np.busday_offset(np.datetime64(st_date.date()), num_days, roll='forward', busdaycal=self.busdaycal)
+        return(pd.Timestamp(prev_date))
+
+    def num_bdays(self, st_date, end_date):
+        # Returns the number of business days between st_date (inclusive) and end_date (exclusive)
+        # Dates that are not business days are moved to the following business day, which does not change their ordinal
+        st_pos = self._day_position(st_date)
+        end_pos = self._day_position(end_date)
+        if st_pos >= 0 and end_pos >= 0:
+            num_days = int(self.bday_ordinals[end_pos] - self.bday_ordinals[st_pos])
+        else:
+            num_days = int(self._busday_count(np.datetime64(st_date.date()), np.datetime64(end_date.date())))
+
+        # An inverted interval is an empty range of dates, as in pd.bdate_range
+        if num_days < 0:
+            num_days = -1
+
+        return(num_days)
+
+    def _busday_count(self, st_days, end_days):
+        # numpy's busday_count of the dates moved to the following business day. For an inverted interval busday_count counts
+        # (end, st] instead of [end, st), which only agrees with the ordinals of the precomputed range when both are business days
+        st_days = np.busday_offset(st_days, 0, roll='forward', busdaycal=self.busdaycal)
+        end_days = np.busday_offset(end_days, 0, roll='forward', busdaycal=self.busdaycal)
+        return(np.busday_count(st_days, end_days, busdaycal=self.busdaycal))
+
+    def list_of_bdays(self, st_date, end_date):
+        # Returns a list with all business days between st_date (inclusive) and end_date (inclusive)
+        st_pos = self._day_position(st_date)
+        end_pos = self._day_position(end_date)
+        if st_pos >= 0 and end_pos >= 0:
+            list_bdays = self.bday_dates[self.bday_ordinals[st_pos]:self.bday_ordinals[end_pos + 1]]
+            return(pd.DatetimeIndex(list_bdays.astype('datetime64[ns]')))
+
+        return(pd.bdate_range(start=st_date, end=end_date, freq='C', holidays=self.holidays))
+
+    # Array versions of the functions above. They take a DatetimeIndex, a Series of dates or a numpy datetime64 array
+    # and return numpy arrays with the same results the scalar functions return for each date
+
+    def _day_positions(self, days):
+        # Returns the positions of days in the precomputed range and a mask of the days that are inside it
+        pos = days.astype(np.int64) - self.first_ordinal
+        inside = (pos >= 0) & (pos < self.num_days)
+        return(np.where(inside, pos, 0), inside)
+
+    def is_bday_array(self, dates):
+        # Returns a boolean array telling which dates are business days
+        days = to_days(dates)
+        pos, inside = self._day_positions(days)
+        is_bday = self.bday_flags[pos]
+        if not inside.all():
+            is_bday[~inside] = np.is_busday(days[~inside], busdaycal=self.busdaycal)
+        return(is_bday)
+
+    def next_bday_array(self, dates, num_days=1):
+        # Returns the dates that are num_days business days after each date. num_days may be a number or an array
+        days = to_days(dates)
+        num_days = np.broadcast_to(np.asarray(num_days, dtype=np.int64), days.shape)
+        if (num_days < 0).any():
+            raise Exception('num-days must be positive')
+
+        pos, inside = self._day_positions(days)
+        k = self.bday_ordinals[pos] + self.bday_flags[pos] + num_days - 1
+        found = inside & (k < len(self.bday_dates))
+        next_dates = np.where(num_days == 0, days, self.bday_dates[np.clip(k, 0, len(self.bday_dates) - 1)])
+
+        fallback = ~found & (num_days > 0)
+        if fallback.any():
+            next_dates[fallback] = np.busday_offset(days[fallback], num_days[fallback], roll='backward', busdaycal=self.busdaycal)
+        return(next_dates.astype('datetime64[ns]'))
+
+    def prev_bday_array(self, dates, num_days=-1):
+        # Returns the dates that are num_days business days before each date. num_days may be a number or an array
+        days = to_days(dates)
+        num_days = -np.abs(np.broadcast_to(np.asarray(num_days, dtype=np.int64), days.shape))
+
+        pos, inside = self._day_positions(days)
+        k = self.bday_ordinals[pos] + num_days
+        found = inside & (k >= 0)
+        prev_dates = np.where(num_days == 0, days, self.bday_dates[np.clip(k, 0, len(self.bday_dates) - 1)])
+
+        fallback = ~found & (num_days < 0)
+        if fallback.any():
+            prev_dates[fallback] = np.busday_offset(days[fallback], num_days[fallback], roll='forward', busdaycal=self.busdaycal)
+        return(prev_dates.astype('datetime64[ns]'))
+
+    def num_bdays_array(self, st_dates, end_dates):
+        # Returns the number of business days between each pair of st_dates (inclusive) and end_dates (exclusive)
+        st_days = to_days(st_dates)
+        end_days = to_days(end_dates)
+        st_days, end_days = np.broadcast_arrays(st_days, end_days)
+
+        st_pos, st_inside = self._day_positions(st_days)
+        end_pos, end_inside = self._day_positions(end_days)
+        num_days = self.bday_ordinals[end_pos] - self.bday_ordinals[st_pos]
+
+        fallback = ~(st_inside & end_inside)
+        if fallback.any():
+            num_days[fallback] = self._busday_count(st_days[fallback], end_days[fallback])
+
+        # An inverted interval is an empty range of dates, as in pd.bdate_range
+        num_days[num_days < 0] = -1
+        return(num_days)
+
+
+def to_days(dates):
+    # Converts a date, a list of dates, a DatetimeIndex, a Series of dates or a datetime64 array to a datetime64[D] array
+    if isinstance(dates, np.ndarray) and np.issubdtype(dates.dtype, np.datetime64):
+        return(dates.astype('datetime64[D]'))
+    if isinstance(dates, pd.Series):
+        dates = dates.values
+    return(np.atleast_1d(pd.DatetimeIndex(np.atleast_1d(dates)).values.astype('datetime64[D]')))
+
+
+# The functions below use the bank calendar for interest rates ('br') and the B3 calendar for trading and settlement ('b3')
+
+@instrument.timed('br_workdays.next_br_bday')
 def next_br_bday (st_date, num_days=1):
     # Calculates the date that is num_days business days after (num_days > 0)
-    
-    if num_days < 0:
-        raise Exception('num-days must be positive')
-
-    next_date = st_date
-    
-    while (num_days > 0):   
-        next_date = next_date + pd.Timedelta(1, unit='D')
-        
-        while ((next_date in list_br_holidays) or (next_date.dayofweek == 5) or (next_date.dayofweek == 6)):
-            next_date = next_date + pd.Timedelta(1, unit='D')
-            
-        num_days = num_days - 1
-    
-    return(next_date)  
+    return(registry.get_calendar('br').next_bday(st_date, num_days))
 
+@instrument.timed('br_workdays.prev_br_bday')
 def prev_br_bday (st_date, num_days=-1):
     # Calculates the date that is num_days business days before (num_days < 0) st_date
+    return(registry.get_calendar('br').prev_bday(st_date, num_days))
 
-    if num_days > 0:
-        num_days = -num_days
-
-    next_date = st_date
-    
-    while (num_days < 0):   
-        next_date = next_date + pd.Timedelta(-1, unit='D')
-        
-        while ((next_date in list_br_holidays) or (next_date.dayofweek == 5) or (next_date.dayofweek == 6)):
-            next_date = next_date + pd.Timedelta(-1, unit='D')
-            
-        num_days = num_days + 1
-    
-    return(next_date)
-
+@instrument.timed('br_workdays.num_br_bdays')
 def num_br_bdays (st_date, end_date):
     # Calculates the number of business days between st_date and end_date
-    
-    if not is_br_bday(st_date):
-        st_date = next_br_bday(st_date)
-    
-    if not is_br_bday(end_date):
-        end_date = next_br_bday(end_date)
-
-    num_days = len(pd.bdate_range(start=st_date, end=end_date,freq='C', holidays=list_br_holidays))-1
-
-    return(num_days)
+    return(registry.get_calendar('br').num_bdays(st_date, end_date))
 
+@instrument.timed('br_workdays.is_br_bday')
 def is_br_bday(ref_date):
     # Returns if ref_date is a business day in Brazil
+    return(registry.get_calendar('br').is_bday(ref_date))
 
-    if ((ref_date in list_br_holidays) or (ref_date.dayofweek == 5) or (ref_date.dayofweek == 6)):
-        return(False)
-    else:
-        return(True)
-
+@instrument.timed('br_workdays.list_of_br_bdays')
 def list_of_br_bdays(st_date, end_date):
     # Returns a list with all business days in Brazil between st_date (inclusive) and end_date (inclusive)
+    return(registry.get_calendar('br').list_of_bdays(st_date, end_date))
 
-    list_br_bdays = pd.bdate_range(start=st_date, end=end_date,freq='C', holidays=list_br_holidays)
-
-    return(list_br_bdays)
-
+@instrument.timed('br_workdays.next_b3_bday')
 def next_b3_bday (st_date, num_days=1):
     # Calculates the date that is num_days business days after (num_days > 0) considering B3's calendar
-    
-    if num_days < 0:
-        raise Exception('num-days must be positive')
-
-    next_date = st_date
-    
-    while (num_days > 0):   
-        next_date = next_date + pd.Timedelta(1, unit='D')
-        
-        while ((next_date in list_b3_holidays) or (next_date.dayofweek == 5) or (next_date.dayofweek == 6)):
-            next_date = next_date + pd.Timedelta(1, unit='D')
-            
-        num_days = num_days - 1
-    
-    return(next_date)  
+    return(registry.get_calendar('b3').next_bday(st_date, num_days))
 
+@instrument.timed('br_workdays.is_b3_bday')
 def is_b3_bday(ref_date):
     # Returns if ref_date is a business day for B3
+    return(registry.get_calendar('b3').is_bday(ref_date))
 
-    if ((ref_date in list_b3_holidays) or (ref_date.dayofweek == 5) or (ref_date.dayofweek == 6)):
-        return(False)
-    else:
-        return(True)
-
+@instrument.timed('br_workdays.list_of_b3_bdays')
 def list_of_b3_bdays(st_date, end_date):
     # Returns a list with all B3 business days between st_date (inclusive) and end_date (inclusive)
+    return(registry.get_calendar('b3').list_of_bdays(st_date, end_date))
+
+@instrument.timed('br_workdays.is_br_bday_array')
+def is_br_bday_array(dates):
+    # Returns a boolean array telling which dates are business days in Brazil
+    return(registry.get_calendar('br').is_bday_array(dates))
+
+@instrument.timed('br_workdays.next_br_bday_array')
+def next_br_bday_array(dates, num_days=1):
+    # Returns an array with the dates that are num_days business days after each date
+    return(registry.get_calendar('br').next_bday_array(dates, num_days))
+
+@instrument.timed('br_workdays.prev_br_bday_array')
+def prev_br_bday_array(dates, num_days=-1):
+    # Returns an array with the dates that are num_days business days before each date
+    return(registry.get_calendar('br').prev_bday_array(dates, num_days))
+
+@instrument.timed('br_workdays.num_br_bdays_array')
+def num_br_bdays_array(st_dates, end_dates):
+    # Returns an array with the number of business days between each pair of st_dates and end_dates
+    return(registry.get_calendar('br').num_bdays_array(st_dates, end_dates))
+
+@instrument.timed('br_workdays.is_b3_bday_array')
+def is_b3_bday_array(dates):
+    # Returns a boolean array telling which dates are B3 business days
+    return(registry.get_calendar('b3').is_bday_array(dates))
+
+@instrument.timed('br_workdays.next_b3_bday_array')
+def next_b3_bday_array(dates, num_days=1):
+    # Returns an array with the dates that are num_days B3 business days after each date
+    return(registry.get_calendar('b3').next_bday_array(dates, num_days))
 
-    list_br_bdays = pd.bdate_range(start=st_date, end=end_date,freq='C', holidays=list_br_holidays)
+@instrument.timed('br_workdays.prev_b3_bday_array')
+def prev_b3_bday_array(dates, num_days=-1):
+    # Returns an array with the dates that are num_days B3 business days before each date
+    return(registry.get_calendar('b3').prev_bday_array(dates, num_days))
 
-    return(list_br_bdays)
-    
+@instrument.timed('br_workdays.num_b3_bdays_array')
+def num_b3_bdays_array(st_dates, end_dates):
+    # Returns an array with the number of B3 business days between each pair of st_dates and end_dates
+    return(registry.get_calendar('b3').num_bdays_array(st_dates, end_dates))
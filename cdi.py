@@ -2,18 +2,23 @@
 # CDI rate means the Brazilian interbank deposit (Certificado de Depósito Interbancário) rate, which is an average of interbank overnight rates in Brazil.
 # CDI rate is expressed as a percentage per annum, based on a two hundred fifty-two (252) business days year, as published by B3 in its daily report available at B3’s website (http://www.b3.com.br)
 
-import os
+import numpy as np
 import pandas as pd
+import storage
+import registry
+import instrument
 import bacen as bc
 import ir_calc as ir
 import br_workdays as wd
 
 
-def load_cdi(db_path='D:\Investiments\Databases\Indexes\CDI.csv'):
-    # Reads the CDI database to dataframe
+@instrument.timed('cdi.load_cdi')
+def load_cdi(db_path=None, mmap=True, version=None):
+    # Reads the CDI database to dataframe. version pins a previous version of the database (see storage.list_versions)
+    if db_path is None:
+        db_path = registry.series_path('CDI')
     try:
-        df_cdi = pd.read_csv(db_path, delimiter=';', dtype={'Rate':float, 'Accum':float}, index_col='TradeDate')
-        df_cdi.index = pd.to_datetime(df_cdi.index,format='%Y-%m-%d')
+        df_cdi = storage.read_series(db_path, {'Rate':float, 'Accum':float}, mmap, version)
         df_cdi.sort_index()
     except OSError as err:
         raise OSError(err)
@@ -22,52 +27,52 @@ def load_cdi(db_path='D:\Investiments\Databases\Indexes\CDI.csv'):
 
     return(df_cdi)
 
-def update_cdi_db(db_path='D:\Investiments\Databases\Indexes\CDI.csv'):
+@instrument.timed('cdi.update_cdi_db')
+def update_cdi_db(db_path=None, verify=False, novos_cdi=None):
     # Updates the CDI database with all the rates published after the last update
+    # novos_cdi can bring the rates already fetched from the BCB api (see updater.update_all_indexes), otherwise they are fetched here
+    if db_path is None:
+        db_path = registry.series_path('CDI')
 
-    df_cdi = load_cdi(db_path)
+    with storage.locked(db_path):
+        df_cdi = load_cdi(db_path, mmap=False)
 
-    # Get the CDI values published since the last update
-    start_date_str = df_cdi.last_valid_index().strftime('%d/%m/%Y')
-    end_date_str = pd.to_datetime("today").strftime("%d/%m/%Y")
+        # Get the CDI values published since the last update
+        if novos_cdi is None:
+            start_date_str = df_cdi.last_valid_index().strftime('%d/%m/%Y')
+            end_date_str = pd.to_datetime("today").strftime("%d/%m/%Y")
 
-    try:
-        novos_cdi = bc.get_bacen_data('CDI', start_date_str, end_date_str)
-    except Exception as err:
-        raise Exception(err)
+            try:
+                novos_cdi = bc.get_bacen_data('CDI', start_date_str, end_date_str)
+            except Exception as err:
+                raise Exception(err)
 
-    # if novos_cdi.first_valid_index().strftime('%d/%m/%Y') == start_date_str:
-    #    novos_cdi.drop(novos_cdi.first_valid_index(), inplace=True)
+        if novos_cdi.empty:
+            return
 
-    if novos_cdi.first_valid_index() == df_cdi.last_valid_index():
-        df_cdi.drop(df_cdi.last_valid_index(), inplace=True)
+        novos_cdi.rename(columns={'valor':'Rate'}, inplace=True)
 
-    novos_cdi.rename(columns={'valor':'Rate'}, inplace=True)
+        # Includes the workday following the date of the last CDI rate available, to calculate the last available Accum
+        new_date = wd.next_br_bday(novos_cdi.last_valid_index())
 
-    # Appends new rates to the dataframe
-    df_cdi = pd.concat([df_cdi, novos_cdi])
+        # Continues the cumulative CDI from the last stored Accum. Only the rows from from_row onwards (the placeholder row
+        # of the last update and the new rates) are written to the database
+        from_row, new_rows = ir.append_accum_r252(df_cdi, novos_cdi, new_date)
 
-    # Includes the workday following the date of the last CDI rate available, to calculate the last available Accum
-    new_date = wd.next_br_bday(df_cdi.last_valid_index())
-    new_row = pd.DataFrame(data={'Rate':[0.0],'Accum':[1.0]},index=[new_date])
-    df_cdi = pd.concat([df_cdi, new_row])
+        if verify:
+            ir.verify_accum_r252(pd.concat([df_cdi.iloc[:from_row], new_rows]))
 
-    df_cdi.sort_index()
+        # Saves the new rows to the database as a new version. The rows they replace are kept in the versions of the database
+        storage.commit_series(new_rows, db_path, from_row, new_date)
 
-    # Calculates the cumulative CDI for the whole period
-    df_cdi = ir.calc_accum_r252(df_cdi)
+        # Cached accumulations of the previous version of the series are no longer valid
+        ir.invalidate_accum_cache('CDI')
+        registry.invalidate_series('CDI')
 
-    # Saves the last version of the CDI database
-    new_path = db_path[:len(db_path)-4] + df_cdi.last_valid_index().strftime('%Y%m%d') + '.csv'
-    if not os.path.exists(new_path):
-        os.rename(db_path,new_path)
-
-    # Saves the updated series to the csv file
-    df_cdi.to_csv(db_path, sep=';',header=['Rate','Accum'], index_label='TradeDate')
-
-def cdi_accum (df_cdi, start_date, end_date, percent=1):
+def cdi_accum (df_cdi, start_date, end_date, percent=1, method='cumprod'):
     # Returns the cumulative return of the CDI rate between start_date (inclusive) and end_date (exclusive)
     # If percent <> 1, applies percent to the daily effective rate
+    # method 'log' or 'b3' uses that accumulation method (see ir_calc.accum_methods)
     # If start_date is not a business day in Brazil, considers the following business day as start_date
     # If end_date is not a business day in Brazil, considers the following business day as end_date
 
@@ -80,15 +85,39 @@ def cdi_accum (df_cdi, start_date, end_date, percent=1):
     if (start_date < df_cdi.first_valid_index()) or (end_date > df_cdi.last_valid_index()):
         raise Exception('Dates out of available range of CDI dates')
 
+    if method != 'cumprod':
+        return(ir.accum_r252_batch(df_cdi, start_date, end_date, percent, 'CDI', method)[0])
+
     try:
         if percent == 1:
             cum_ret = df_cdi.loc[end_date].Accum / df_cdi.loc[start_date].Accum
         else:
-            df_cdi_tmp = df_cdi.loc[start_date : end_date]
-            df_cdi_tmp = ir.calc_accum_r252(df_cdi_tmp, percent)
-            cum_ret = df_cdi_tmp.loc[end_date].Accum / df_cdi_tmp.loc[start_date].Accum
+            # Uses the cumulative products of the daily factors of the whole series for this percent, computed once and cached
+            accum = ir.cached_accum_r252(df_cdi, percent, 'CDI')
+            cum_ret = accum[df_cdi.index.get_loc(end_date)] / accum[df_cdi.index.get_loc(start_date)]
     except Exception as err:
         print(err)
     return(cum_ret)
 
+def cdi_accum_batch (df_cdi, start_dates, end_dates, percents=1, method='cumprod'):
+    # Returns an array with the cumulative return of the CDI rate between each start_date (inclusive) and end_date (exclusive)
+    # start_dates and end_dates are arrays of dates (DatetimeIndex, Series or datetime64 arrays), percents is a number or an array
+    # method is the accumulation method (see ir_calc.accum_methods): 'b3' follows the B3 truncation rules, for reconciliations
+    # Dates follow the same rules of cdi_accum: dates that are not business days in Brazil are moved to the following business day
 
+    start_dates = wd.to_days(start_dates)
+    end_dates = wd.to_days(end_dates)
+    if start_dates.size == 0 or end_dates.size == 0:
+        return(np.empty(np.broadcast_shapes(start_dates.shape, end_dates.shape)))
+    start_dates = np.where(wd.is_br_bday_array(start_dates), start_dates, wd.next_br_bday_array(start_dates))
+    end_dates = np.where(wd.is_br_bday_array(end_dates), end_dates, wd.next_br_bday_array(end_dates))
+
+    if (start_dates.min() < df_cdi.first_valid_index()) or (end_dates.max() > df_cdi.last_valid_index()):
+        raise Exception('Dates out of available range of CDI dates')
+
+    try:
+        cum_ret = ir.accum_r252_batch(df_cdi, start_dates, end_dates, percents, 'CDI', method)
+    except KeyError as err:
+        raise KeyError(err)
+
+    return(cum_ret)
@@ -0,0 +1,155 @@
+# This module contains the interest rate curves used to project the CDI and discount cash flows
+# PreCurve is the pre-fixed rate curve of a date (e.g. built from DI1 futures), with rates as exponential annual rates base 252 (workdays)
+# Rates between vertices are interpolated exponentially on business days (flat-forward 252): the daily forward rate is constant
+# between two vertices, and after the last vertex the last forward rate is kept
+
+import numpy as np
+import pandas as pd
+import registry
+import ir_calc as ir
+import br_workdays as wd
+
+# Notional of the DI1 futures contract at maturity
+di1_notional = 100000
+
+
+class PreCurve:
+    # Pre-fixed rate curve of curve_date, built once from its vertices (maturity dates and rates)
+    # Every function takes arrays of dates (DatetimeIndex, Series or datetime64 arrays) and returns numpy arrays
+
+    def __init__(self, curve_date, maturities, rates, calendar_name='br'):
+        self.calendar = registry.get_calendar(calendar_name)
+        # A curve date that is not a business day is moved to the following business day, as the dates given to accum
+        self.curve_date = pd.Timestamp(curve_date)
+        if not self.calendar.is_bday(self.curve_date):
+            self.curve_date = self.calendar.next_bday(self.curve_date)
+        self.curve_day = np.datetime64(self.curve_date, 'D')
+
+        bdays = self.calendar.num_bdays_array(self.curve_day, wd.to_days(maturities))
+        rates = np.broadcast_to(np.asarray(rates, dtype=float), bdays.shape)
+        if (bdays <= 0).any():
+            raise Exception('Maturities of the curve must be after the curve date')
+
+        order = np.argsort(bdays, kind='stable')
+        bdays, rates = bdays[order], rates[order]
+        if (np.diff(bdays) == 0).any():
+            raise Exception('Curve has more than one rate for the same maturity')
+
+        # Nodes of the curve: business days from curve_date and log of the discount factor, starting at the curve date (0, 0.0)
+        self.nodes = np.concatenate(([0], bdays))
+        self.log_discounts = np.concatenate(([0.0], -bdays / 252 * np.log1p(rates)))
+        # Log of the daily discount factor of each segment between nodes. The last one is also used after the last vertex
+        self.slopes = np.diff(self.log_discounts) / np.diff(self.nodes)
+
+        # Cumulative log factors of the projected accumulation for each percentage of the rate (see log_accum)
+        self.log_accums = {}
+
+    @classmethod
+    def from_di1(cls, curve_date, maturities, prices, calendar_name='br'):
+        # Builds the curve from the prices (PU) of DI1 futures with the given maturities
+        curve_day = np.datetime64(pd.Timestamp(curve_date), 'D')
+        bdays = registry.get_calendar(calendar_name).num_bdays_array(curve_day, wd.to_days(maturities))
+        rates = (di1_notional / np.asarray(prices, dtype=float)) ** (252 / bdays) - 1
+
+        return(cls(curve_date, maturities, rates, calendar_name))
+
+    def business_days(self, dates):
+        # Returns the number of business days between the curve date and each date. Dates must not be before the curve date
+        days = wd.to_days(dates)
+        if (days < self.curve_day).any():
+            raise Exception('Dates must not be before the curve date')
+        return(self.calendar.num_bdays_array(self.curve_day, days))
+
+    def segments(self, bdays):
+        # Returns the segment of the curve of each number of business days
+        return(np.clip(np.searchsorted(self.nodes, bdays, side='right') - 1, 0, len(self.slopes) - 1))
+
+    def log_discount(self, bdays):
+        # Log of the discount factor for each number of business days from the curve date
+        seg = self.segments(bdays)
+        return(self.log_discounts[seg] + self.slopes[seg] * (bdays - self.nodes[seg]))
+
+    def discount(self, dates):
+        # Returns the discount factor from each date to the curve date
+        return(np.exp(self.log_discount(self.business_days(dates))))
+
+    def rate(self, dates):
+        # Returns the rate (exponential annual rate base 252) from the curve date to each date
+        bdays = self.business_days(dates)
+        seg = self.segments(bdays)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.expm1(-self.log_discount(bdays) * 252 / bdays)
+        # On the curve date itself, the rate of the first segment
+        return(np.where(bdays > 0, rates, np.expm1(-self.slopes[seg] * 252)))
+
+    def forward_rate(self, start_dates, end_dates):
+        # Returns the forward rate (exponential annual rate base 252) between each start_date and end_date
+        st_bdays = self.business_days(start_dates)
+        end_bdays = self.business_days(end_dates)
+        if (end_bdays < st_bdays).any():
+            raise Exception('Start Date must be older than End Date')
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.expm1((self.log_discount(st_bdays) - self.log_discount(end_bdays)) * 252 / (end_bdays - st_bdays))
+        # Between equal dates, the rate of the segment of the date
+        return(np.where(end_bdays > st_bdays, rates, np.expm1(-self.slopes[self.segments(st_bdays)] * 252)))
+
+    def log_accum(self, percentage):
+        # Returns the cumulative log of the projected daily factors at the nodes of the curve, using a given percentage of the rate
+        # The daily factor of each segment is (daily forward rate * percentage) + 1, as in calc_accum_r252
+        log_accum = self.log_accums.get(percentage)
+        if log_accum is None:
+            slopes = np.log1p(np.expm1(-self.slopes) * percentage)
+            log_accum = (np.concatenate(([0.0], np.cumsum(slopes * np.diff(self.nodes)))), slopes)
+            self.log_accums[percentage] = log_accum
+        return(log_accum)
+
+    def forward_accum(self, start_dates, end_dates, percentages=1):
+        # Returns the projected cumulative return of the rate between each start_date (inclusive) and end_date (exclusive),
+        # using the given percentage of the forward rates. percentages is a number or an array
+        st_bdays = self.business_days(start_dates)
+        end_bdays = self.business_days(end_dates)
+        st_bdays, end_bdays, percentages = np.broadcast_arrays(st_bdays, end_bdays, np.asarray(percentages, dtype=float))
+        if (end_bdays < st_bdays).any():
+            raise Exception('Start Date must be older than End Date')
+
+        st_seg = self.segments(st_bdays)
+        end_seg = self.segments(end_bdays)
+        log_ret = np.empty(st_bdays.shape)
+        for percentage in np.unique(percentages):
+            members = percentages == percentage
+            nodes_accum, slopes = self.log_accum(percentage)
+            st_log = nodes_accum[st_seg[members]] + slopes[st_seg[members]] * (st_bdays[members] - self.nodes[st_seg[members]])
+            end_log = nodes_accum[end_seg[members]] + slopes[end_seg[members]] * (end_bdays[members] - self.nodes[end_seg[members]])
+            log_ret[members] = end_log - st_log
+
+        return(np.exp(log_ret))
+
+    def accum(self, rate252, start_dates, end_dates, percentages=1, series_name='CDI'):
+        # Returns the cumulative return of the rate between each start_date (inclusive) and end_date (exclusive), using the given percentage
+        # The part of each interval before the curve date uses the realized rates in rate252 (e.g. the CDI database) and the part after
+        # it uses the forward rates of the curve, so an instrument can be valued from its issue date to its maturity in one call
+        # Dates that are not business days are moved to the following business day, as in cdi_accum
+
+        st_days = wd.to_days(start_dates)
+        end_days = wd.to_days(end_dates)
+        st_days = np.where(self.calendar.is_bday_array(st_days), st_days, self.calendar.next_bday_array(st_days)).astype('datetime64[D]')
+        end_days = np.where(self.calendar.is_bday_array(end_days), end_days, self.calendar.next_bday_array(end_days)).astype('datetime64[D]')
+        st_days, end_days, percentages = np.broadcast_arrays(st_days, end_days, np.asarray(percentages, dtype=float))
+        if (st_days > end_days).any():
+            raise Exception('Start Date must be older than End Date')
+
+        # Realized part: from start_date to the curve date (or to end_date, if it comes first)
+        realized = np.ones(st_days.shape)
+        real_end = np.minimum(end_days, self.curve_day)
+        past = st_days < real_end
+        if past.any():
+            if (st_days[past].min() < np.datetime64(rate252.first_valid_index(), 'D')) or (self.curve_day > np.datetime64(rate252.last_valid_index(), 'D')):
+                raise Exception('Dates out of available range of realized rates')
+            realized[past] = ir.accum_r252_batch(rate252, st_days[past], real_end[past], percentages[past], series_name)
+
+        # Projected part: from the curve date (or from start_date, if it comes after) to end_date
+        proj_start = np.maximum(st_days, self.curve_day)
+        projected = self.forward_accum(proj_start, np.maximum(end_days, self.curve_day), percentages)
+
+        return(realized * projected)
@@ -0,0 +1,161 @@
+# This module exports series derived from the index databases to CSV or Parquet files (or to stdout), for the data warehouse and BI
+# The derived series are generated lazily, chunk_rows dates at a time, from the stored Rate and Accum columns, and each chunk is
+# written before the next one is calculated, so the memory used does not grow with the length of the period:
+#   rate_accum_chunks      - cumulative return of the CDI or Selic at one or more percentages of the rate
+#   ipca_vna_chunks        - VNA (updated face value) of an IPCA indexed bond, for each business day
+#   converted_accum_chunks - cumulative return of the CDI or Selic converted to a foreign currency (e.g. CDI in USD)
+# The cumulative returns are from start_date: the first row is 1.0, and the value of a date accrues up to the day before it (as in cdi_accum)
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import storage
+import registry
+import instrument
+import ir_calc as ir
+import ipca
+import fxrates
+import br_workdays as wd
+
+default_chunk_rows = 10000
+
+# Rate series that can be exported with rate_accum_chunks and converted_accum_chunks
+rate_series = ('CDI', 'Selic')
+
+
+def column_name(series_name, percentage):
+    # Name of the column of the series at percentage (e.g. CDI_110 for 110% of the CDI)
+    return(f'{series_name}_{round(percentage * 100, 6):g}')
+
+def series_rows(df, series_name, start_date, end_date):
+    # Positions of the first and last rows of df between start_date and end_date (inclusive)
+    first = df.index.searchsorted(pd.Timestamp(start_date), side='left')
+    last = df.index.searchsorted(pd.Timestamp(end_date), side='right') - 1
+    if first > last:
+        raise Exception(f'No {series_name} dates between {start_date} and {end_date}')
+    return(first, last)
+
+def rate_accum_chunks(series_name, percentages, start_date, end_date, chunk_rows=default_chunk_rows, method='cumprod'):
+    # Generates the cumulative return of the series_name rate (CDI or Selic) from start_date, for each date of the series up to end_date
+    # Each chunk has one column per percentage of the rate (1 is the rate itself). method is one of ir_calc.accum_methods
+    if series_name not in rate_series:
+        raise Exception(f'Unknown rate series {series_name}. Use one of: {", ".join(rate_series)}')
+
+    df = registry.get_series(series_name)
+    first, last = series_rows(df, series_name, start_date, end_date)
+    columns = {column_name(series_name, percentage): float(percentage) for percentage in np.atleast_1d(percentages)}
+
+    if method == 'b3':
+        yield from b3_accum_chunks(df, columns, first, last, chunk_rows)
+        return
+
+    for row in range(first, last + 1, chunk_rows):
+        dates = df.index[row:min(row + chunk_rows, last + 1)]
+        yield pd.DataFrame({column: ir.accum_r252_batch(df, df.index[first], dates, percentage, series_name, method)
+                            for column, percentage in columns.items()}, index=dates.rename(storage.index_name))
+
+def b3_accum_chunks(df, columns, first, last, chunk_rows):
+    # Chunks of rate_accum_chunks with the B3 truncation rules. The truncated product of each column at the end of a chunk is carried
+    # to the next one, so each chunk accumulates only its own rates
+    rates = df.Rate.values
+    products = {column: ir.b3_limb * ir.b3_limb for column in columns}
+
+    for row in range(first, last + 1, chunk_rows):
+        end = min(row + chunk_rows, last + 1)
+        chunk = {}
+        for column, percentage in columns.items():
+            # The value of a row accrues the rates up to the row before it. The first row of the export is 1.0
+            column_products = ir.accum_b3_path(rates[max(row - 1, first):end - 1], percentage, products[column])
+            if row == first:
+                column_products = [products[column]] + column_products
+            products[column] = column_products[-1]
+            chunk[column] = ir.b3_units_to_float(column_products)
+        yield pd.DataFrame(chunk, index=df.index[row:end].rename(storage.index_name))
+
+def ipca_vna_chunks(base_date, start_date, end_date, base_value=1000.0, reset_day=15, accrual_type='cd', chunk_rows=default_chunk_rows):
+    # Generates the VNA of an IPCA indexed bond for each business day between start_date and end_date: base_value updated by the
+    # IPCA from base_date up to the day (see ipca.ipca_accum for reset_day and accrual_type)
+    df = registry.get_series('IPCA')
+    days = wd.list_of_br_bdays(pd.Timestamp(start_date), pd.Timestamp(end_date))
+    base_day = np.datetime64(pd.Timestamp(base_date), 'D')
+
+    for row in range(0, len(days), chunk_rows):
+        dates = days[row:row + chunk_rows]
+        vna = base_value * ipca.ipca_accum_batch(df, base_day, dates, reset_day, accrual_type)
+        yield pd.DataFrame({'VNA': vna}, index=pd.DatetimeIndex(dates, name=storage.index_name))
+
+def converted_accum_chunks(series_name, currency, percentages, start_date, end_date, chunk_rows=default_chunk_rows, fx_store=None):
+    # Generates the cumulative return of the series_name rate (CDI or Selic) converted to currency: an amount in BRL that accrues
+    # the rate, valued in currency at the exchange rate of each date. Uses the rate of the last business day with a published rate
+    if fx_store is None:
+        fx_store = fxrates.FXStore([currency])
+
+    start_rate = None
+    for chunk in rate_accum_chunks(series_name, percentages, start_date, end_date, chunk_rows):
+        rates = fx_store.rate(np.full(len(chunk), currency), chunk.index.values)
+        if start_rate is None:
+            start_rate = rates[0]
+        chunk = chunk.mul(start_rate / rates, axis=0)
+        yield chunk.rename(columns={column: f'{column}_{currency}' for column in chunk.columns})
+
+@instrument.timed('export.write_csv')
+def write_csv(chunks, path='-', float_format=None):
+    # Writes the chunks to the csv file in path (semicolon separated, as the databases), or to stdout if path is '-'
+    # The file is written to a temporary file and renamed when complete, so a failed export never leaves a partial file
+    # Returns the number of rows written
+    rows = 0
+    out_file = sys.stdout if path == '-' else open(path + '.tmp', 'w', newline='')
+    try:
+        for chunk in chunks:
+            chunk.to_csv(out_file, sep=';', header=(rows == 0), index_label=storage.index_name, date_format='%Y-%m-%d',
+                         float_format=float_format)
+            rows += len(chunk)
+    except:
+        if path != '-':
+            out_file.close()
+            os.remove(path + '.tmp')
+        raise
+
+    if path != '-':
+        out_file.close()
+        os.replace(path + '.tmp', path)
+    return(rows)
+
+@instrument.timed('export.write_parquet')
+def write_parquet(chunks, path):
+    # Writes the chunks to the Parquet file in path, one row group per chunk (needs pyarrow). Returns the number of rows written
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception('Parquet export needs pyarrow')
+
+    rows = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk.rename_axis(storage.index_name), preserve_index=True)
+            if writer is None:
+                writer = pq.ParquetWriter(path + '.tmp', table.schema)
+            writer.write_table(table)
+            rows += len(chunk)
+    except:
+        if writer is not None:
+            writer.close()
+            os.remove(path + '.tmp')
+        raise
+
+    if writer is None:
+        return(0)
+    writer.close()
+    os.replace(path + '.tmp', path)
+    return(rows)
+
+def write_chunks(chunks, path='-'):
+    # Writes the chunks to path, in the format of its extension (.csv or .parquet). '-' writes csv to stdout
+    if path == '-' or storage.storage_format(path) == 'csv':
+        return(write_csv(chunks, path))
+    if storage.storage_format(path) == 'parquet':
+        return(write_parquet(chunks, path))
+    raise Exception(f'Export to {path} not supported. Use a .csv or .parquet file, or - for stdout')
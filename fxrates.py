@@ -1,17 +1,24 @@
 # This module contains the set of functions that work with the FX rates.
 # For the BRL/USD FX rate we use the BCB API as source
+# The other currencies (EUR, GBP, JPY, CHF) use the BCB PTAX series too, one database per currency (BRLEUR, BRLGBP, ...)
+# FXStore holds all the currencies in one array aligned by date, for cross rates and batched conversions
  
-import os
+import numpy as np
 import pandas as pd
+import storage
+import registry
+import instrument
 import bacen as bc
 import ir_calc as ir
 import br_workdays as wd
 
-def load_brlusd(db_path='D:\Investiments\Databases\Indexes\BRLUSD.csv'):
+@instrument.timed('fxrates.load_brlusd')
+def load_brlusd(db_path=None, mmap=True, version=None):
     # Reads the BRLUSD database to dataframe
+    if db_path is None:
+        db_path = registry.series_path('BRLUSD')
     try:
-        df_brlusd = pd.read_csv(db_path, delimiter=';', dtype={'BRLUSD':float}, index_col='TradeDate')
-        df_brlusd.index = pd.to_datetime(df_brlusd.index,format='%Y-%m-%d')
+        df_brlusd = storage.read_series(db_path, {'BRLUSD':float}, mmap, version)
         df_brlusd.sort_index()
     except OSError as err:
         raise OSError(err)
@@ -20,37 +27,177 @@ def load_brlusd(db_path='D:\Investiments\Databases\Indexes\BRLUSD.csv'):
 
     return(df_brlusd)
 
-def update_brlusd_db(db_path='D:\Investiments\Databases\Indexes\BRLUSD.csv'):
+@instrument.timed('fxrates.update_brlusd_db')
+def update_brlusd_db(db_path=None, novos_brlusd=None):
     # Updates the BRLUSD database with all the rates published after the last update
+    # novos_brlusd can bring the rates already fetched from the BCB api (see updater.update_all_indexes), otherwise they are fetched here
+    if db_path is None:
+        db_path = registry.series_path('BRLUSD')
 
-    df_brlusd = load_brlusd(db_path)
+    with storage.locked(db_path):
+        df_brlusd = load_brlusd(db_path, mmap=False)
 
-    # Get the BRLUSD values published since the last update
-    start_date_str = df_brlusd.last_valid_index().strftime('%d/%m/%Y')
-    end_date_str = pd.to_datetime("today").strftime("%d/%m/%Y")
+        # Get the BRLUSD values published since the last update
+        if novos_brlusd is None:
+            start_date_str = df_brlusd.last_valid_index().strftime('%d/%m/%Y')
+            end_date_str = pd.to_datetime("today").strftime("%d/%m/%Y")
 
-    try:
-        novos_brlusd = bc.get_bacen_data('BRLUSD', start_date_str, end_date_str)
-    except Exception as err:
-        raise Exception(err)
+            try:
+                novos_brlusd = bc.get_bacen_data('BRLUSD', start_date_str, end_date_str)
+            except Exception as err:
+                raise Exception(err)
 
-    if novos_brlusd.first_valid_index() == df_brlusd.last_valid_index():
-        df_brlusd.drop(df_brlusd.last_valid_index(), inplace=True)
+        if novos_brlusd.empty:
+            return
 
-    novos_brlusd.rename(columns={'valor':'BRLUSD'}, inplace=True)
+        novos_brlusd.rename(columns={'valor':'BRLUSD'}, inplace=True)
+        novos_brlusd = novos_brlusd[['BRLUSD']].sort_index()
 
-    # Appends new rates to the dataframe
-    df_brlusd = pd.concat([df_brlusd, novos_brlusd])
+        # Rates already stored from the first new date on are replaced by the new ones
+        from_row = df_brlusd.index.searchsorted(novos_brlusd.first_valid_index())
 
-    df_brlusd.sort_index()
+        # Saves the new rates to the database as a new version
+        storage.commit_series(novos_brlusd, db_path, from_row, novos_brlusd.last_valid_index())
+        registry.invalidate_series('BRLUSD')
 
-    # Saves the last version of the BRLUSD database
-    new_path = db_path[:len(db_path)-4] + df_brlusd.last_valid_index().strftime('%Y%m%d') + '.csv'
-    if not os.path.exists(new_path):
-        os.rename(db_path,new_path)
+# Database (series name) of each currency. Rates are in BRL per unit of the currency
+fx_series = {'USD': 'BRLUSD', 'EUR': 'BRLEUR', 'GBP': 'BRLGBP', 'JPY': 'BRLJPY', 'CHF': 'BRLCHF'}
+
+def get_fx_series(currency):
+    try:
+        return(fx_series[currency])
+    except KeyError:
+        raise KeyError(f'Unknown currency {currency}. Use one of: {", ".join(fx_series)}')
+
+@instrument.timed('fxrates.load_fx')
+def load_fx(currency, db_path=None, mmap=True, version=None):
+    # Reads the database of the BRL rate of currency to dataframe (one column named as the series, e.g. BRLEUR)
+    series_name = get_fx_series(currency)
+    if db_path is None:
+        db_path = registry.series_path(series_name)
+    try:
+        df_fx = storage.read_series(db_path, {series_name:float}, mmap, version)
+        df_fx.sort_index()
+    except OSError as err:
+        raise OSError(err)
+    except Exception as err:
+        raise Exception(err)
+
+    return(df_fx)
+
+@instrument.timed('fxrates.update_fx_db')
+def update_fx_db(currency, db_path=None, novos_fx=None):
+    # Updates the database of the BRL rate of currency with all the rates published after the last update
+    # novos_fx can bring the rates already fetched from the BCB api, otherwise they are fetched here
+    series_name = get_fx_series(currency)
+    if db_path is None:
+        db_path = registry.series_path(series_name)
+
+    with storage.locked(db_path):
+        df_fx = load_fx(currency, db_path, mmap=False)
+
+        if novos_fx is None:
+            try:
+                novos_fx = bc.get_bacen_data(series_name, df_fx.last_valid_index(), pd.to_datetime("today"))
+            except Exception as err:
+                raise Exception(err)
+
+        if novos_fx.empty:
+            return
+
+        # Rates already stored are replaced by the new ones
+        novos_fx = novos_fx.rename(columns={'valor':series_name})
+        from_row = df_fx.index.searchsorted(novos_fx.first_valid_index())
+
+        # Saves the new rates to the database as a new version
+        storage.commit_series(novos_fx[[series_name]].sort_index(), db_path, from_row, novos_fx.last_valid_index())
+        registry.invalidate_series(series_name)
+
+
+class FXStore:
+    # BRL rates of many currencies in one array aligned by date: rates[i, j] is the BRL price of currencies[j] on days[i]
+    # days are all the business days (br calendar) between the first and the last rate of the series
+    # A day without rate (not published, or a day that is not a business day) uses the rate of the previous business day that
+    # has one, going back at most max_fallback business days. Older gaps are left without rate (NaN)
+
+    def __init__(self, currencies=tuple(fx_series), frames=None, max_fallback=5, calendar_name='br'):
+        # frames can bring the dataframes of the currencies (dict currency -> dataframe), otherwise they are taken from the registry
+        self.calendar = registry.get_calendar(calendar_name)
+        self.currencies = ['BRL'] + [currency for currency in currencies if currency != 'BRL']
+        self.columns = {currency: j for j, currency in enumerate(self.currencies)}
+        self.max_fallback = max_fallback
+
+        if frames is None:
+            frames = {currency: registry.get_series(get_fx_series(currency)) for currency in self.currencies[1:]}
+        series = [frames[currency].iloc[:, 0] for currency in self.currencies[1:]]
+
+        first_day = min(s.first_valid_index() for s in series)
+        last_day = max(s.last_valid_index() for s in series)
+        self.days = self.calendar.list_of_bdays(first_day, last_day).values.astype('datetime64[D]')
+
+        rates = np.full((len(self.days), len(self.currencies)), np.nan)
+        rates[:, 0] = 1.0
+        for j, s in enumerate(series, start=1):
+            pos = np.searchsorted(self.days, s.index.values.astype('datetime64[D]'))
+            inside = (pos < len(self.days))
+            inside[inside] = self.days[pos[inside]] == s.index.values.astype('datetime64[D]')[inside]
+            rates[pos[inside], j] = s.values[inside]
+
+        self.rates = pd.DataFrame(rates).ffill(limit=max_fallback).values
+        self.rates.flags.writeable = False
+
+        # Cross rates already calculated, keyed by (base, quote)
+        self.cross_cache = {}
+
+    def currency_columns(self, currencies):
+        # Returns the columns of the currencies in the rates array
+        codes, inverse = np.unique(np.asarray(currencies, dtype=str), return_inverse=True)
+        unknown = [code for code in codes if code not in self.columns]
+        if unknown:
+            raise KeyError(f'Currencies not in the FX store: {", ".join(unknown)}')
+        return(np.array([self.columns[code] for code in codes], dtype=np.int64)[inverse.reshape(-1)])
+
+    def day_rows(self, dates):
+        # Returns the rows of the rates array used for each date: the last business day on or before the date
+        days = wd.to_days(dates)
+        last_bdays = np.where(self.calendar.is_bday_array(days), days, self.calendar.prev_bday_array(days)).astype('datetime64[D]')
+        if (last_bdays.min() < self.days[0]) or (last_bdays.max() > self.days[-1]):
+            raise Exception('Dates out of available range of FX dates')
+        return(np.searchsorted(self.days, last_bdays))
+
+    def rate(self, currencies, dates):
+        # Returns the BRL price of each currency on each date
+        return(self.rates[self.day_rows(dates), self.currency_columns(currencies)])
+
+    def cross_rates(self, base, quote):
+        # Returns the price of base in units of quote (e.g. EUR, USD gives EURUSD) for all the days of the store, through the BRL rates
+        key = (base, quote)
+        cross = self.cross_cache.get(key)
+        if cross is None:
+            cross = self.rates[:, self.columns[base]] / self.rates[:, self.columns[quote]]
+            cross.flags.writeable = False
+            self.cross_cache[key] = cross
+        return(cross)
+
+    def cross_rate(self, base, quote, dates):
+        # Returns the price of base in units of quote on each date
+        return(self.cross_rates(base, quote)[self.day_rows(dates)])
+
+    def convert(self, amounts, currencies, dates, to_currency='BRL'):
+        # Converts the amounts, each in its currency, to to_currency using the rates of each date. All the conversions are done at once
+        rows = self.day_rows(dates)
+        amounts = np.asarray(amounts, dtype=float)
+        rows, amounts = np.broadcast_arrays(rows, amounts)
+        columns = np.broadcast_to(self.currency_columns(np.broadcast_to(np.asarray(currencies), amounts.shape).reshape(-1)), amounts.shape)
+
+        converted = amounts * self.rates[rows, columns]
+        if to_currency != 'BRL':
+            converted = converted / self.rates[rows, self.columns[to_currency]]
+
+        if np.isnan(converted).any():
+            raise Exception('No FX rate available in the fallback period for some of the conversions')
+        return(converted)
 
-    # Saves the updated series to the csv file
-    df_brlusd.to_csv(db_path, sep=';',header=['BRLUSD'], index_label='TradeDate')
 
 def brlusd_accum (df_brlusd, start_date, end_date):
     # Returns the cumulative return of the BRLUSD rate between start_date (inclusive) and end_date (exclusive)
@@ -71,3 +218,23 @@ def brlusd_accum (df_brlusd, start_date, end_date):
     except Exception as err:
         print(err)
     return(cum_ret)
+
+def brlusd_accum_batch (df_brlusd, start_dates, end_dates):
+    # Returns an array with the cumulative return of the BRLUSD rate between each start_date (inclusive) and end_date (exclusive)
+    # Dates follow the same rules of brlusd_accum: dates that are not business days in Brazil are moved to the following business day
+
+    start_dates = wd.to_days(start_dates)
+    end_dates = wd.to_days(end_dates)
+    start_dates = np.where(wd.is_br_bday_array(start_dates), start_dates, wd.next_br_bday_array(start_dates))
+    end_dates = np.where(wd.is_br_bday_array(end_dates), end_dates, wd.next_br_bday_array(end_dates))
+
+    if (start_dates.min() < df_brlusd.first_valid_index()) or (end_dates.max() > df_brlusd.last_valid_index()):
+        raise Exception('Dates out of available range of BRLUSD dates')
+
+    try:
+        rates = df_brlusd.BRLUSD.values
+        cum_ret = rates[ir.find_positions(df_brlusd, end_dates)] / rates[ir.find_positions(df_brlusd, start_dates)]
+    except KeyError as err:
+        raise KeyError(err)
+
+    return(cum_ret)
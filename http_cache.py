@@ -0,0 +1,141 @@
+# This module contains the on-disk cache of the responses of the BCB and IBGE apis
+# Responses are stored by (source, series_id, window start, window end). The freshness rules are:
+#   closed windows (periods whose values are already published and never change) are served from the cache forever
+#   open windows (periods that may still get new values) are served from the cache for max_age seconds, then revalidated
+#   with the server using the ETag / Last-Modified of the cached response
+# In offline mode only the cache is used: a window that is not in the cache raises CacheMiss instead of going to the network
+# The cache is disabled until enable() is called
+
+import os
+import re
+import json
+import time
+import http_client
+import instrument
+
+cache_dir = None
+offline = False
+default_max_age = 3600
+
+
+class CacheMiss(Exception):
+    # Raised in offline mode when a response is not in the cache
+    pass
+
+
+def enable(path, offline_mode=False, max_age=3600):
+    # Turns on the cache, storing the responses in the directory path
+    # offline_mode=True serves only from the cache. max_age is the time (seconds) an open window is served without revalidation
+    global cache_dir, offline, default_max_age
+
+    os.makedirs(path, exist_ok=True)
+    cache_dir = path
+    offline = offline_mode
+    default_max_age = max_age
+
+def disable():
+    # Turns off the cache. Every request goes to the network again
+    global cache_dir, offline
+
+    cache_dir = None
+    offline = False
+
+def entry_path(key):
+    # Returns the file of the cache entry of key (source, series_id, window start, window end)
+    parts = [re.sub(r'[^0-9A-Za-z_.-]', '_', str(part)) for part in key]
+    return(os.path.join(cache_dir, *parts[:-2], '_'.join(parts[-2:]) + '.json'))
+
+def read_entry(key):
+    try:
+        with open(entry_path(key), encoding='utf-8') as entry_file:
+            return(json.load(entry_file))
+    except (OSError, ValueError):
+        return(None)
+
+def write_entry(key, entry):
+    path = entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as entry_file:
+        json.dump(entry, entry_file)
+    os.replace(tmp_path, path)
+
+def response_max_age(headers):
+    # Returns the max-age of the Cache-Control header of the response, or None if the server did not send one
+    match = re.search(r'max-age=(\d+)', headers.get('cache-control', ''))
+    if match:
+        return(int(match.group(1)))
+    return(None)
+
+def cached_response(key):
+    # Returns (entry, fresh): the cached entry of key (or None) and if it can be served without going to the server
+    entry = read_entry(key)
+
+    if offline:
+        if entry is None:
+            instrument.count('http_cache.miss')
+            raise CacheMiss(f'{key} is not in the cache and the cache is in offline mode')
+        instrument.count('http_cache.hit')
+        return(entry, True)
+
+    if entry is None:
+        instrument.count('http_cache.miss')
+        return(None, False)
+
+    max_age = entry['max_age'] if entry['max_age'] is not None else default_max_age
+    fresh = entry['closed'] or (time.time() - entry['fetched_at'] < max_age)
+    instrument.count('http_cache.hit' if fresh else 'http_cache.stale')
+    return(entry, fresh)
+
+def conditional_headers(entry):
+    # Headers used to revalidate a cached entry with the server
+    headers = {}
+    if entry is not None:
+        if entry['headers'].get('etag'):
+            headers['If-None-Match'] = entry['headers']['etag']
+        if entry['headers'].get('last-modified'):
+            headers['If-Modified-Since'] = entry['headers']['last-modified']
+    return(headers)
+
+def store_response(key, closed, url, entry, status, headers, body):
+    # Stores the response to key and returns it as (status, headers, body)
+    # A 304 answer (not modified) keeps the cached body and restarts its max_age
+    if status == 304 and entry is not None:
+        instrument.count('http_cache.revalidated')
+        entry['fetched_at'] = time.time()
+        entry['closed'] = closed
+        entry['max_age'] = response_max_age(headers)
+        write_entry(key, entry)
+        return(entry['status'], entry['headers'], entry['body'].encode('utf-8'))
+
+    # Only final answers are stored: values (200) and windows without values (404)
+    if status in (200, 404):
+        write_entry(key, {'url': url, 'status': status, 'closed': closed, 'fetched_at': time.time(),
+                          'max_age': response_max_age(headers), 'headers': headers, 'body': body.decode('utf-8')})
+
+    return(status, headers, body)
+
+def fetch(url, key, closed):
+    # Gets url through the cache and returns (status, headers, body)
+    if cache_dir is None:
+        return(http_client.fetch(url))
+
+    entry, fresh = cached_response(key)
+    if fresh:
+        return(entry['status'], entry['headers'], entry['body'].encode('utf-8'))
+
+    status, headers, body = http_client.fetch(url, headers=conditional_headers(entry))
+    return(store_response(key, closed, url, entry, status, headers, body))
+
+async def fetch_async(client, url, key, closed):
+    # Asynchronous version of fetch. client is a http_client.AsyncClient
+    if cache_dir is None:
+        return(await client.fetch(url))
+
+    entry, fresh = cached_response(key)
+    if fresh:
+        return(entry['status'], entry['headers'], entry['body'].encode('utf-8'))
+
+    status, headers, body = await client.fetch(url, headers=conditional_headers(entry))
+    return(store_response(key, closed, url, entry, status, headers, body))
@@ -0,0 +1,147 @@
+# This module contains the HTTP functions used to download data from the BCB and IBGE apis
+# Requests keep their connections open (one pool per thread) and are retried with exponential backoff when the server fails
+# AsyncClient runs the requests of many series at the same time, so an update pays the longest round trip instead of the sum of all of them
+
+import json
+import time
+import asyncio
+import threading
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+default_timeout = 30
+default_retries = 3
+default_backoff = 0.5
+
+# Open connections of the current thread, keyed by (scheme, host)
+connection_pool = threading.local()
+
+
+class HttpError(Exception):
+    # Raised when the server answers with a status other than 200
+
+    def __init__(self, status, url):
+        super().__init__(f'HTTP status {status} fetching {url}')
+        self.status = status
+        self.url = url
+
+
+def get_connection(scheme, netloc, timeout):
+    # Returns an open connection to netloc, reusing the one kept by this thread if there is one
+    if not hasattr(connection_pool, 'connections'):
+        connection_pool.connections = {}
+
+    conn = connection_pool.connections.get((scheme, netloc))
+    if conn is None:
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=timeout)
+        connection_pool.connections[(scheme, netloc)] = conn
+    else:
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+
+    return(conn)
+
+def drop_connection(scheme, netloc):
+    # Closes the connection to netloc kept by this thread (after an error the connection can not be reused)
+    conn = getattr(connection_pool, 'connections', {}).pop((scheme, netloc), None)
+    if conn is not None:
+        conn.close()
+
+def request(url, timeout=default_timeout, headers=None):
+    # Makes one GET request to url and returns (status, response headers, body)
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+
+    conn = get_connection(parts.scheme, parts.netloc, timeout)
+    try:
+        conn.request('GET', path, headers=headers or {})
+        response = conn.getresponse()
+        body = response.read()
+    except (OSError, http.client.HTTPException):
+        drop_connection(parts.scheme, parts.netloc)
+        raise
+
+    if response.will_close:
+        drop_connection(parts.scheme, parts.netloc)
+
+    return(response.status, {key.lower(): value for key, value in response.getheaders()}, body)
+
+def is_retryable(status):
+    # Server errors and rate limiting are retried. Other statuses (e.g. 404) are final answers
+    return(status >= 500 or status == 429)
+
+def fetch(url, timeout=default_timeout, retries=default_retries, backoff=default_backoff, headers=None):
+    # Gets url and returns (status, response headers, body), retrying with exponential backoff on connection and server errors
+    for attempt in range(retries + 1):
+        try:
+            status, resp_headers, body = request(url, timeout, headers)
+            if not is_retryable(status):
+                return(status, resp_headers, body)
+            error = HttpError(status, url)
+        except (OSError, http.client.HTTPException) as err:
+            error = err
+
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+
+    raise error
+
+def fetch_json(url, timeout=default_timeout, retries=default_retries, backoff=default_backoff):
+    # Gets url and returns its body decoded from json
+    status, resp_headers, body = fetch(url, timeout, retries, backoff)
+    if status != 200:
+        raise HttpError(status, url)
+
+    return(json.loads(body))
+
+
+class AsyncClient:
+    # Asynchronous client used to fetch many urls concurrently
+    # The requests run in a pool of max_connections worker threads, each one keeping its connections open between requests
+    # The backoff between retries is an asyncio sleep, so a failing request does not hold a worker thread
+
+    def __init__(self, max_connections=8, timeout=default_timeout, retries=default_retries, backoff=default_backoff):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix='http_client')
+
+    async def __aenter__(self):
+        return(self)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def fetch(self, url, headers=None):
+        # Asynchronous version of fetch
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(self.retries + 1):
+            try:
+                status, resp_headers, body = await loop.run_in_executor(self.executor, request, url, self.timeout, headers)
+                if not is_retryable(status):
+                    return(status, resp_headers, body)
+                error = HttpError(status, url)
+            except (OSError, http.client.HTTPException) as err:
+                error = err
+
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+        raise error
+
+    async def fetch_json(self, url):
+        # Asynchronous version of fetch_json
+        status, resp_headers, body = await self.fetch(url)
+        if status != 200:
+            raise HttpError(status, url)
+
+        return(json.loads(body))
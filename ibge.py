@@ -1,41 +1,118 @@
+import json
+import asyncio
 import pandas as pd
+import http_client
+import http_cache
+import instrument
 
+# Url of the IBGE api (aggregate 1737 - IPCA). Can be changed to point to a local server
+ibge_api_url = 'https://servicodados.ibge.gov.br/api/v3/agregados/1737/periodos/{date_list}/variaveis/{series_id}?localidades=N1[all]'
+
+# The IPCA of a month is published around the 10th of the following month. A query whose last month started more than
+# closed_after_days ago has all its values published, so its cached response never expires
+closed_after_days = 50
+
+def ibge_request(series_id, date_list):
+    # Returns (url, cache key, closed) of the query of series_id for the months in date_list
+    months = date_list.split('|')
+    closed = pd.to_datetime(months[-1], format='%Y%m') + pd.Timedelta(closed_after_days, unit='D') < pd.to_datetime("today")
+
+    return(ibge_api_url.format(date_list=date_list, series_id=series_id), ('ibge', series_id, months[0], months[-1]), closed)
+
+def decode_ibge_response(url, status, body):
+    if status != 200:
+        raise http_client.HttpError(status, url)
+    return(json.loads(body))
+
+def parse_ibge_data(payload, date_column_name='TradeDate', value_column_name='Value'):
+    # Builds the dataframe of the series from the json payload returned by the api
+    if payload:
+        values = payload[0]['resultados'][0]['series'][0]['serie']
+        new_values = pd.DataFrame(values.items(), columns=[date_column_name, value_column_name])
+        new_values[date_column_name] = pd.to_datetime(new_values[date_column_name], format='%Y%m')
+        new_values[value_column_name] = pd.to_numeric(new_values[value_column_name], errors='coerce')
+        new_values.set_index(date_column_name, inplace=True)
+    else:
+        # if the payload is empty, there is no new data to add
+        new_values = pd.DataFrame(data=[])
+
+    return(new_values)
+
+@instrument.timed('ibge.call_ibge_api')
 def call_ibge_api(series_id, date_list, date_column_name='TradeDate', value_column_name='Value'):
-    api_url = f'https://servicodados.ibge.gov.br/api/v3/agregados/1737/periodos/{date_list}/variaveis/{series_id}?localidades=N1[all]'
+    api_url, key, closed = ibge_request(series_id, date_list)
         
     try:
-        req = pd.read_json(api_url)
+        status, headers, body = http_cache.fetch(api_url, key, closed)
+        payload = decode_ibge_response(api_url, status, body)
+    except http_cache.CacheMiss:
+        raise
     except Exception as ex:
         raise Exception(ex)
     
-    if not req.empty:
-        # if req is empty, there is no new data to add
-        values = req['resultados'][0][0]['series'][0]['serie']
-        new_values = pd.DataFrame(values.items(), columns=[date_column_name, value_column_name])
-        new_values[date_column_name] = pd.to_datetime(new_values[date_column_name], format='%Y%m')
-        new_values.set_index(date_column_name, inplace=True)
-    else:
-        new_values = pd.DataFrame(data=[])
+    return(parse_ibge_data(payload, date_column_name, value_column_name))
+
+@instrument.timed('ibge.call_ibge_api_async')
+async def call_ibge_api_async(client, series_id, date_list, date_column_name='TradeDate', value_column_name='Value'):
+    # Asynchronous version of call_ibge_api. client is a http_client.AsyncClient
+    api_url, key, closed = ibge_request(series_id, date_list)
+
+    try:
+        status, headers, body = await http_cache.fetch_async(client, api_url, key, closed)
+        payload = decode_ibge_response(api_url, status, body)
+    except http_cache.CacheMiss:
+        raise
+    except Exception as ex:
+        raise Exception(ex)
+
+    return(parse_ibge_data(payload, date_column_name, value_column_name))
+
+def ipca_date_list(start_date, end_date):
+    # Returns the list of months between start_date and end_date in the format used by the api
+    date_list = pd.period_range(start = start_date, end = end_date, freq='M').strftime("%Y%m").to_list()
+    return('|'.join(date_list))
+
+def join_ipca_values(new_values, new_values2):
+    # Joins the IPCA index numbers and the IPCA monthly rates. The rates are published as percentage, we store them divided by 100
+    if new_values.empty or new_values2.empty:
+        return(pd.DataFrame(data=[]))
+
+    new_values2['IPCA'] = new_values2['IPCA'] / 100
+    new_values = pd.concat([new_values, new_values2], axis=1).dropna()
 
     return(new_values)
 
 def get_ipca_from_ibge(start_date, end_date):
     # Gets the values of the IPCA, for the period start_date to end_date, from the IBGE api
 
-    date_list = pd.period_range(start = start_date, end = end_date, freq='M').strftime("%Y%m").to_list()
-    date_list = '|'.join(date_list)
+    date_list = ipca_date_list(start_date, end_date)
 
     try:
         # First gets the IPCA index numbers - series_id = '2266'
         new_values = call_ibge_api('2266', date_list, 'TradeDate', 'Num_IPCA')
         #Then gets the IPCA monthly rates - series_id = '63'
         new_values2 = call_ibge_api('63', date_list, 'TradeDate', 'IPCA')
-        if new_values2['IPCA'].dtype != float and new_values2['IPCA'].dtype != int:
-            new_values2['IPCA'] = float(new_values2['IPCA'])
-        new_values2['IPCA'] = new_values2['IPCA'] / 100
-        new_values = pd.concat([new_values, new_values2], axis=1)
+        new_values = join_ipca_values(new_values, new_values2)
+    except http_cache.CacheMiss:
+        raise
     except Exception as ex:
         raise Exception(ex)
     
     
-    return(new_values)
\ No newline at end of file
+    return(new_values)
+
+async def get_ipca_from_ibge_async(client, start_date, end_date):
+    # Asynchronous version of get_ipca_from_ibge. The index numbers and the monthly rates are fetched concurrently
+
+    date_list = ipca_date_list(start_date, end_date)
+
+    try:
+        new_values, new_values2 = await asyncio.gather(call_ibge_api_async(client, '2266', date_list, 'TradeDate', 'Num_IPCA'),
+                                                       call_ibge_api_async(client, '63', date_list, 'TradeDate', 'IPCA'))
+        new_values = join_ipca_values(new_values, new_values2)
+    except http_cache.CacheMiss:
+        raise
+    except Exception as ex:
+        raise Exception(ex)
+
+    return(new_values)
@@ -0,0 +1,207 @@
+# This module measures where the time of a run goes: timers and counters around the fetch, load, update, accumulation and
+# business day functions, and an optional sampling profiler
+# Instrumentation is turned on by the environment variable CURRY_INSTRUMENT=1, read when this module is imported. When it is off,
+# timed() returns the function itself and timer() / count() do nothing, so the instrumented functions run at their normal speed
+# The sampling profiler is turned on by CURRY_PROFILE=<file>: the call sites sampled during the run are written to file at exit
+#
+# Usage:
+#   @instrument.timed('cdi.load_cdi')          decorator
+#   with instrument.timer('parse'):            context manager
+#   instrument.count('bcb.windows', 3)         counter
+#   instrument.log_metrics()                   one json log line per metric
+#   instrument.write_prometheus('metrics.prom')
+
+import os
+import sys
+import json
+import time
+import atexit
+import inspect
+import logging
+import functools
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+enabled = os.environ.get('CURRY_INSTRUMENT', '') not in ('', '0')
+profile_path = os.environ.get('CURRY_PROFILE', '')
+
+logger = logging.getLogger('curry.instrument')
+
+# Timers: name -> [number of calls, total seconds, min seconds, max seconds]. Counters: name -> value
+timers = {}
+counters = {}
+metrics_lock = threading.Lock()
+
+
+def record(name, seconds):
+    with metrics_lock:
+        stats = timers.get(name)
+        if stats is None:
+            timers[name] = [1, seconds, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = min(stats[2], seconds)
+            stats[3] = max(stats[3], seconds)
+
+if enabled:
+    def timed(name=None):
+        # Decorator that times every call of the function
+        def decorate(function):
+            timer_name = name or f'{function.__module__}.{function.__qualname__}'
+
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return(await function(*args, **kwargs))
+                    finally:
+                        record(timer_name, time.perf_counter() - start)
+                return(async_wrapper)
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return(function(*args, **kwargs))
+                finally:
+                    record(timer_name, time.perf_counter() - start)
+            return(wrapper)
+        return(decorate)
+
+    @contextmanager
+    def timer(name):
+        # Context manager that times the code inside it
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record(name, time.perf_counter() - start)
+
+    def count(name, value=1):
+        # Adds value to the counter name
+        with metrics_lock:
+            counters[name] = counters.get(name, 0) + value
+else:
+    def timed(name=None):
+        def decorate(function):
+            return(function)
+        return(decorate)
+
+    no_timer = nullcontext()
+
+    def timer(name):
+        return(no_timer)
+
+    def count(name, value=1):
+        pass
+
+
+def metrics():
+    # Returns a copy of the timers and counters
+    with metrics_lock:
+        return({'timers': {name: {'calls': stats[0], 'total': stats[1], 'min': stats[2], 'max': stats[3]} for name, stats in timers.items()},
+                'counters': dict(counters)})
+
+def reset():
+    with metrics_lock:
+        timers.clear()
+        counters.clear()
+
+def log_metrics(level=logging.INFO):
+    # Writes one structured (json) log line for each timer and counter
+    current = metrics()
+    for name, stats in current['timers'].items():
+        logger.log(level, json.dumps({'metric': 'timer', 'name': name, **stats}))
+    for name, value in current['counters'].items():
+        logger.log(level, json.dumps({'metric': 'counter', 'name': name, 'value': value}))
+
+def prometheus_text():
+    # Returns the timers and counters in the Prometheus text exposition format
+    current = metrics()
+    lines = ['# HELP curry_call_seconds Time spent in the instrumented functions',
+             '# TYPE curry_call_seconds summary']
+    for name, stats in sorted(current['timers'].items()):
+        lines.append(f'curry_call_seconds_sum{{name="{name}"}} {stats["total"]!r}')
+        lines.append(f'curry_call_seconds_count{{name="{name}"}} {stats["calls"]}')
+    lines += ['# HELP curry_events_total Counters of the instrumented functions',
+              '# TYPE curry_events_total counter']
+    for name, value in sorted(current['counters'].items()):
+        lines.append(f'curry_events_total{{name="{name}"}} {value}')
+
+    return('\n'.join(lines) + '\n')
+
+def write_prometheus(path):
+    # Writes the metrics to a Prometheus text file (e.g. for the node exporter textfile collector). The file is replaced atomically
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as prom_file:
+        prom_file.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+
+class SamplingProfiler:
+    # Samples the stack of the profiled thread every interval seconds, from a background thread, and counts the call sites
+    # (file, line and function) seen on the stack. A call site that shows up in many samples is where the time goes
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.main_thread().ident
+        self.samples = 0
+        self.own_sites = Counter()
+        self.stack_sites = Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='curry-profiler', daemon=True)
+        self.thread.start()
+        return(self)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        return(self)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            # Own samples are counted by line, cumulative samples by function (counted once per sample, even in recursion)
+            self.own_sites[f'{frame.f_code.co_filename}:{frame.f_lineno}:{frame.f_code.co_name}'] += 1
+            seen = set()
+            while frame is not None:
+                site = f'{frame.f_code.co_filename}:{frame.f_code.co_firstlineno}:{frame.f_code.co_name}'
+                if site not in seen:
+                    seen.add(site)
+                    self.stack_sites[site] += 1
+                frame = frame.f_back
+
+    def stats(self, top=50):
+        # Returns the call sites with the most samples: own (the function was running) and cumulative (the function was on the stack)
+        return({'samples': self.samples, 'interval': self.interval,
+                'own': [{'site': site, 'samples': n, 'share': n / max(self.samples, 1)} for site, n in self.own_sites.most_common(top)],
+                'cumulative': [{'site': site, 'samples': n, 'share': n / max(self.samples, 1)} for site, n in self.stack_sites.most_common(top)]})
+
+    def dump(self, path, top=50):
+        with open(path, 'w') as profile_file:
+            json.dump(self.stats(top), profile_file, indent=2)
+
+
+def profile_run(path, interval=0.005):
+    # Starts the sampling profiler of the main thread and writes its statistics to path when the process exits
+    profiler = SamplingProfiler(interval).start()
+
+    def dump():
+        profiler.stop()
+        profiler.dump(path)
+    atexit.register(dump)
+
+    return(profiler)
+
+if profile_path:
+    profile_run(profile_path)
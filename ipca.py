@@ -1,66 +1,198 @@
 # This module contains the set of functions that work with the IPCA inflation index.
 # IPCA is the most used inflation index in Brazil. It is calculated and published by IBGE. It is published between the 8th and 11th of the following month.
 # IPCA is published both as a monthly percentage rate and a index number. We update our database getting the monthly percentage rate from the BCB's API.
+# Until the IPCA of a month is published, its projected rate (e.g. ANBIMA's projection) can be stored in the database, flagged as projected.
 
 import os
+import numpy as np
 import pandas as pd
+import storage
+import registry
+import instrument
 import ibge
 import ir_calc as ir
 import br_workdays as wd
 
 
-def load_ipca(db_path='D:\Investiments\Databases\Indexes\IPCA.csv'):
+# Provenance of each row of the IPCA database (Source column)
+#   official    - rate published by IBGE
+#   projected   - projected rate (e.g. ANBIMA's projection), used until the official rate is published
+#   placeholder - month following the last rate available. Only its Accum is used, its rate is not known yet
+# The Accum of a row depends only on the rates of the previous rows, so the Accum of the first projected month is still official
+official = 0.0
+projected = 1.0
+placeholder = 2.0
+
+# Precedence of the sources of projections. A stored projection is replaced by a new projection of the same or higher precedence
+projection_sources = {'anbima': 1, 'manual': 2}
+
+ipca_dtypes = {'Num_IPCA':float, 'IPCA':float, 'Accum':float, 'Source':float}
+
+
+@instrument.timed('ipca.load_ipca')
+def load_ipca(db_path=None, mmap=True, version=None):
     # Reads the IPCA database to dataframe
+    if db_path is None:
+        db_path = registry.series_path('IPCA')
     try:
-        ipca = pd.read_csv(db_path, delimiter=';', dtype={'Num_IPCA':float, 'IPCA':float, 'Accum':float}, index_col='TradeDate')
-        ipca.index = pd.to_datetime(ipca.index,format='%Y-%m-%d')
+        ipca = storage.read_series(db_path, ipca_dtypes, mmap, version)
         ipca.sort_index()
     except OSError as err:
         raise OSError(err)
     except Exception as err:
         raise Exception(err)
 
+    # Databases created before the projections have only official rates and the placeholder month
+    if 'Source' not in ipca.columns:
+        ipca['Source'] = np.where(np.arange(len(ipca)) < len(ipca) - 1, official, placeholder)
+
     return(ipca)
 
-def update_ipca_db(db_path='D:\Investiments\Databases\Indexes\IPCA.csv'):
+def load_ipca_projections(db_path=None):
+    # Reads the stored projections of the IPCA to dataframe (monthly projected rate and the precedence of its source)
+    if db_path is None:
+        db_path = registry.series_path('IPCA_proj')
+    if not os.path.exists(db_path):
+        return(pd.DataFrame({'IPCA': pd.Series(dtype=float), 'Priority': pd.Series(dtype=float)},
+                            index=pd.DatetimeIndex([], name=storage.index_name)))
+    try:
+        projections = storage.read_series(db_path, {'IPCA':float, 'Priority':float}, mmap=False)
+    except Exception as err:
+        raise Exception(err)
+
+    return(projections)
+
+def save_ipca_projections(new_projections, source='anbima', db_path=None):
+    # Stores projected monthly rates of the IPCA. new_projections is a Series of rates (already divided by 100) indexed by month
+    # A projection replaces the stored projection of the same month only if its source has the same or higher precedence
+    if db_path is None:
+        db_path = registry.series_path('IPCA_proj')
+    if source not in projection_sources:
+        raise Exception(f'Source of projections must be one of: {", ".join(projection_sources)}')
+
+    months = pd.DatetimeIndex(new_projections.index).to_period('M').to_timestamp()
+    new_rows = pd.DataFrame({'IPCA': np.asarray(new_projections, dtype=float), 'Priority': float(projection_sources[source])}, index=months)
+
+    with storage.locked(db_path):
+        projections = load_ipca_projections(db_path)
+        stored = projections.reindex(new_rows.index)
+        new_rows = new_rows.loc[~(stored.Priority > new_rows.Priority)]
+
+        projections = pd.concat([projections.drop(new_rows.index, errors='ignore'), new_rows]).sort_index()
+        projections.index.name = storage.index_name
+        storage.commit_series(projections, db_path, 0)
+    registry.invalidate_series('IPCA_proj')
+
+def first_unofficial_row(ipca):
+    # Returns the position of the first row of ipca whose rate is not official (the first projected month or the placeholder month)
+    # or len(ipca) if every rate is official
+    unofficial = np.flatnonzero(ipca.Source.values != official)
+    return(int(unofficial[0]) if len(unofficial) else len(ipca))
+
+def last_official_date(ipca):
+    # Returns the last date whose Accum uses only official rates
+    return(ipca.index[min(first_unofficial_row(ipca), len(ipca) - 1)])
+
+def build_ipca_tail(ipca, from_row, new_ipca, projections):
+    # Builds the rows of the IPCA database from position from_row onwards: the official rates in new_ipca, then the projected rates
+    # of the following months (while there are projections for consecutive months) and the placeholder month
+    new_rows = new_ipca[['Num_IPCA','IPCA']].astype(float)
+    new_rows['Source'] = official
+
+    if not new_rows.empty:
+        next_month = new_rows.last_valid_index() + pd.DateOffset(months=1)
+    elif from_row < len(ipca):
+        next_month = ipca.index[from_row]
+    else:
+        # Database with only official rates and no placeholder month
+        next_month = ipca.index[-1] + pd.DateOffset(months=1)
+    proj_rows = {}
+    while next_month in projections.index:
+        proj_rows[next_month] = projections.loc[next_month, 'IPCA']
+        next_month = next_month + pd.DateOffset(months=1)
+
+    proj_rows = pd.DataFrame({'Num_IPCA': 0.0, 'IPCA': list(proj_rows.values()), 'Source': projected}, index=list(proj_rows.keys()))
+    next_row = pd.DataFrame(data={'Num_IPCA':[0.0],'IPCA':[0.0],'Source':[placeholder]},index=[next_month])
+    new_rows = pd.concat([frame for frame in [new_rows, proj_rows, next_row] if not frame.empty])
+
+    # Continues the cumulative return from the last stored Accum
+    if from_row == 0:
+        new_rows['Accum'] = np.concatenate(([1.0], ir.continue_accum(1.0, 1 + new_rows.IPCA.values[:-1])))
+    else:
+        prev_rates = np.concatenate(([ipca.IPCA.iloc[from_row - 1]], new_rows.IPCA.values[:-1]))
+        new_rows['Accum'] = ir.continue_accum(ipca.Accum.iloc[from_row - 1], 1 + prev_rates)
+
+    return(new_rows[list(ipca_dtypes)])
+
+def write_ipca_tail(ipca, from_row, new_rows, db_path, ref_date=None):
+    # Replaces the rows of the database from position from_row onwards with new_rows, as a new version of the database
+    # Databases created before the Source column are rewritten once with the new column
+    if 'Source' in storage.stored_columns(db_path):
+        storage.commit_series(new_rows, db_path, from_row, ref_date)
+    else:
+        storage.commit_series(pd.concat([ipca.iloc[:from_row], new_rows]), db_path, 0, ref_date)
+    registry.invalidate_series('IPCA')
+
+@instrument.timed('ipca.update_ipca_db')
+def update_ipca_db(db_path=None, verify=False, novos_ipca=None, proj_path=None):
     # Updates the IPCA database with all the rates published after the last update
+    # novos_ipca can bring the rates already fetched from the IBGE api (see updater.update_all_indexes), otherwise they are fetched here
+    # Projected months that got their official rate are replaced, and stored projections are used for the months after them
+    if db_path is None:
+        db_path = registry.series_path('IPCA')
 
-    try:
-        ipca = load_ipca(db_path)
-    except Exception as exp:
-        raise Exception(exp)
+    with storage.locked(db_path):
+        try:
+            ipca = load_ipca(db_path, mmap=False)
+        except Exception as exp:
+            raise Exception(exp)
 
-    # Get the IPCA values published since the last update
-    try:
-        novos_ipca = ibge.get_ipca_from_ibge(ipca.last_valid_index(),pd.to_datetime("today"))
-    except Exception as exp:
-        raise Exception(exp)
+        # Get the IPCA values published since the last update
+        if novos_ipca is None:
+            try:
+                novos_ipca = ibge.get_ipca_from_ibge(last_official_date(ipca),pd.to_datetime("today"))
+            except Exception as exp:
+                raise Exception(exp)
     
-    if novos_ipca.first_valid_index() == ipca.last_valid_index():
-        ipca.drop(ipca.last_valid_index(), inplace=True)
+        if novos_ipca.empty:
+            return
 
-    # Appends new rates to the dataframe
-    ipca = pd.concat([ipca, novos_ipca])
+        # Rows from from_row onwards (projected and placeholder months of the last update) are replaced by the new rows
+        from_row = ipca.index.searchsorted(novos_ipca.first_valid_index())
+        new_rows = build_ipca_tail(ipca, from_row, novos_ipca, load_ipca_projections(proj_path))
+        new_date = novos_ipca.last_valid_index() + pd.DateOffset(months=1)
 
-    # Includes the month following the date of the last IPCA rate available, to calculate the last available Accum
-    new_date = ipca.last_valid_index() + pd.DateOffset(months=1)
-    new_row = pd.DataFrame(data={'Num_IPCA':[0.0],'IPCA':[0.0],'Accum':[1.00]},index=[new_date])
-    ipca = pd.concat([ipca, new_row])
+        if verify:
+            verify_ipca_accum(pd.concat([ipca.iloc[:from_row], new_rows]))
 
-    ipca.sort_index()
-    
-    # Calculates the cumulative return
+        # Saves the new rows to the database
+        write_ipca_tail(ipca, from_row, new_rows, db_path, new_date)
+
+def apply_ipca_projections(db_path=None, proj_path=None):
+    # Rebuilds the projected months of the IPCA database from the stored projections. Only the rows after the last official rate are written
+    if db_path is None:
+        db_path = registry.series_path('IPCA')
+
+    with storage.locked(db_path):
+        ipca = load_ipca(db_path, mmap=False)
+        from_row = first_unofficial_row(ipca)
+        new_rows = build_ipca_tail(ipca, from_row, ipca.iloc[:0], load_ipca_projections(proj_path))
+
+        write_ipca_tail(ipca, from_row, new_rows, db_path)
+
+def calc_ipca_accum(ipca):
+    # Calculates the cumulative return of the IPCA for the whole period
     ipca['Accum'] = (1 + ipca.IPCA.shift(1)).cumprod()
-    ipca.loc[ipca.first_valid_index()].Accum = 1.00
-    ipca['Accum'].round(decimals=8)
+    ipca.loc[ipca.first_valid_index(), 'Accum'] = 1.00
 
-    # Saves the last version of the IPCA database in a different file
-    new_path = db_path[:len(db_path)-4] + ipca.last_valid_index().strftime('%Y%m%d') + '.csv'
-    if not os.path.exists(new_path):
-        os.rename(db_path,new_path)
+    return(ipca)
 
-    # Saves the updated series to the csv file
-    ipca.to_csv(db_path, sep=';',header=['Num_IPCA','IPCA','Accum'], index_label='TradeDate')
+def verify_ipca_accum(ipca):
+    # Checks that the Accum column of ipca is bit for bit equal to a full recompute with calc_ipca_accum
+    full = calc_ipca_accum(ipca[['IPCA']].copy())
+    if not np.array_equal(full.Accum.values, ipca.Accum.values):
+        mismatch = np.flatnonzero(full.Accum.values != ipca.Accum.values)
+        raise Exception(f'Accum differs from a full recompute at {len(mismatch)} rows, first at {ipca.index[mismatch[0]]}')
 
 def calc_first_accrual(start_date, end_date, reset_day, accrual_type):
     # Calculates the parameters to be used in the accrual of the first rate -> may be necessary to calculate a pro-rata accrual        
@@ -112,12 +244,14 @@ def calc_last_accrual(start_date, end_date, reset_day, accrual_type):
 
     return {'month_m0': month_m0, 'month_m1': month_m1, 'last_date': last_date, 'tot_days': tot_days, 'num_days': num_days}
 
-def ipca_accum (ipca, start_date, end_date, reset_day=0, accrual_type='cd'):
+def ipca_accum (ipca, start_date, end_date, reset_day=0, accrual_type='cd', use_projections=True):
     # Returns the cumulative return of the IPCA rate between start_date (inclusive) and end_date (exclusive)
     # Source for the formula: https://www.b3.com.br/data/files/F6/26/EA/D2/F051F610AF4EF0F6AC094EA8/Caderno%20de%20Formulas%20-%20Debentures%20Cetip%2021.pdf
+    # Months without official rate use the projected rates stored in the database. With use_projections=False only official rates are used
     
+    last_date = ipca.last_valid_index() if use_projections else last_official_date(ipca)
 
-    if (start_date < ipca.first_valid_index()) or (start_date > ipca.last_valid_index()) or (end_date < ipca.first_valid_index()) or (end_date > ipca.last_valid_index()):
+    if (start_date < ipca.first_valid_index()) or (start_date > last_date) or (end_date < ipca.first_valid_index()) or (end_date > last_date):
         raise Exception('Dates out of available range of IPCA dates')
     
     if start_date > end_date:
@@ -145,3 +279,91 @@ def ipca_accum (ipca, start_date, end_date, reset_day=0, accrual_type='cd'):
     return(ipca_accum)
 
 
+
+def month_lengths(months):
+    # Returns the number of calendar days of each month in months (datetime64[M] array)
+    return((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+
+def calc_accruals_batch(start_days, end_days, reset_days, bd_mask):
+    # Array version of calc_first_accrual and calc_last_accrual. Dates are datetime64[D] arrays, months are datetime64[M] arrays
+    # Returns the months m0 and m1 of the first and of the last accrual and their pro-rata fractions (num_days / tot_days)
+    start_months = start_days.astype('datetime64[M]')
+    end_months = end_days.astype('datetime64[M]')
+    start_mday = (start_days - start_months.astype('datetime64[D]')).astype(np.int64) + 1
+    end_mday = (end_days - end_months.astype('datetime64[D]')).astype(np.int64) + 1
+
+    # First accrual: from start_date to the reset day of month m1 (or to end_date if it comes first)
+    first_m0 = np.where(start_mday < reset_days, start_months - 1, start_months)
+    first_m1 = first_m0 + 1
+    # Last accrual: from the reset day of month m0 (or from start_date if it comes after) to end_date
+    last_m0 = np.where(end_mday <= reset_days, end_months - 1, end_months)
+    last_m1 = last_m0 + 1
+
+    if (reset_days > month_lengths(first_m1)).any() or (reset_days > month_lengths(last_m0)).any():
+        raise Exception('Reset day is not a valid day in the month of the accrual')
+
+    first_dates = np.minimum(first_m1.astype('datetime64[D]') + (reset_days - 1), end_days)
+    last_dates = np.maximum(last_m0.astype('datetime64[D]') + (reset_days - 1), start_days)
+
+    # Calendar days
+    first_tot = month_lengths(first_m0)
+    first_num = (first_dates - start_days).astype(np.int64)
+    last_tot = month_lengths(last_m0)
+    last_num = (end_days - last_dates).astype(np.int64)
+
+    # Business days
+    if bd_mask.any():
+        first_tot[bd_mask] = wd.num_br_bdays_array(first_m0[bd_mask], first_m1[bd_mask])
+        first_num[bd_mask] = wd.num_br_bdays_array(start_days[bd_mask], first_dates[bd_mask])
+        last_tot[bd_mask] = wd.num_br_bdays_array(last_m0[bd_mask], last_m1[bd_mask])
+        last_num[bd_mask] = wd.num_br_bdays_array(last_dates[bd_mask], end_days[bd_mask])
+
+    return {'first_m0': first_m0, 'first_m1': first_m1, 'first_frac': first_num / first_tot,
+            'last_m0': last_m0, 'last_m1': last_m1, 'last_frac': last_num / last_tot}
+
+def ipca_accum_batch (ipca, start_dates, end_dates, reset_days=0, accrual_types='cd', use_projections=True):
+    # Returns an array with the cumulative return of the IPCA rate between each start_date (inclusive) and end_date (exclusive)
+    # start_dates and end_dates are arrays of dates (DatetimeIndex, Series or datetime64 arrays). reset_days and accrual_types
+    # are a value for all the intervals or an array with one value for each interval
+    # Follows the same rules of ipca_accum: reset_day 0 is the day of end_date, accrual type is cd (calendar days) or bd (business days)
+    # and months without official rate use the projected rates, unless use_projections=False
+
+    start_days = wd.to_days(start_dates)
+    end_days = wd.to_days(end_dates)
+    start_days, end_days = np.broadcast_arrays(start_days, end_days)
+    if start_days.size == 0:
+        return(np.empty(start_days.shape))
+
+    first_day = np.datetime64(ipca.first_valid_index(), 'D')
+    last_day = np.datetime64(ipca.last_valid_index() if use_projections else last_official_date(ipca), 'D')
+    if (start_days.min() < first_day) or (start_days.max() > last_day) or (end_days.min() < first_day) or (end_days.max() > last_day):
+        raise Exception('Dates out of available range of IPCA dates')
+
+    if (start_days > end_days).any():
+        raise Exception('Start Date must be older than End Date')
+
+    accrual_types = np.broadcast_to(np.asarray(accrual_types), start_days.shape)
+    if not np.isin(accrual_types, ['cd', 'bd']).all():
+        raise Exception('Accrual type must be cd (calendar days), or bd (business days)')
+
+    reset_days = np.broadcast_to(np.asarray(reset_days, dtype=np.int64), start_days.shape)
+    end_mday = (end_days - end_days.astype('datetime64[M]').astype('datetime64[D]')).astype(np.int64) + 1
+    reset_days = np.where(reset_days == 0, end_mday, reset_days)
+
+    accruals = calc_accruals_batch(start_days, end_days, reset_days, accrual_types == 'bd')
+
+    try:
+        accum = ipca.Accum.values
+        first_m0 = accum[ir.find_positions(ipca, accruals['first_m0'])]
+        first_m1 = accum[ir.find_positions(ipca, accruals['first_m1'])]
+        last_m0 = accum[ir.find_positions(ipca, accruals['last_m0'])]
+        last_m1 = accum[ir.find_positions(ipca, accruals['last_m1'])]
+    except KeyError as err:
+        raise KeyError(err)
+
+    # First accrual may be pro-rata, intermediate accruals are never pro-rata, last accrual can be pro-rata
+    ipca_accum = (first_m1 / first_m0) ** accruals['first_frac']
+    ipca_accum = ipca_accum * (last_m0 / first_m1)
+    ipca_accum = ipca_accum * (last_m1 / last_m0) ** accruals['last_frac']
+
+    return(ipca_accum)
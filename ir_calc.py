@@ -1,17 +1,468 @@
+# This module calculates the cumulative returns of the rates (accumulation functions used by the index modules) and the taxes
+# (IR and IOF) due on the redemptions of fixed income investments
+
+import weakref
+import threading
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
+import instrument
+
+# Cache of the full history cumulative products (or cumulative log factors) of a rate series for each percentage, keyed by
+# (series, stored version, fingerprint of the rates, method, percentage). See series_cache_key
+# Entries are evicted in least recently used order when the cache grows over accum_cache_budget bytes
+accum_cache_budget = 64 * 1024 * 1024
+accum_cache = OrderedDict()
+accum_cache_lock = threading.Lock()
+accum_cache_size = 0
+# Odd weights of the fingerprint of the rates (see rates_fingerprint), grown when a longer series is seen
+fingerprint_weights = np.arange(1, 2 * 16384, 2, dtype=np.uint64)
+
+# Methods of accumulation of the daily rates
+#   cumprod - float64 cumulative product of the daily factors (the Accum column of the databases)
+#   log     - cumulative sum of the logs of the daily factors. Ratios between two dates are exp of a difference, with an error that
+#             does not grow with the length of the history
+#   b3      - exact B3 rules (Caderno de Formulas, DI): daily rate rounded to 8 decimals, daily factor (1 + rate * percentage) with
+#             16 decimals and the product truncated to 16 decimals after each day. Calculated with scaled integers (see accum_b3_batch)
+accum_methods = ('cumprod', 'log', 'b3')
 
-def calc_accum_r252(rate252, percentage=1):
+@instrument.timed('ir_calc.calc_accum_r252')
+def calc_accum_r252(rate252, percentage=1, method='cumprod'):
     # Calculates the cumulative return for the Rate in df_rate252 using a given percentage of the rate
     # Rate is an exponential annual rate base 252 (workdays)
     # df_rate252 must have dates in the index and a column named Rate. The index must be sorted in ascending order.
+    # method is one of accum_methods
 
     # For each day d: Cum_Return_d = ( 1 + (Rate_d-1 * Percentage) ^ (1/252)) * Cum_Return_d-1
 
+    if method == 'log':
+        rate252['Accum'] = np.exp(calc_log_accum_r252(rate252, percentage))
+        return(rate252)
+    if method == 'b3':
+        positions = np.arange(len(rate252))
+        rate252['Accum'] = accum_b3_batch(rate252.Rate.values, np.zeros(len(rate252), dtype=np.int64), positions, percentage)
+        return(rate252)
+    if method != 'cumprod':
+        raise Exception(f'Accumulation method must be one of: {", ".join(accum_methods)}')
+
     with pd.option_context('mode.chained_assignment', None):
         rate252['Accum'] = (((((1 + rate252.Rate.shift(1)) ** (1/252) - 1) * percentage)) + 1).cumprod()
 
     # The Cum_Perc of the first day gets NaN, it is necessary to make it = 1.0000
 
-    rate252.loc[rate252.first_valid_index()].Accum = 1.0000
+    rate252.loc[rate252.first_valid_index(), 'Accum'] = 1.0000
+
+    return(rate252)
+
+def calc_factors_r252(rates, percentage=1):
+    # Returns the daily factors of the rates (exponential annual rates base 252), using a given percentage of the rate
+    # The factor of day d is applied to go from the Accum of day d to the Accum of the following day
+    return(((1 + rates) ** (1/252) - 1) * percentage + 1)
+
+def continue_accum(last_accum, factors):
+    # Continues a cumulative product from last_accum, multiplying one factor at a time in the same order of a full cumprod
+    # so the result is bit for bit equal to the one of calc_accum_r252 over the whole series
+    return(np.cumprod(np.concatenate(([last_accum], factors)))[1:])
+
+def append_accum_r252(rate252, new_rates, next_date):
+    # Calculates the rows to be stored after the new_rates are published, without recomputing the Accum of the whole series
+    # rate252 is the stored series (Rate and Accum columns). Its last row is a placeholder (Rate 0) for the day after the last published rate.
+    # new_rates is a dataframe with the new Rate values and next_date is the business day after the last of them.
+    # Returns (from_row, tail): the rows of rate252 from position from_row onwards (the placeholder, or any date that was
+    # published again) must be replaced by tail, which has the new rates, a new placeholder at next_date and their Accum.
+
+    from_row = rate252.index.searchsorted(new_rates.first_valid_index())
+
+    tail = pd.concat([new_rates[['Rate']], pd.DataFrame(data={'Rate':[0.0]}, index=[next_date])])
+
+    if from_row == 0:
+        tail['Accum'] = np.concatenate(([1.0], continue_accum(1.0, calc_factors_r252(tail.Rate.values[:-1], 1))))
+    else:
+        prev_rates = np.concatenate(([rate252.Rate.iloc[from_row - 1]], tail.Rate.values[:-1]))
+        tail['Accum'] = continue_accum(rate252.Accum.iloc[from_row - 1], calc_factors_r252(prev_rates, 1))
+
+    return(from_row, tail)
+
+def verify_accum_r252(rate252):
+    # Checks that the Accum column of rate252 is bit for bit equal to a full recompute with calc_accum_r252
+    full = calc_accum_r252(rate252[['Rate']].copy())
+    if not np.array_equal(full.Accum.values, rate252.Accum.values):
+        mismatch = np.flatnonzero(full.Accum.values != rate252.Accum.values)
+        raise Exception(f'Accum differs from a full recompute at {len(mismatch)} rows, first at {rate252.index[mismatch[0]]}')
+
+def calc_log_accum_r252(rate252, percentage=1):
+    # Returns an array with the cumulative log of the daily factors for the Rate in rate252, using a given percentage of the rate
+    # Position i holds log(Accum_i / Accum_0), so the cumulative return between positions s and e is exp(log_accum[e] - log_accum[s])
+
+    # The daily rates are calculated with log1p and expm1, and their logs with log1p, so they keep their precision: (1 + r) ** (1/252) - 1
+    # would lose it when 1 is added to the annual rate and subtracted from the daily factor
+    rates = rate252.Rate.values
+    daily_rates = np.expm1(np.log1p(rates[:-1]) / 252) * percentage
+
+    return(np.concatenate(([0.0], np.cumsum(np.log1p(daily_rates)))))
+
+# Exact B3 accumulation. Values are integers in units of 1e-8 (daily rates and percentages) or 1e-16 (factors and products)
+# A product is kept in three limbs of base 1e8 (integer part, 8 first decimals, 8 last decimals), so the product of a limb of the
+# accumulated product by a limb of the daily factor never overflows int64 (for products below b3_max_accum)
+
+b3_limb = 10**8
+b3_max_accum = 9 * 10**10
+
+def b3_daily_rates(rates):
+    # Daily rates (TDI) of the annual rates base 252, rounded to 8 decimals, in units of 1e-8
+    return(np.round(((1 + rates) ** (1/252) - 1) * 1e8).astype(np.int64))
+
+def b3_multiply(a2, a1, a0, factors):
+    # Multiplies the products (a2 + a1 * 1e-8 + a0 * 1e-16) by the factors (units of 1e-16) and truncates them to 16 decimals
+    f2, rest = np.divmod(factors, b3_limb * b3_limb)
+    f1, f0 = np.divmod(rest, b3_limb)
+
+    c0 = a0 * f0
+    c1 = a0 * f1 + a1 * f0 + c0 // b3_limb
+    c2 = a0 * f2 + a1 * f1 + a2 * f0 + c1 // b3_limb
+    c3 = a1 * f2 + a2 * f1 + c2 // b3_limb
+    c4 = a2 * f2 + c3 // b3_limb
+
+    return(c4, c3 % b3_limb, c2 % b3_limb)
+
+def accum_b3_path(rates, percentage=1, start_units=b3_limb * b3_limb):
+    # Continues the B3 product start_units (units of 1e-16, e.g. the product returned by a previous call) with the daily rates of the
+    # annual rates base 252, one day at a time. Returns the list of the products after each day, as exact integers in units of 1e-16
+    # Used to accumulate a series in pieces (e.g. the chunks of export.rate_accum_chunks) with the same results of accum_b3_batch
+    one = b3_limb * b3_limb
+    percent_units = int(round(percentage * 1e8))
+
+    products = []
+    product = int(start_units)
+    for daily_rate in b3_daily_rates(np.asarray(rates, dtype=float)).tolist():
+        product = product * (one + daily_rate * percent_units) // one
+        products.append(product)
+    return(products)
+
+def b3_units_to_float(products):
+    # Converts products in units of 1e-16 to floats, as accum_b3_batch does (integer part plus the 16 decimals)
+    one = b3_limb * b3_limb
+    return(np.array([integer + decimals / 1e16 for integer, decimals in (divmod(product, one) for product in products)], dtype=float))
+
+def accum_b3_batch(rates, st_pos, end_pos, percentages=1, units=False):
+    # Returns the cumulative return between each st_pos (inclusive) and end_pos (exclusive) row of the annual rates base 252, using the
+    # given percentage of the rate, following the B3 truncation rules. Each end_pos must not be before its st_pos
+    # Intervals with the same start and percentage share one product, calculated a day at a time for all of them at once
+    # units=True returns the products as integers in units of 1e-16 (exact, for reconciliations), otherwise as floats
+    st_pos, end_pos, percentages = np.broadcast_arrays(np.asarray(st_pos, dtype=np.int64), np.asarray(end_pos, dtype=np.int64),
+                                                       np.asarray(percentages, dtype=float))
+    if (end_pos < st_pos).any():
+        raise Exception('Start Date must be older than End Date')
+
+    daily_rates = b3_daily_rates(np.asarray(rates, dtype=float))
+    percent_units = np.round(percentages * 1e8).astype(np.int64)
+
+    # Products shared by the intervals with the same start and percentage, sorted by start
+    keys, pair_of = np.unique(np.stack([st_pos.reshape(-1), percent_units.reshape(-1)]), axis=1, return_inverse=True)
+    pair_of = pair_of.reshape(-1)
+    pair_st, pair_percents = keys
+    ends = end_pos.reshape(-1)
+
+    a2 = np.ones(len(pair_st), dtype=np.int64)
+    a1 = np.zeros(len(pair_st), dtype=np.int64)
+    a0 = np.zeros(len(pair_st), dtype=np.int64)
+    r2, r1, r0 = np.ones(len(ends), dtype=np.int64), np.zeros(len(ends), dtype=np.int64), np.zeros(len(ends), dtype=np.int64)
+
+    # Intervals in order of their end, so the ones that end after each day are a slice
+    order = np.argsort(ends, kind='stable')
+    first_day = int(pair_st.min()) if len(pair_st) else 0
+    last_day = int(ends.max()) if len(ends) else 0
+    bounds = np.searchsorted(ends[order], np.arange(first_day + 1, last_day + 2), side='left')
+
+    # The limbs of the integer part must stay below b3_max_accum, so their products by the limbs of the factors fit in int64
+    if len(pair_st) and np.log1p(daily_rates[first_day:last_day] * pair_percents.max() / 1e16).clip(0).sum() >= np.log(b3_max_accum):
+        raise Exception('Cumulative return too large for the B3 accumulation')
+
+    # Each day multiplies the products already started by their daily factor. Pairs are sorted by start, so they are a prefix
+    started = np.searchsorted(pair_st, np.arange(first_day, last_day), side='right')
+    for i, day in enumerate(range(first_day, last_day)):
+        n = started[i]
+        factors = b3_limb * b3_limb + daily_rates[day] * pair_percents[:n]
+        a2[:n], a1[:n], a0[:n] = b3_multiply(a2[:n], a1[:n], a0[:n], factors)
+
+        # Intervals that end on the next day
+        ending = order[bounds[i]:bounds[i + 1]]
+        pairs = pair_of[ending]
+        r2[ending], r1[ending], r0[ending] = a2[pairs], a1[pairs], a0[pairs]
+
+    # Intervals that end on their start date have the product 1
+    empty = ends == st_pos.reshape(-1)
+    r2[empty], r1[empty], r0[empty] = 1, 0, 0
+
+    if units:
+        if (r2 >= np.iinfo(np.int64).max // (b3_limb * b3_limb)).any():
+            raise Exception('Cumulative return too large to be returned in units of 1e-16')
+        return((r2 * b3_limb * b3_limb + r1 * b3_limb + r0).reshape(st_pos.shape))
+    return((r2 + (r1 * b3_limb + r0) / 1e16).reshape(st_pos.shape))
+
+def set_accum_cache_budget(num_bytes):
+    # Sets the memory budget, in bytes, of the accumulation cache and evicts entries that do not fit in the new budget
+    global accum_cache_budget
+
+    with accum_cache_lock:
+        accum_cache_budget = num_bytes
+        evict_accum_cache()
+
+def evict_accum_cache():
+    # Removes the least recently used entries until the cache fits in its budget. Must be called holding accum_cache_lock
+    global accum_cache_size
+
+    while accum_cache and accum_cache_size > accum_cache_budget:
+        key, log_accum = accum_cache.popitem(last=False)
+        accum_cache_size -= log_accum.nbytes
+
+def invalidate_accum_cache(series_name=None):
+    # Drops the cached accumulations of series_name (or of all series), to free their memory
+    # Called by the update functions every time new rates are stored. Entries of the previous rates would never be used again
+    global accum_cache_size
+
+    with accum_cache_lock:
+        if series_name is None:
+            accum_cache.clear()
+            accum_cache_size = 0
+        else:
+            for key in [key for key in accum_cache if key[0] == series_name]:
+                accum_cache_size -= accum_cache.pop(key).nbytes
+
+def rates_fingerprint(rates):
+    # Returns a checksum of the float64 rates: the sum, wrapping around, of their bits times odd weights
+    # Any change of a single rate, or of the number of rates, changes the checksum
+    global fingerprint_weights
+
+    weights = fingerprint_weights
+    if len(weights) < len(rates):
+        weights = fingerprint_weights = np.arange(1, 2 * len(rates) + 1, 2, dtype=np.uint64)
+
+    return((len(rates), int((np.ascontiguousarray(rates, dtype=np.float64).view(np.uint64) * weights[:len(rates)]).sum())))
+
+def series_cache_key(rate252, series_name=None):
+    # Returns the key that identifies the contents of rate252 in the accumulation cache: the series name, the version of its
+    # database (set by storage.read_series, including a pinned version) and a fingerprint of its rates. Copies of a series with other
+    # rates (e.g. scenarios) get their own entries, even when they are passed with the same series_name
+    # The fingerprint is calculated once per dataframe and kept in its attrs (see FingerprintStamp). Loaded series must not be changed
+    # in place
+    stamp = rate252.attrs.get('rates_fingerprint')
+    if stamp is None or not stamp.stamps(rate252):
+        stamp = FingerprintStamp(rate252, rates_fingerprint(rate252.Rate.values))
+        rate252.attrs['rates_fingerprint'] = stamp
+    return((series_name, rate252.attrs.get('version'), stamp.fingerprint))
+
+class FingerprintStamp:
+    # Fingerprint of the rates of a dataframe, with a weak reference to it. Frames derived from it (copies, slices) inherit its attrs
+    # as copies of the stamp, which lose the reference (as do pickled frames), so they calculate their own fingerprint
+
+    def __init__(self, df, fingerprint):
+        self.ref = weakref.ref(df)
+        self.fingerprint = fingerprint
+
+    def __getstate__(self):
+        return({'ref': None, 'fingerprint': self.fingerprint})
+
+    def stamps(self, df):
+        return(self.ref is not None and self.ref() is df)
+
+def cached_array(key, calculate):
+    # Returns the array of key in the accumulation cache, calculating it with calculate() and storing it if it is not there
+    global accum_cache_size
+
+    with accum_cache_lock:
+        values = accum_cache.get(key)
+        if values is not None:
+            accum_cache.move_to_end(key)
+            return(values)
+
+    values = calculate()
+    values.flags.writeable = False
+
+    with accum_cache_lock:
+        if key not in accum_cache and values.nbytes <= accum_cache_budget:
+            accum_cache[key] = values
+            accum_cache_size += values.nbytes
+            evict_accum_cache()
+
+    return(values)
+
+def cached_accum_r252(rate252, percentage=1, series_name=None):
+    # Returns the cumulative product of the daily factors of rate252 at percentage (the Accum of calc_accum_r252), reusing the array
+    # computed by a previous call for the same series and percentage. For percentage = 1 it is the stored Accum column
+    if percentage == 1 and 'Accum' in rate252.columns:
+        return(rate252.Accum.values)
+
+    def calculate():
+        return(np.concatenate(([1.0], np.cumprod(calc_factors_r252(rate252.Rate.values[:-1], percentage)))))
+
+    return(cached_array(series_cache_key(rate252, series_name) + ('cumprod', float(percentage)), calculate))
+
+def cached_log_accum_r252(rate252, percentage=1, series_name=None):
+    # Returns calc_log_accum_r252(rate252, percentage), reusing the array computed by a previous call for the same series and percentage
+    return(cached_array(series_cache_key(rate252, series_name) + ('log', float(percentage)),
+                        lambda: calc_log_accum_r252(rate252, percentage)))
+
+def find_positions(rate252, dates):
+    # Returns the positions of dates in the index of rate252. The index must be sorted in ascending order.
+    # Raises KeyError if any of the dates is not in the index
+
+    index_days = rate252.index.values.astype('datetime64[D]')
+    days = np.atleast_1d(np.asarray(dates).astype('datetime64[D]'))
+
+    positions = np.searchsorted(index_days, days)
+    found = positions < len(index_days)
+    found[found] = index_days[positions[found]] == days[found]
+    if not found.all():
+        raise KeyError(f'Dates not found in the index: {days[~found][:5]}')
+
+    return(positions)
+
+def accum_r252_batch(rate252, start_dates, end_dates, percentages=1, series_name=None, method='cumprod'):
+    # Returns an array with the cumulative return between each start_date (inclusive) and end_date (exclusive), using the given percentage of the rate
+    # start_dates, end_dates and percentages are arrays of the same size (or scalars). Dates must be in the index of rate252.
+    # method 'cumprod' uses the ratios of the cumulative products of the daily factors (the Accum column for percentage = 1), 'log' the
+    # differences of the cumulative log factors and 'b3' the exact B3 rules (see accum_methods). Each percentage has its cumulative
+    # products (or logs) computed once and shared by all its intervals
+    # series_name (e.g. 'CDI') identifies the series in the accumulation cache
+
+    if method not in accum_methods:
+        raise Exception(f'Accumulation method must be one of: {", ".join(accum_methods)}')
+
+    st_pos = find_positions(rate252, start_dates)
+    end_pos = find_positions(rate252, end_dates)
+    st_pos, end_pos, percentages = np.broadcast_arrays(st_pos, end_pos, np.asarray(percentages, dtype=float))
+    if (end_pos < st_pos).any():
+        raise Exception('Start Date must be older than End Date')
+
+    if method == 'b3':
+        return(accum_b3_batch(rate252.Rate.values, st_pos, end_pos, percentages))
+
+    cum_ret = np.empty(st_pos.shape)
+
+    unique_percentages, groups = np.unique(percentages, return_inverse=True)
+    groups = groups.reshape(st_pos.shape)
+    order = np.argsort(groups, kind='stable')
+    bounds = np.searchsorted(groups[order], np.arange(len(unique_percentages) + 1))
+
+    for i, percentage in enumerate(unique_percentages):
+        members = order[bounds[i]:bounds[i + 1]]
+        if method == 'cumprod':
+            accum = cached_accum_r252(rate252, percentage, series_name)
+            cum_ret[members] = accum[end_pos[members]] / accum[st_pos[members]]
+        else:
+            log_accum = cached_log_accum_r252(rate252, percentage, series_name)
+            cum_ret[members] = np.exp(log_accum[end_pos[members]] - log_accum[st_pos[members]])
+
+    return(cum_ret)
+
+
+# Taxes on the redemptions of fixed income investments
+
+# Regressive income tax (IR): rate on the income for holding periods (calendar days) up to each limit. Longer periods pay the last rate
+ir_day_limits = np.array([180, 360, 720])
+ir_rates = np.array([0.225, 0.20, 0.175, 0.15])
+
+# IOF: share of the income taxed when the investment is redeemed 1, 2, ... 30 calendar days after the purchase. From 30 days on there is no IOF
+iof_table = np.array([96, 93, 90, 86, 83, 80, 76, 73, 70, 66, 63, 60, 56, 53, 50, 46, 43, 40, 36, 33, 30, 26, 23, 20, 16, 13, 10, 6, 3, 0]) / 100
+
+def calc_ir_rates(holding_days):
+    # Returns the IR rate of each holding period (calendar days)
+    return(ir_rates[np.searchsorted(ir_day_limits, holding_days, side='left')])
+
+def calc_iof_rates(holding_days):
+    # Returns the IOF rate of each holding period (calendar days). Redemptions on the day of the purchase pay the whole income
+    return(np.concatenate(([1.0], iof_table))[np.clip(holding_days, 0, len(iof_table))])
+
+def calc_taxes(costs, gross, holding_days):
+    # Returns (iof, ir) of redemptions with the given costs, gross values and holding periods (calendar days)
+    # The IOF is due on the income, and the IR on the income after the IOF. Redemptions with no income pay no taxes
+    income = np.maximum(np.asarray(gross, dtype=float) - costs, 0.0)
+    iof = income * calc_iof_rates(holding_days)
+    ir = (income - iof) * calc_ir_rates(holding_days)
+    return(iof, ir)
+
+def match_fifo(lot_accounts, lot_quantities, red_accounts, red_quantities, min_quantity=1e-9):
+    # Matches the redemptions with the lots of each account, first in first out. Lots and redemptions must be sorted by account and date
+    # Returns (lots, redemptions, quantities): for each matched part, the position of its lot, of its redemption and its quantity
+    # The lots of each account are laid end to end on a line (cumulative quantities), and so are its redemptions, starting at the same
+    # point. Every piece of the line between two consecutive ends (of a lot or of a redemption) belongs to one lot and one redemption
+    lot_quantities = np.asarray(lot_quantities, dtype=float)
+    red_quantities = np.asarray(red_quantities, dtype=float)
+
+    accounts, lot_groups = np.unique(lot_accounts, return_inverse=True)
+    lot_groups = lot_groups.reshape(-1)
+    red_groups = np.searchsorted(accounts, red_accounts)
+    red_groups = np.minimum(red_groups, len(accounts) - 1) if len(accounts) else red_groups
+    if len(red_groups) and (not len(accounts) or (accounts[red_groups] != np.asarray(red_accounts)).any()):
+        raise Exception('Redemption of an account with no lots')
+
+    # Each account starts where the lots of the previous account end
+    held = np.bincount(lot_groups, lot_quantities, len(accounts))
+    redeemed = np.bincount(red_groups, red_quantities, len(accounts))
+    if (redeemed > held * (1 + 1e-12) + min_quantity).any():
+        raise Exception('Redemption of more quantity than held in the account')
+    account_starts = np.concatenate(([0.0], np.cumsum(held)[:-1]))
+
+    lot_ends = np.cumsum(lot_quantities)
+    red_ends = account_starts[red_groups] + np.cumsum(red_quantities) - np.concatenate(([0.0], np.cumsum(redeemed)))[red_groups]
+    red_starts = red_ends - red_quantities
+
+    points = np.unique(np.concatenate((red_starts, red_ends, lot_ends)))
+    piece_starts, piece_ends = points[:-1], points[1:]
+    reds = np.searchsorted(red_ends, piece_starts, side='right')
+    inside = reds < len(red_ends)
+    inside[inside] = piece_starts[inside] >= red_starts[reds[inside]]
+    inside &= (piece_ends - piece_starts) > min_quantity
+
+    piece_starts, piece_ends, reds = piece_starts[inside], piece_ends[inside], reds[inside]
+    lots = np.minimum(np.searchsorted(lot_ends, piece_starts, side='right'), len(lot_ends) - 1)
+
+    return(lots, reds, piece_ends - piece_starts)
+
+@instrument.timed('ir_calc.redeem_lots')
+def redeem_lots(lots, redemptions, min_quantity=1e-9):
+    # Calculates the taxes of the redemptions of fixed income lots, matched first in first out in each account
+    # lots is a dataframe with one row per purchase and the columns:
+    #   account       - account (or account and asset) of the lot. Optional: all the lots are in the same account
+    #   purchase_date - date of the purchase, when the lot starts to accrue
+    #   quantity      - quantity bought
+    #   cost          - amount paid for the whole lot
+    #   indexer       - 'CDI', 'Selic', 'IPCA' or 'BRLUSD', and the optional columns of a book of positions (see valuation.py)
+    # redemptions is a dataframe with one row per redemption and the columns account (optional), redemption_date and quantity
+    # Each matched part is valued at its redemption date by the batch accumulation functions, all the parts of an indexer at once
+    # Returns a dataframe with one row per matched part: the labels of its lot and redemption, quantity, holding_days, cost,
+    # gross (value at the redemption), income, iof, ir and net (gross - iof - ir). Per lot amounts: result.groupby('lot').sum()
+    import valuation
+
+    lots = lots.assign(purchase_date=pd.to_datetime(lots.purchase_date))
+    redemptions = redemptions.assign(redemption_date=pd.to_datetime(redemptions.redemption_date))
+    if 'account' not in lots.columns:
+        lots = lots.assign(account=0)
+    if 'account' not in redemptions.columns:
+        redemptions = redemptions.assign(account=0)
+
+    lots = lots.sort_values(['account', 'purchase_date'], kind='stable')
+    redemptions = redemptions.sort_values(['account', 'redemption_date'], kind='stable')
+
+    lot_pos, red_pos, quantities = match_fifo(lots.account.values, lots.quantity.values, redemptions.account.values,
+                                              redemptions.quantity.values, min_quantity)
+
+    purchase_days = lots.purchase_date.values.astype('datetime64[D]')[lot_pos]
+    redemption_days = redemptions.redemption_date.values.astype('datetime64[D]')[red_pos]
+    if (redemption_days < purchase_days).any():
+        raise Exception('Redemption of more quantity than held in the account at the redemption date')
+
+    # Each matched part is a position with the cost of its share of the lot, valued at its redemption date
+    parts = lots.iloc[lot_pos].drop(columns=['account', 'purchase_date', 'quantity', 'cost'])
+    parts.index = pd.RangeIndex(len(parts))
+    costs = lots.cost.values.astype(float)[lot_pos] * quantities / lots.quantity.values.astype(float)[lot_pos]
+    book = valuation.prepare_book(parts.assign(start_date=purchase_days, notional=costs))
+    gross = valuation.value_book(book, redemption_days).value.values
+
+    holding_days = (redemption_days - purchase_days).astype(np.int64)
+    iof, ir = calc_taxes(costs, gross, holding_days)
 
-    return(rate252)
\ No newline at end of file
+    return(pd.DataFrame({'lot': lots.index.values[lot_pos], 'redemption': redemptions.index.values[red_pos], 'quantity': quantities,
+                         'holding_days': holding_days, 'cost': costs, 'gross': gross, 'income': gross - costs,
+                         'iof': iof, 'ir': ir, 'net': gross - iof - ir}))
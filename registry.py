@@ -0,0 +1,226 @@
+# This module keeps the holiday calendars and the index series used by the other modules
+# Nothing is read when the modules are imported: each calendar and series is loaded from the data directory on first use
+# and kept for the life of the process.
+# The data directory is taken from the CURRY_DATA_DIR environment variable, or set with set_data_dir()
+# For pools of worker processes, export_shared() copies the loaded calendars and series to shared memory once, and the workers
+# call attach_shared() with the returned handle to use that copy instead of loading their own.
+
+import os
+import importlib
+import threading
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory, resource_tracker
+
+data_dir = os.environ.get('CURRY_DATA_DIR', 'D:\Investiments\Databases\Indexes')
+holidays_file = 'BR_holidays.csv'
+
+# Storage formats searched for each series in the data directory, in order of preference
+series_extensions = ['.cols', '.parquet', '.feather', '.csv']
+
+# For each series: the module and the function that load its database, and the arguments passed before the database path
+series_loaders = {'CDI': ('cdi', 'load_cdi'),
+                  'Selic': ('selic', 'load_selic'),
+                  'IPCA': ('ipca', 'load_ipca'),
+                  'IPCA_proj': ('ipca', 'load_ipca_projections'),
+                  'BRLUSD': ('fxrates', 'load_brlusd'),
+                  'BRLEUR': ('fxrates', 'load_fx', 'EUR'),
+                  'BRLGBP': ('fxrates', 'load_fx', 'GBP'),
+                  'BRLJPY': ('fxrates', 'load_fx', 'JPY'),
+                  'BRLCHF': ('fxrates', 'load_fx', 'CHF')}
+
+# Holiday lists used by each calendar: bank holidays for interest rates (CDI, Selic) and Sao Paulo holidays for B3
+calendar_cities = {'br': 'Brazilian Real', 'b3': 'Sao Paulo'}
+
+calendars = {}
+series = {}
+# Versions of the databases pinned by pin_series(), keyed by series name. Other series use the current version
+pinned_versions = {}
+registry_lock = threading.RLock()
+
+# Functions called with (series name, database path) just before a series is loaded from its database, and with
+# (None, holidays path) before a calendar is built. Used e.g. by the query service to know which version of the files it loaded
+load_hooks = []
+
+# Shared memory blocks created by export_shared() (freed by release_shared in the process that created them), with the pid of
+# that process, and blocks of another process opened by attach_shared() (only closed)
+created_blocks = []
+attached_blocks = []
+
+
+def set_data_dir(path):
+    # Changes the data directory. Calendars and series loaded from the previous directory are dropped
+    global data_dir
+
+    with registry_lock:
+        data_dir = path
+        calendars.clear()
+        series.clear()
+
+def holidays_path():
+    return(os.path.join(data_dir, holidays_file))
+
+def series_path(series_name):
+    # Returns the path of the database of series_name in the data directory, in the first storage format found (csv if none is found)
+    for ext in series_extensions:
+        path = os.path.join(data_dir, series_name + ext)
+        if os.path.exists(path):
+            return(path)
+
+    return(os.path.join(data_dir, series_name + '.csv'))
+
+def get_calendar(calendar_name):
+    # Returns the business day calendar calendar_name ('br' or 'b3'), building it on first use
+    calendar = calendars.get(calendar_name)
+    if calendar is not None:
+        return(calendar)
+
+    import br_workdays as wd
+
+    with registry_lock:
+        if calendar_name not in calendars:
+            run_load_hooks(None, holidays_path())
+            holidays = wd.load_holidays(holidays_path(), calendar_cities[calendar_name])
+            calendars[calendar_name] = wd.BusinessCalendar(holidays)
+        return(calendars[calendar_name])
+
+def get_series(series_name):
+    # Returns the dataframe of the series series_name (e.g. 'CDI', 'Selic', 'IPCA' or 'BRLUSD'), loading it on first use
+    df = series.get(series_name)
+    if df is not None:
+        return(df)
+
+    # Series of the BCB catalog with no loader of their own are read by bacen.load_series
+    module_name, loader_name, *loader_args = series_loaders.get(series_name, ('bacen', 'load_series', series_name))
+    loader = getattr(importlib.import_module(module_name), loader_name)
+
+    with registry_lock:
+        if series_name not in series:
+            path = series_path(series_name)
+            run_load_hooks(series_name, path)
+            if series_name in pinned_versions:
+                series[series_name] = loader(*loader_args, path, version=pinned_versions[series_name])
+            else:
+                series[series_name] = loader(*loader_args, path)
+        return(series[series_name])
+
+def run_load_hooks(series_name, path):
+    for hook in load_hooks:
+        hook(series_name, path)
+
+def pin_series(series_name, version):
+    # Makes get_series return the version of the database of series_name (see storage.list_versions) instead of the current one,
+    # so valuations can be reproduced with the data of a past update. version None goes back to the current version
+    with registry_lock:
+        if version is None:
+            pinned_versions.pop(series_name, None)
+        else:
+            pinned_versions[series_name] = version
+        series.pop(series_name, None)
+
+def invalidate_series(series_name=None):
+    # Drops the loaded series_name (or all series), so it is loaded again on next use. Called after the database is updated
+    with registry_lock:
+        if series_name is None:
+            series.clear()
+        else:
+            series.pop(series_name, None)
+
+# Shared memory
+
+def to_shared_block(arrays):
+    # Copies the arrays (dict name -> array) to a new shared memory block and returns (block, layout)
+    layout = []
+    offset = 0
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values)
+        layout.append((name, values.dtype.str, offset, len(values)))
+        offset += values.nbytes
+        offset += -offset % 8
+
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (name, dtype, start, length), values in zip(layout, arrays.values()):
+        np.ndarray((length,), dtype=dtype, buffer=block.buf, offset=start)[:] = values
+    created_blocks.append((os.getpid(), block))
+
+    return(block, layout)
+
+def open_shared_block(block_name):
+    # Opens a shared memory block created by another process without registering it with the resource tracker, which would
+    # otherwise free the block (and warn of a leak) when this process exits, while its creator is still using it
+    try:
+        return(shared_memory.SharedMemory(name=block_name, track=False))
+    except TypeError:
+        # Python before 3.13 has no track argument and always registers the block
+        pass
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return(shared_memory.SharedMemory(name=block_name))
+    finally:
+        resource_tracker.register = register
+
+def from_shared_block(block_name, layout):
+    # Maps the arrays stored in a shared memory block (read only) and returns them as a dict name -> array
+    block = open_shared_block(block_name)
+    attached_blocks.append(block)
+
+    arrays = {}
+    for name, dtype, start, length in layout:
+        arrays[name] = np.ndarray((length,), dtype=dtype, buffer=block.buf, offset=start)
+        arrays[name].flags.writeable = False
+
+    return(arrays)
+
+def export_shared(calendar_names=('br', 'b3'), series_names=('CDI', 'Selic', 'IPCA', 'BRLUSD')):
+    # Copies the calendars and series to shared memory and returns a handle (a picklable dict) to be passed to attach_shared()
+    # The blocks stay alive until release_shared() is called in this process
+    handle = {'calendars': {}, 'series': {}}
+
+    for calendar_name in calendar_names:
+        calendar = get_calendar(calendar_name)
+        block, layout = to_shared_block({'holidays': calendar.holidays.astype(np.int64),
+                                         'bday_flags': calendar.bday_flags,
+                                         'bday_ordinals': calendar.bday_ordinals})
+        handle['calendars'][calendar_name] = (block.name, layout, str(calendar.first_day))
+
+    for series_name in series_names:
+        df = get_series(series_name)
+        arrays = {df.index.name or 'index': df.index.values.astype('datetime64[ns]').view(np.int64)}
+        arrays.update({column: df[column].values for column in df.columns})
+        block, layout = to_shared_block(arrays)
+        handle['series'][series_name] = (block.name, layout)
+
+    return(handle)
+
+def attach_shared(handle):
+    # Registers in this process the calendars and series exported by export_shared(), without copying them
+    import br_workdays as wd
+
+    with registry_lock:
+        for calendar_name, (block_name, layout, first_day) in handle['calendars'].items():
+            arrays = from_shared_block(block_name, layout)
+            calendars[calendar_name] = wd.BusinessCalendar.from_arrays(arrays['holidays'].view('datetime64[D]'), arrays['bday_flags'],
+                                                                       arrays['bday_ordinals'], np.datetime64(first_day, 'D'))
+
+        for series_name, (block_name, layout) in handle['series'].items():
+            arrays = from_shared_block(block_name, layout)
+            index_name = layout[0][0]
+            index = pd.DatetimeIndex(arrays.pop(index_name).view('datetime64[ns]'), copy=False, name=index_name)
+            series[series_name] = pd.DataFrame(arrays, index=index, copy=False)
+
+def release_shared():
+    # Closes the shared memory blocks used by this process. The blocks created by export_shared() in this process are also
+    # unlinked (freed). Blocks attached from another process, or inherited from the parent by a forked worker, are left to their creator
+    while attached_blocks:
+        attached_blocks.pop().close()
+
+    while created_blocks:
+        pid, block = created_blocks.pop()
+        block.close()
+        if pid == os.getpid():
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
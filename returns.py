@@ -0,0 +1,116 @@
+# This module calculates period returns (daily, monthly, yearly or every N business days) and rolling window returns of the index series
+# Returns are ratios of the stored cumulative values, so a whole range is calculated at once instead of one *_accum call per period:
+#   CDI, Selic and IPCA - Accum column
+#   BRLUSD              - BRLUSD column (the rate itself)
+# A period goes from its first date in the series (inclusive) to the first date of the next period (exclusive), the same convention
+# of cdi_accum, ipca_accum and brlusd_accum. The last period may be partial: it ends at the last date of the series
+# Annualized returns use the 252 business days base
+
+import numpy as np
+import pandas as pd
+import br_workdays as wd
+
+# Frequencies of the periods, as pandas period codes
+period_codes = {'M': 'M', 'Y': 'Y'}
+
+
+def value_column(df):
+    # Returns the array of cumulative values of the series
+    if 'Accum' in df.columns:
+        return(df.Accum.values)
+    if 'BRLUSD' in df.columns:
+        return(df.BRLUSD.values)
+    raise Exception('Series must have an Accum or a BRLUSD column')
+
+def select_range(df, start_date=None, end_date=None):
+    # Rows of df between start_date and end_date (inclusive)
+    if start_date is None and end_date is None:
+        return(df)
+    return(df.loc[start_date:end_date])
+
+def period_starts(index, freq):
+    # Returns the positions of the first row of each period in index
+    # freq is 'D' (each row is a period), 'M' (months), 'Y' (years) or a number N (every N rows, i.e. N business days of a daily series)
+    if isinstance(freq, (int, np.integer)):
+        if freq <= 0:
+            raise Exception('Number of business days of the period must be positive')
+        return(np.arange(0, len(index), freq))
+    if freq == 'D':
+        return(np.arange(len(index)))
+    if freq not in period_codes:
+        raise Exception('Frequency must be D (daily), M (monthly), Y (yearly) or a number of business days')
+
+    if len(index) == 0:
+        return(np.empty(0, dtype=np.int64))
+    periods = index.to_period(period_codes[freq]).asi8
+    return(np.flatnonzero(np.concatenate(([True], periods[1:] != periods[:-1]))))
+
+def annualize_returns(returns, st_dates, end_dates):
+    # Annualizes the returns on the 252 business days base
+    bdays = wd.num_br_bdays_array(st_dates, end_dates)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return(np.where(bdays > 0, (1 + returns) ** (252 / bdays) - 1, np.nan))
+
+def empty_table():
+    return(pd.DataFrame({'Start': pd.DatetimeIndex([]), 'End': pd.DatetimeIndex([]), 'Return': np.empty(0)}))
+
+def make_table(labels, index, st_pos, end_pos, values, annualize):
+    st_dates = index.values[st_pos]
+    end_dates = index.values[end_pos]
+    returns = values[end_pos] / values[st_pos] - 1
+    if annualize:
+        returns = annualize_returns(returns, st_dates, end_dates)
+
+    return(pd.DataFrame({'Start': st_dates, 'End': end_dates, 'Return': returns}, index=labels))
+
+def period_returns(df, freq='M', start_date=None, end_date=None, annualize=False):
+    # Returns the return of each period of the series df (a dataframe loaded by load_cdi, load_selic, load_ipca or load_brlusd)
+    # between start_date and end_date. The result has one row per period, with its Start and End (exclusive) dates and the Return
+    # The rows are labelled by period (e.g. 2022-01 for monthly returns) or by the start date of the period (daily or N business days)
+    df = select_range(df, start_date, end_date)
+    index = df.index
+    values = value_column(df)
+
+    starts = period_starts(index, freq)
+    ends = np.append(starts[1:], len(index) - 1)
+    # The last period has no length when the last row is the first of its period
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+
+    if freq in period_codes:
+        labels = index[starts].to_period(period_codes[freq])
+    else:
+        labels = index[starts]
+
+    return(make_table(labels, index, starts, ends, values, annualize))
+
+def rolling_returns(df, window, freq='M', start_date=None, end_date=None, annualize=False):
+    # Returns the returns of the series df over rolling windows of window periods (e.g. window=12, freq='M' for 12 month inflation)
+    # freq='D' gives windows of window rows (business days of a daily series)
+    # Each row is labelled by the last period of its window, and has the Start and End (exclusive) dates and the Return of the window
+    if window <= 0:
+        raise Exception('Window must have at least one period')
+
+    df = select_range(df, start_date, end_date)
+    index = df.index
+    values = value_column(df)
+
+    starts = period_starts(index, freq)
+    # No rows in the selected range
+    if len(starts) == 0:
+        return(empty_table())
+    # Boundaries of the periods: first row of each period and the last row of the series
+    bounds = np.append(starts, len(index) - 1) if starts[-1] != len(index) - 1 else starts
+    if len(bounds) <= window:
+        return(empty_table())
+
+    st_pos = bounds[:-window]
+    end_pos = bounds[window:]
+    last_periods = bounds[window - 1:-1]
+
+    if freq in period_codes:
+        labels = index[last_periods].to_period(period_codes[freq])
+    else:
+        labels = index[last_periods]
+
+    return(make_table(labels, index, st_pos, end_pos, values, annualize))
@@ -3,18 +3,23 @@
 # The Selic rate, or 'over Selic', is the Brazilian federal funds rate. Precisely, Selic rate is the weighted average interest rate of the overnight interbank operations
 #  — collateralized by federal government securities — carried out at the Special System for Settlement and Custody (Selic). 
 # Selic rate is expressed as a percentage per annum, based on a two hundred fifty-two (252) business days year, as published by BCB in its website (http://www.bcb.gov.br)
-import os
+import numpy as np
 import pandas as pd
+import storage
+import registry
+import instrument
 import bacen as bc
 import ir_calc as ir
 import br_workdays as wd
 
 
-def load_selic(db_path='D:\Investiments\Databases\Indexes\Selic.csv'):
+@instrument.timed('selic.load_selic')
+def load_selic(db_path=None, mmap=True, version=None):
     # read Selic database to dataframe
+    if db_path is None:
+        db_path = registry.series_path('Selic')
     try:
-        df_selic = pd.read_csv(db_path, delimiter=';', dtype={'Rate':float, 'Accum':float}, index_col='TradeDate')
-        df_selic.index = pd.to_datetime(df_selic.index,format='%Y-%m-%d')
+        df_selic = storage.read_series(db_path, {'Rate':float, 'Accum':float}, mmap, version)
         df_selic.sort_index()
     except OSError as err:
         raise OSError(err)
@@ -23,49 +28,53 @@ def load_selic(db_path='D:\Investiments\Databases\Indexes\Selic.csv'):
 
     return(df_selic)
 
-def update_selic_db(db_path='D:\Investiments\Databases\Indexes\Selic.csv'):
+@instrument.timed('selic.update_selic_db')
+def update_selic_db(db_path=None, verify=False, novos_selic=None):
+    # Updates the Selic database with all the rates published after the last update
+    # novos_selic can bring the rates already fetched from the BCB api (see updater.update_all_indexes), otherwise they are fetched here
+    if db_path is None:
+        db_path = registry.series_path('Selic')
 
-    df_selic = load_selic(db_path)
+    with storage.locked(db_path):
+        df_selic = load_selic(db_path, mmap=False)
 
-    # Get the Selic values published since the last update.
-    start_date_str = df_selic.last_valid_index().strftime('%d/%m/%Y')
-    end_date_str = pd.to_datetime("today").strftime("%d/%m/%Y")
-
-    try:
-        novos_selic = bc.get_bacen_data('Selic', start_date_str, end_date_str)
-    except Exception as err:
-        raise Exception(err)
+        # Get the Selic values published since the last update.
+        if novos_selic is None:
+            start_date_str = df_selic.last_valid_index().strftime('%d/%m/%Y')
+            end_date_str = pd.to_datetime("today").strftime("%d/%m/%Y")
 
+            try:
+                novos_selic = bc.get_bacen_data('Selic', start_date_str, end_date_str)
+            except Exception as err:
+                raise Exception(err)
 
-    if novos_selic.first_valid_index() == df_selic.last_valid_index():
-        df_selic.drop(df_selic.last_valid_index(), inplace=True)
 
-    novos_selic.rename(columns={'valor':'Rate'}, inplace=True)
+        if novos_selic.empty:
+            return
 
-    # Appends new rates to the dataframe
-    df_selic = pd.concat([df_selic, novos_selic])
+        novos_selic.rename(columns={'valor':'Rate'}, inplace=True)
 
-    # Includes the workday following the date of the last CDI rate available, to calculate the last available Accum
-    new_date = wd.next_br_bday(df_selic.last_valid_index())
-    new_row = pd.DataFrame(data={'Rate':[0.0],'Accum':[1.0]},index=[new_date])
-    df_selic = pd.concat([df_selic, new_row])
+        # Includes the workday following the date of the last Selic rate available, to calculate the last available Accum
+        new_date = wd.next_br_bday(novos_selic.last_valid_index())
 
-    df_selic.sort_index()
+        # Continues the cumulative Selic from the last stored Accum. Only the rows from from_row onwards (the placeholder row
+        # of the last update and the new rates) are written to the database
+        from_row, new_rows = ir.append_accum_r252(df_selic, novos_selic, new_date)
 
-    # Calculates the cumulative Selic for the whole period
-    df_selic = ir.calc_accum_r252(df_selic)
+        if verify:
+            ir.verify_accum_r252(pd.concat([df_selic.iloc[:from_row], new_rows]))
 
-    # Saves the last version of the Selic database
-    new_path = db_path[:len(db_path)-4] + df_selic.last_valid_index().strftime('%Y%m%d') + '.csv'
-    if not os.path.exists(new_path):
-        os.rename(db_path,new_path)
+        # Saves the new rows to the database as a new version. The rows they replace are kept in the versions of the database
+        storage.commit_series(new_rows, db_path, from_row, new_date)
 
-    # Saves the updated series to the csv file
-    df_selic.to_csv(db_path, sep=';',header=['Rate','Accum'], index_label='TradeDate')
+        # Cached accumulations of the previous version of the series are no longer valid
+        ir.invalidate_accum_cache('Selic')
+        registry.invalidate_series('Selic')
 
-def selic_accum (df_selic, start_date, end_date, percent=1):
+def selic_accum (df_selic, start_date, end_date, percent=1, method='cumprod'):
     # Returns the cumulative return of the Selic rate between start_date (inclusive) and end_date (exclusive)
     # If percent <> 1, applies percent to the daily effective rate
+    # method 'log' or 'b3' uses that accumulation method (see ir_calc.accum_methods)
     # If start_date is not a business day in Brazil, considers the following business day as start_date
     # If end_date is not a business day in Brazil, considers the following business day as end_date
 
@@ -78,14 +87,40 @@ def selic_accum (df_selic, start_date, end_date, percent=1):
     if (start_date < df_selic.first_valid_index()) or (end_date > df_selic.last_valid_index()):
         raise Exception('Dates out of available range of Selic dates')
 
+    if method != 'cumprod':
+        return(ir.accum_r252_batch(df_selic, start_date, end_date, percent, 'Selic', method)[0])
+
     try:
         if percent == 1:
             cum_ret = df_selic.loc[end_date].Accum / df_selic.loc[start_date].Accum
         else:
-            df_selic_tmp = df_selic.loc[start_date : end_date]
-            df_selic_tmp = ir.calc_accum_r252(df_selic_tmp, percent)
-            cum_ret = df_selic_tmp.loc[end_date].Accum / df_selic_tmp.loc[start_date].Accum
+            # Uses the cumulative products of the daily factors of the whole series for this percent, computed once and cached
+            accum = ir.cached_accum_r252(df_selic, percent, 'Selic')
+            cum_ret = accum[df_selic.index.get_loc(end_date)] / accum[df_selic.index.get_loc(start_date)]
     except Exception as err:
         print(err)
 
     return(cum_ret)
+
+def selic_accum_batch (df_selic, start_dates, end_dates, percents=1, method='cumprod'):
+    # Returns an array with the cumulative return of the Selic rate between each start_date (inclusive) and end_date (exclusive)
+    # start_dates and end_dates are arrays of dates (DatetimeIndex, Series or datetime64 arrays), percents is a number or an array
+    # method is the accumulation method (see ir_calc.accum_methods): 'b3' follows the B3 truncation rules, for reconciliations
+    # Dates follow the same rules of selic_accum: dates that are not business days in Brazil are moved to the following business day
+
+    start_dates = wd.to_days(start_dates)
+    end_dates = wd.to_days(end_dates)
+    if start_dates.size == 0 or end_dates.size == 0:
+        return(np.empty(np.broadcast_shapes(start_dates.shape, end_dates.shape)))
+    start_dates = np.where(wd.is_br_bday_array(start_dates), start_dates, wd.next_br_bday_array(start_dates))
+    end_dates = np.where(wd.is_br_bday_array(end_dates), end_dates, wd.next_br_bday_array(end_dates))
+
+    if (start_dates.min() < df_selic.first_valid_index()) or (end_dates.max() > df_selic.last_valid_index()):
+        raise Exception('Dates out of available range of Selic dates')
+
+    try:
+        cum_ret = ir.accum_r252_batch(df_selic, start_dates, end_dates, percents, 'Selic', method)
+    except KeyError as err:
+        raise KeyError(err)
+
+    return(cum_ret)
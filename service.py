@@ -0,0 +1,294 @@
+# This module is a resident query service: it keeps the calendars and index series in memory (through the registry) and answers
+# batched queries over a local HTTP/JSON api, so a pricing script does not have to load the databases before each query
+# The requests are handled by an asyncio server. The queries are calculated in a pool of worker threads, so a large query does not
+# hold the other connections. Responses to queries already answered are served from an LRU result cache
+# The service watches the databases of the loaded series: when an update_*_db (or bulk_update) writes a database after the series
+# was loaded, the series is reloaded on its next query and the result cache is dropped
+#
+# Endpoints (dates are yyyy-mm-dd strings, each query takes arrays and answers arrays of the same size):
+#   POST /accum    {"series": "CDI", "start_dates": [...], "end_dates": [...], "percents": 1.1}             -> {"accum": [...]}
+#                  CDI and Selic also take method: cumprod, log or b3 (see ir_calc.accum_methods)
+#                  IPCA also takes reset_days, accrual_types and use_projections (see ipca.ipca_accum_batch)
+#   POST /bdays    {"op": "count", "start_dates": [...], "end_dates": [...], "calendar": "br"}              -> {"count": [...]}
+#                  {"op": "is_bday" | "next" | "prev", "dates": [...], "num_days": 1, "calendar": "br"}  -> {"is_bday" | "dates": [...]}
+#   POST /convert  {"amounts": [...], "currencies": [...], "dates": [...], "to": "BRL"}                     -> {"amounts": [...]}
+#   GET  /health   loaded series, number of reloads and size of the result cache
+#   GET  /metrics  instrument metrics in the Prometheus text format
+#
+# Usage: python Curry.py serve --port 8765
+
+import os
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import registry
+import instrument
+import ir_calc as ir
+import cdi
+import selic
+import ipca
+import fxrates
+
+logger = logging.getLogger('curry.service')
+
+default_host = '127.0.0.1'
+default_port = 8765
+# Seconds between the checks of the databases for new data
+default_reload_interval = 2.0
+default_cache_entries = 10000
+# Worker threads that calculate the queries
+default_workers = 4
+# Largest request body accepted, in bytes
+max_body_size = 64 * 1024 * 1024
+
+status_texts = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large'}
+
+
+def to_days(dates):
+    return(np.atleast_1d(np.asarray(dates, dtype='datetime64[D]')))
+
+def to_strings(days):
+    return(np.datetime_as_string(np.asarray(days).astype('datetime64[D]'), unit='D').tolist())
+
+def accum_query(query):
+    # Cumulative return of the series between each start_date (inclusive) and end_date (exclusive)
+    series_name = query['series']
+    start_days = to_days(query['start_dates'])
+    end_days = to_days(query['end_dates'])
+
+    if series_name == 'CDI':
+        accum = cdi.cdi_accum_batch(registry.get_series('CDI'), start_days, end_days, np.asarray(query.get('percents', 1), dtype=float),
+                                   query.get('method', 'cumprod'))
+    elif series_name == 'Selic':
+        accum = selic.selic_accum_batch(registry.get_series('Selic'), start_days, end_days, np.asarray(query.get('percents', 1), dtype=float),
+                                       query.get('method', 'cumprod'))
+    elif series_name == 'IPCA':
+        accum = ipca.ipca_accum_batch(registry.get_series('IPCA'), start_days, end_days, np.asarray(query.get('reset_days', 0)),
+                                      np.asarray(query.get('accrual_types', 'cd')), query.get('use_projections', True))
+    elif series_name == 'BRLUSD':
+        accum = fxrates.brlusd_accum_batch(registry.get_series('BRLUSD'), start_days, end_days)
+    else:
+        raise Exception(f'Unknown series {series_name}. Use one of: CDI, Selic, IPCA, BRLUSD')
+
+    return({'accum': np.asarray(accum).tolist()})
+
+def bdays_query(query):
+    # Business day arithmetic on the br (bank holidays) or b3 calendar
+    calendar = registry.get_calendar(query.get('calendar', 'br'))
+    op = query['op']
+
+    if op == 'count':
+        return({'count': calendar.num_bdays_array(to_days(query['start_dates']), to_days(query['end_dates'])).tolist()})
+    if op == 'is_bday':
+        return({'is_bday': calendar.is_bday_array(to_days(query['dates'])).tolist()})
+    if op == 'next':
+        return({'dates': to_strings(calendar.next_bday_array(to_days(query['dates']), query.get('num_days', 1)))})
+    if op == 'prev':
+        return({'dates': to_strings(calendar.prev_bday_array(to_days(query['dates']), query.get('num_days', -1)))})
+    raise Exception(f'Unknown business day operation {op}. Use one of: count, is_bday, next, prev')
+
+
+class QueryService:
+    # Resident service that answers the queries of the endpoints. One instance serves all the connections
+
+    def __init__(self, host=default_host, port=default_port, reload_interval=default_reload_interval, cache_entries=default_cache_entries,
+                 workers=default_workers):
+        self.host = host
+        self.port = port
+        self.reload_interval = reload_interval
+        self.cache_entries = cache_entries
+        self.workers = workers
+        self.result_cache = OrderedDict()
+        self.fx_store = None
+        self.reloads = 0
+        # Modification time of each loaded database when it was loaded, keyed by series name (None for the holidays file)
+        self.stamps = {}
+        self.server = None
+        self.executor = None
+
+        self.routes = {('POST', '/accum'): accum_query,
+                       ('POST', '/bdays'): bdays_query,
+                       ('POST', '/convert'): self.convert_query}
+
+    def convert_query(self, query):
+        # Converts the amounts, each in its currency, to the currency to, at the rates of the dates
+        if self.fx_store is None:
+            self.fx_store = fxrates.FXStore()
+        amounts = self.fx_store.convert(query['amounts'], query['currencies'], to_days(query['dates']), query.get('to', 'BRL'))
+        return({'amounts': amounts.tolist()})
+
+    def health(self):
+        return({'status': 'ok', 'data_dir': registry.data_dir, 'series': sorted(registry.series), 'reloads': self.reloads,
+                'cache_entries': len(self.result_cache)})
+
+    # Hot reload
+
+    def database_stamp(self, path):
+        # Modification time of the database in path. A .cols database is a directory: its meta file is written last by every update
+        if os.path.isdir(path):
+            path = os.path.join(path, 'meta.json')
+        try:
+            return(os.stat(path).st_mtime_ns)
+        except OSError:
+            return(None)
+
+    def database_loaded(self, series_name, path):
+        # Registry load hook: takes the stamp of the database just before the series (or the calendars, series_name None) is loaded
+        self.stamps[series_name] = self.database_stamp(path)
+
+    def check_databases(self):
+        # Drops the series whose database changed since it was loaded, and the results calculated with them
+        # Series loaded before the service started (so without a stamp of their load) are stamped on the first check
+        for series_name in list(registry.series):
+            if series_name not in self.stamps:
+                self.stamps[series_name] = self.database_stamp(registry.series_path(series_name))
+        if registry.calendars and None not in self.stamps:
+            self.stamps[None] = self.database_stamp(registry.holidays_path())
+
+        changed = []
+        for series_name, stamp in list(self.stamps.items()):
+            path = registry.holidays_path() if series_name is None else registry.series_path(series_name)
+            if self.database_stamp(path) != stamp:
+                changed.append(series_name)
+
+        if not changed:
+            return(changed)
+
+        for series_name in changed:
+            if series_name is None:
+                # A new holidays file changes the calendars, and so every calculation
+                registry.set_data_dir(registry.data_dir)
+                ir.invalidate_accum_cache()
+                self.stamps = {}
+                break
+            # The stamp is taken again when the series is loaded again
+            self.stamps.pop(series_name, None)
+            registry.invalidate_series(series_name)
+            ir.invalidate_accum_cache(series_name)
+
+        self.result_cache.clear()
+        self.fx_store = None
+        self.reloads += 1
+        instrument.count('service.reloads')
+        logger.info(json.dumps({'event': 'reload', 'series': [name or 'holidays' for name in changed]}))
+        return(changed)
+
+    async def watch_databases(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                self.check_databases()
+            except Exception as err:
+                logger.error(f'Error checking the databases: {err}')
+
+    # Requests
+
+    def run_handler(self, handler, path, body):
+        # Calculates the response of a query. Runs in a worker thread
+        with instrument.timer(f'service.{path.strip("/")}'):
+            return(json.dumps(handler(json.loads(body))).encode())
+
+    async def dispatch(self, method, path, body):
+        # Returns (status, content type, response body) of a request
+        # The result cache is used only by the event loop. The query is calculated in the pool of worker threads
+        if method == 'GET' and path == '/health':
+            return(200, 'application/json', json.dumps(self.health()).encode())
+        if method == 'GET' and path == '/metrics':
+            return(200, 'text/plain; version=0.0.4', instrument.prometheus_text().encode())
+
+        handler = self.routes.get((method, path))
+        if handler is None:
+            if any(route_path == path for route_method, route_path in self.routes):
+                return(405, 'application/json', json.dumps({'error': f'{path} only answers POST requests'}).encode())
+            return(404, 'application/json', json.dumps({'error': f'Unknown endpoint {path}'}).encode())
+
+        key = (path, body)
+        response = self.result_cache.get(key)
+        if response is not None:
+            self.result_cache.move_to_end(key)
+            instrument.count('service.cache_hit')
+            return(200, 'application/json', response)
+
+        instrument.count('service.cache_miss')
+        reloads = self.reloads
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(self.executor, self.run_handler, handler, path, body)
+        except Exception as err:
+            return(400, 'application/json', json.dumps({'error': str(err)}).encode())
+
+        # A response calculated while the databases were reloaded may use the old series, so it is not cached
+        if reloads != self.reloads:
+            return(200, 'application/json', response)
+        self.result_cache[key] = response
+        if len(self.result_cache) > self.cache_entries:
+            self.result_cache.popitem(last=False)
+        return(200, 'application/json', response)
+
+    async def handle_connection(self, reader, writer):
+        # Answers the requests of one connection. Connections are kept open between requests (HTTP/1.1 keep alive)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > max_body_size:
+                    status, content_type, response = 413, 'application/json', json.dumps({'error': 'Request body too large'}).encode()
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, content_type, response = await self.dispatch(method, target.split('?')[0], body)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                writer.write(f'HTTP/1.1 {status} {status_texts[status]}\r\nContent-Type: {content_type}\r\n'
+                             f'Content-Length: {len(response)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode())
+                writer.write(response)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='service')
+        registry.load_hooks.append(self.database_loaded)
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.watcher = asyncio.create_task(self.watch_databases())
+        logger.info(json.dumps({'event': 'start', 'host': self.host, 'port': self.port, 'data_dir': registry.data_dir}))
+        return(self)
+
+    async def stop(self):
+        self.watcher.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        registry.load_hooks.remove(self.database_loaded)
+        self.executor.shutdown(wait=False)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+
+def run_service(host=default_host, port=default_port, reload_interval=default_reload_interval, cache_entries=default_cache_entries,
+                workers=default_workers):
+    # Runs the query service until the process is stopped
+    asyncio.run(QueryService(host, port, reload_interval, cache_entries, workers).serve_forever())
@@ -0,0 +1,463 @@
+# This module contains the storage layer used by the load and update functions of the index databases (CDI, Selic, IPCA, BRLUSD)
+# Every database is a dataframe with the dates in the index (TradeDate) and one or more value columns
+# The format is chosen by the extension of the database path:
+#   .csv      - semicolon separated text file, the original format of the databases. Also used to import and export data
+#   .cols     - binary columnar format: a directory with raw files per column (int64 dates and float64 values) and a json file
+#               with the columns and the segments of rows. Each append writes only its rows (and the rows they replace, e.g. the
+#               placeholder row of the last update) to a new segment of files. Loads of a single segment are memory mapped (zero copy)
+#   .parquet  - Parquet file (needs pyarrow)
+#   .feather  - Feather file (needs pyarrow)
+# Whole databases are written to a temporary file and renamed over the old one. The .cols format never changes a column file once
+# written: the meta file, renamed over the old one last, switches to the new segments, so a reader (and a frame it already memory
+# mapped) sees either the old or the new version, never a partial one
+# Updates run holding an advisory lock on the database (see locked), so concurrent updaters of the same database run one at a time
+# Every update through commit_series is a new version of the database. The rows it replaced are saved in the versions directory
+# next to the database (<database>.versions), and read_series(..., version=n) rebuilds any previous version from them
+
+import os
+import sys
+import io
+import json
+import time
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+index_name = 'TradeDate'
+meta_file = 'meta.json'
+versions_file = 'versions.json'
+# Segments of a .cols database before its appends merge them (see write_cols)
+max_segments = 8
+
+# Locks held by the current thread: lock path -> (open lock file, number of nested locked() blocks)
+held_locks = threading.local()
+
+
+def storage_format(db_path):
+    # Returns the storage format of db_path based on its extension
+    ext = os.path.splitext(str(db_path).rstrip('/\\'))[1].lower()
+    formats = {'.csv': 'csv', '.cols': 'cols', '.parquet': 'parquet', '.feather': 'feather'}
+    try:
+        return(formats[ext])
+    except KeyError:
+        raise Exception(f'Unknown storage format for {db_path}. Use one of: {", ".join(formats)}')
+
+def read_series(db_path, dtypes, mmap=True, version=None):
+    # Reads the database in db_path to a dataframe with the columns in dtypes (dict column -> dtype)
+    # For the .cols format, mmap=True maps the files in memory instead of reading them (the dataframe is read only)
+    # version pins a version of the database (see list_versions). None reads the current version
+    # The version read is kept in df.attrs['version'] (used e.g. by the cache of ir_calc)
+    if version is not None:
+        df = read_version(db_path, dtypes, version)
+        df.attrs['version'] = version
+        return(df)
+
+    fmt = storage_format(db_path)
+
+    if fmt == 'csv':
+        df = pd.read_csv(db_path, delimiter=';', dtype=dtypes, index_col=index_name, float_precision='round_trip')
+        df.index = pd.to_datetime(df.index, format='%Y-%m-%d')
+    elif fmt == 'cols':
+        df = read_cols(db_path, mmap)
+    elif fmt == 'parquet':
+        df = pd.read_parquet(db_path)
+    else:
+        df = pd.read_feather(db_path).set_index(index_name)
+
+    df.index.name = index_name
+    # Columns in dtypes that are not stored in the database (e.g. columns added after it was created) are left out
+    if list(df.columns) != list(dtypes):
+        df = df[[column for column in dtypes if column in df.columns]]
+    df.attrs['version'] = current_version(db_path)
+
+    return(df)
+
+def tmp_path(db_path):
+    # Temporary file where a new version of db_path is written before it is renamed to db_path
+    return(str(db_path).rstrip('/\\') + '.tmp')
+
+def write_series(df, db_path):
+    # Writes the whole dataframe df to db_path, replacing its contents
+    fmt = storage_format(db_path)
+
+    if fmt == 'cols':
+        write_cols(df, db_path, 0)
+        return
+
+    new_path = tmp_path(db_path)
+    if fmt == 'csv':
+        df.to_csv(new_path, sep=';', header=list(df.columns), index_label=index_name)
+    elif fmt == 'parquet':
+        df.rename_axis(index_name).to_parquet(new_path)
+    else:
+        df.rename_axis(index_name).reset_index().to_feather(new_path)
+    os.replace(new_path, db_path)
+
+def append_series(df_new, db_path, from_row=None):
+    # Stores the rows of df_new after the first from_row rows of the database in db_path (after all the rows, if from_row is None)
+    # Rows of the database from position from_row onwards are replaced by df_new
+    # The .cols format writes only the rows of df_new. csv files are not parsed: the bytes up to the line of from_row are copied to
+    # the temporary file, followed by the rows of df_new, and it is renamed over the database. Parquet and Feather files have to be
+    # rewritten.
+    fmt = storage_format(db_path)
+
+    if fmt == 'cols':
+        write_cols(df_new, db_path, num_rows(db_path) if from_row is None else from_row)
+    elif fmt == 'csv':
+        data, line_ends = csv_lines(db_path)
+        offset, missing_newline = csv_row_offset(data, line_ends, from_row)
+        new_path = tmp_path(db_path)
+        with open(new_path, 'wb') as csv_file:
+            data[:offset].tofile(csv_file)
+            if missing_newline:
+                csv_file.write(b'\n')
+            csv_file.write(df_new.to_csv(sep=';', header=False).encode())
+        os.replace(new_path, db_path)
+    else:
+        df = read_series(db_path, dict(df_new.dtypes), mmap=False)
+        if from_row is not None:
+            df = df.iloc[:from_row]
+        write_series(pd.concat([df, df_new]), db_path)
+
+def csv_lines(db_path):
+    # Returns the bytes of the csv file in db_path and the positions of its line breaks
+    data = np.fromfile(db_path, dtype=np.uint8)
+    return(data, np.flatnonzero(data == ord('\n')))
+
+def csv_row_offset(data, line_ends, row=None):
+    # Returns the byte offset where the line of row starts in the csv file (the first line is the header), or the end of the file
+    # if row is None or after the last row. Also tells if the file does not end with a line break
+    if row is not None and row < len(line_ends):
+        return(int(line_ends[row]) + 1, False)
+    return(len(data), len(data) > 0 and data[-1] != ord('\n'))
+
+def csv_num_rows(data, line_ends):
+    # Number of rows of the csv file: its lines, but the header
+    lines = len(line_ends) + int(len(data) > 0 and data[-1] != ord('\n'))
+    return(max(lines - 1, 0))
+
+def num_rows(db_path):
+    # Returns the number of rows stored in db_path
+    fmt = storage_format(db_path)
+    if fmt == 'cols':
+        return(read_meta(db_path)['rows'])
+    if fmt == 'csv':
+        return(csv_num_rows(*csv_lines(db_path)))
+    return(len(read_series(db_path, {}, mmap=False)))
+
+def empty_series(columns):
+    return(pd.DataFrame({column: pd.Series(dtype=float) for column in columns}, index=pd.DatetimeIndex([], name=index_name)))
+
+def read_rows(db_path, columns, from_row):
+    # Reads the rows of the database in db_path from position from_row on, as float columns. The .cols and csv formats do not load
+    # the rows before from_row
+    fmt = storage_format(db_path)
+
+    if fmt == 'cols':
+        return(read_cols(db_path, mmap=False, from_row=from_row))
+    if fmt == 'csv':
+        data, line_ends = csv_lines(db_path)
+        offset = csv_row_offset(data, line_ends, from_row)[0]
+        if offset >= len(data):
+            return(empty_series(columns))
+        df = pd.read_csv(io.BytesIO(data[offset:].tobytes()), delimiter=';', header=None, names=[index_name] + list(columns),
+                         index_col=index_name, dtype={column: float for column in columns}, float_precision='round_trip')
+        df.index = pd.to_datetime(df.index, format='%Y-%m-%d')
+        return(df)
+    return(read_series(db_path, {column: float for column in columns}, mmap=False).iloc[from_row:])
+
+def stored_columns(db_path):
+    # Returns the list of value columns stored in db_path
+    fmt = storage_format(db_path)
+
+    if fmt == 'csv':
+        return([column for column in pd.read_csv(db_path, delimiter=';', nrows=0).columns if column != index_name])
+    if fmt == 'cols':
+        return(list(read_meta(db_path)['columns']))
+    if fmt == 'parquet':
+        return(list(pd.read_parquet(db_path).columns))
+    return([column for column in pd.read_feather(db_path).columns if column != index_name])
+
+# Locking
+
+def lock_path(db_path):
+    return(str(db_path).rstrip('/\\') + '.lock')
+
+def acquire_file_lock(lock_file):
+    # Blocks until this process holds the exclusive lock of lock_file
+    if sys.platform == 'win32':
+        import msvcrt
+        while True:
+            try:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK gives up after 10 seconds
+                time.sleep(0.1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+def release_file_lock(lock_file):
+    if sys.platform == 'win32':
+        import msvcrt
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+@contextmanager
+def locked(db_path):
+    # Holds the advisory lock of the database in db_path (a <database>.lock file) inside the with block
+    # The lock is exclusive between processes and between threads. A thread that already holds the lock can enter the block again
+    path = lock_path(db_path)
+    if not hasattr(held_locks, 'paths'):
+        held_locks.paths = {}
+
+    if path in held_locks.paths:
+        lock_file, depth = held_locks.paths[path]
+        held_locks.paths[path] = (lock_file, depth + 1)
+    else:
+        lock_file = open(path, 'a+')
+        try:
+            acquire_file_lock(lock_file)
+        except:
+            lock_file.close()
+            raise
+        held_locks.paths[path] = (lock_file, 1)
+
+    try:
+        yield
+    finally:
+        lock_file, depth = held_locks.paths[path]
+        if depth > 1:
+            held_locks.paths[path] = (lock_file, depth - 1)
+        else:
+            del held_locks.paths[path]
+            try:
+                release_file_lock(lock_file)
+            finally:
+                lock_file.close()
+
+# Versions
+
+def versions_path(db_path):
+    # Directory with the versions of the database in db_path
+    return(str(db_path).rstrip('/\\') + '.versions')
+
+def read_versions(db_path):
+    # Returns the versions of the database: the current version and, for each previous version, the rows replaced by the next one
+    try:
+        with open(os.path.join(versions_path(db_path), versions_file)) as versions:
+            return(json.load(versions))
+    except FileNotFoundError:
+        return({'current': 1, 'versions': []})
+
+def write_versions(db_path, versions):
+    path = os.path.join(versions_path(db_path), versions_file)
+    with open(path + '.tmp', 'w') as tmp:
+        json.dump(versions, tmp, indent=1)
+    os.replace(path + '.tmp', path)
+
+def delta_path(db_path, version):
+    # File with the rows of version that were replaced by the next version
+    return(os.path.join(versions_path(db_path), f'v{version}.csv'))
+
+def save_delta(db_path, replaced, rows, from_row, columns, last_date, ref_date=None):
+    # Saves the rows of the current version of the database (rows rows, up to last_date) replaced from position from_row, and moves
+    # the database to a new version
+    os.makedirs(versions_path(db_path), exist_ok=True)
+    versions = read_versions(db_path)
+    version = versions['current']
+    write_series(replaced, delta_path(db_path, version))
+
+    versions['versions'].append({'version': version, 'rows': rows, 'from_row': from_row, 'columns': columns,
+                                 'last_date': None if last_date is None else last_date.strftime('%Y-%m-%d'),
+                                 'ref_date': None if ref_date is None else pd.Timestamp(ref_date).strftime('%Y-%m-%d'),
+                                 'replaced': pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')})
+    versions['current'] = version + 1
+    write_versions(db_path, versions)
+
+def commit_series(df_new, db_path, from_row=None, ref_date=None):
+    # Writes the rows of df_new to the database in db_path as a new version (see append_series for from_row, 0 writes the whole database)
+    # The rows replaced are saved, so the previous version can still be read. ref_date (e.g. the date of the new data) is kept with it
+    # Only the rows from from_row on are read. They are saved, and the version moves on, after the new rows are in place, so a
+    # write that fails leaves both the database and its versions as they were
+    with locked(db_path):
+        if not os.path.exists(db_path):
+            write_series(df_new, db_path)
+            return
+
+        columns = stored_columns(db_path)
+        rows = num_rows(db_path)
+        from_row = rows if from_row is None else int(min(from_row, rows))
+        # Writing different columns (e.g. a column added to the database) replaces all the rows
+        if columns != list(df_new.columns):
+            from_row = 0
+
+        # The row before from_row is read too, for the last date of a database whose rows are all kept
+        first = max(from_row - 1, 0)
+        tail = read_rows(db_path, columns, first)
+        last_date = tail.index[-1] if len(tail) else None
+
+        if from_row == 0:
+            write_series(df_new, db_path)
+        else:
+            append_series(df_new, db_path, from_row)
+        save_delta(db_path, tail.iloc[from_row - first:], rows, from_row, columns, last_date, ref_date)
+
+def list_versions(db_path):
+    # Returns a dataframe with the versions of the database: number of rows, last date and when it was replaced (NaN for the current one)
+    versions = read_versions(db_path)
+    rows = [{key: entry[key] for key in ('version', 'rows', 'last_date', 'ref_date', 'replaced')} for entry in versions['versions']]
+    rows.append({'version': versions['current'], 'rows': num_rows(db_path), 'last_date': None, 'ref_date': None, 'replaced': None})
+    return(pd.DataFrame(rows).set_index('version'))
+
+def current_version(db_path):
+    return(read_versions(db_path)['current'])
+
+def read_version(db_path, dtypes, version):
+    # Rebuilds version of the database from the current version, putting back the rows replaced by each newer version
+    versions = read_versions(db_path)
+    if version == versions['current']:
+        return(read_series(db_path, dtypes, mmap=False))
+
+    entries = {entry['version']: entry for entry in versions['versions']}
+    if version not in entries:
+        raise Exception(f'Version {version} of {db_path} not found. Versions available: 1 to {versions["current"]}')
+
+    df = read_series(db_path, {column: float for column in stored_columns(db_path)}, mmap=False)
+    for newer in range(versions['current'] - 1, version - 1, -1):
+        entry = entries[newer]
+        delta = read_series(delta_path(db_path, newer), {column: float for column in entry['columns']}, mmap=False)
+        df = delta if entry['from_row'] == 0 else pd.concat([df.iloc[:entry['from_row']], delta[list(df.columns)]])
+
+    df.index.name = index_name
+    return(df[[column for column in dtypes if column in df.columns]].astype({column: dtype for column, dtype in dtypes.items() if column in df.columns}))
+
+def convert_series(src_path, dst_path, dtypes):
+    # Copies the database in src_path to dst_path, converting it to the format of dst_path. Used to import and export csv files
+    write_series(read_series(src_path, dtypes, mmap=False), dst_path)
+
+# Binary columnar format (.cols)
+
+def read_meta(db_path):
+    # Reads the description (columns, dtypes and number of rows) of a .cols database
+    with open(os.path.join(db_path, meta_file)) as meta:
+        return(json.load(meta))
+
+def write_meta(db_path, meta):
+    # Writes the description of a .cols database. The file is replaced only after the new version is completely written
+    tmp_path = os.path.join(db_path, meta_file + '.tmp')
+    with open(tmp_path, 'w') as tmp:
+        json.dump(meta, tmp)
+    os.replace(tmp_path, os.path.join(db_path, meta_file))
+
+def cols_segments(meta):
+    # Segments of a .cols database: list of {'rows': number of rows used, 'files': {column: file}}. Databases written before the
+    # segments have one, with the files of their generation (<column>.bin before the generations of column files)
+    if 'segments' in meta:
+        return(meta['segments'])
+    columns = [index_name] + list(meta['columns'])
+    return([{'rows': meta['rows'], 'files': {column: meta.get('files', {}).get(column, column + '.bin') for column in columns}}])
+
+def read_column(path, dtype, rows, mmap, offset=0):
+    # Reads (or maps in memory) rows values of the raw array of a column, from position offset
+    if rows == 0:
+        return(np.empty(0, dtype=dtype))
+    byte_offset = offset * np.dtype(dtype).itemsize
+    if mmap:
+        return(np.memmap(path, dtype=dtype, mode='r', offset=byte_offset, shape=(rows,)))
+    return(np.fromfile(path, dtype=dtype, count=rows, offset=byte_offset))
+
+def read_cols(db_path, mmap=True, from_row=0):
+    # Reads the rows of a .cols database from position from_row on. With mmap=True a single segment is mapped in memory (zero
+    # copy, the dataframe is read only). The rows of several segments are read and concatenated
+    meta = read_meta(db_path)
+    dtypes = {index_name: 'int64', **meta['columns']}
+
+    parts = {column: [] for column in dtypes}
+    start = 0
+    for segment in cols_segments(meta):
+        first = max(from_row - start, 0)
+        if first < segment['rows']:
+            for column, dtype in dtypes.items():
+                parts[column].append(read_column(os.path.join(db_path, segment['files'][column]), dtype, segment['rows'] - first, mmap, first))
+        start += segment['rows']
+
+    data = {}
+    for column, arrays in parts.items():
+        if len(arrays) == 1:
+            data[column] = arrays[0]
+        else:
+            data[column] = np.concatenate(arrays) if arrays else np.empty(0, dtype=dtypes[column])
+
+    dates = data.pop(index_name).view('datetime64[ns]')
+    return(pd.DataFrame(data, index=pd.DatetimeIndex(dates, copy=False, name=index_name), copy=False))
+
+def write_cols(df, db_path, from_row):
+    # Writes the rows of df at position from_row, replacing the rows stored from it on
+    # The rows of df go to a new segment of column files, and the meta file, replaced last, switches to the segments kept plus the
+    # new one. Rows replaced are only left out of the segment that has them, its files are not changed, so a reader keeps seeing the
+    # version it loaded. from_row 0 writes the database as a single segment. Appends that would go over max_segments merge the
+    # segments after the first one with the new rows, so the first (and largest) one is not copied
+    # Files that are neither in the new nor in the previous segments are removed, the previous ones may still be opened by readers
+    os.makedirs(db_path, exist_ok=True)
+    old_meta = read_meta(db_path) if os.path.exists(os.path.join(db_path, meta_file)) else None
+
+    segments = []
+    if from_row > 0:
+        if list(old_meta['columns']) != list(df.columns):
+            raise Exception(f'Columns {list(df.columns)} do not match the columns of {db_path}')
+        meta = dict(old_meta)
+        meta.pop('files', None)
+
+        start = 0
+        for segment in cols_segments(old_meta):
+            if start >= from_row:
+                break
+            segments.append({'rows': min(segment['rows'], from_row - start), 'files': segment['files']})
+            start += segment['rows']
+
+        if len(segments) >= max_segments:
+            first_rows = segments[0]['rows']
+            kept_rows = sum(segment['rows'] for segment in segments)
+            merged = read_cols(db_path, mmap=False, from_row=first_rows).iloc[:kept_rows - first_rows]
+            df = pd.concat([merged, df[list(merged.columns)]])
+            segments = segments[:1]
+    else:
+        meta = {'index': index_name, 'columns': {column: df[column].dtype.str for column in df.columns},
+                'generation': old_meta.get('generation', 0) if old_meta else 0}
+
+    if len(df) > 0:
+        columns = {index_name: df.index.values.astype('datetime64[ns]').view('int64')}
+        for column, dtype in meta['columns'].items():
+            columns[column] = df[column].values.astype(dtype)
+
+        meta['generation'] = meta.get('generation', 0) + 1
+        files = {column: f'{column}.{meta["generation"]}.bin' for column in columns}
+        for column, values in columns.items():
+            with open(os.path.join(db_path, files[column]), 'wb') as col_file:
+                values.tofile(col_file)
+        segments.append({'rows': int(len(df)), 'files': files})
+
+    meta['segments'] = segments
+    meta['rows'] = int(sum(segment['rows'] for segment in segments))
+    write_meta(db_path, meta)
+
+    if old_meta is not None:
+        remove_old_generations(db_path, meta, old_meta)
+
+def remove_old_generations(db_path, meta, old_meta):
+    # Removes the column files that are neither in the current nor in the previous segments
+    keep = {meta_file} | {file_name for segment in cols_segments(meta) + cols_segments(old_meta) for file_name in segment['files'].values()}
+    for file_name in os.listdir(db_path):
+        if file_name.endswith('.bin') and file_name not in keep:
+            try:
+                os.remove(os.path.join(db_path, file_name))
+            except OSError:
+                # A file still mapped by a reader can not be removed on Windows. It is removed by a later update
+                pass
@@ -0,0 +1,149 @@
+# Local stub of the BCB (SGS) and IBGE apis, serving the json payloads stored in the fixtures directory
+# Fixtures are named bcb_<series id>.json (the list of {"data", "valor"} of the series, as the SGS answers) and
+# ibge_<variable id>.json (the answer of the IBGE aggregate 1737 for the variable, with the months available in its "serie")
+# Each query is answered with the values of the fixture inside the requested dates or months. As the SGS does, a window with
+# no values is answered with 404. Failures of the server can be scheduled with fail()
+#
+# Usage:
+#   with StubServer() as stub:
+#       bacen.bacen_api_url, ibge.ibge_api_url = stub.bacen_url, stub.ibge_url
+#       ...
+
+import os
+import json
+import threading
+import urllib.parse
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        status, body = self.server.stub.answer(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer:
+    # Threaded HTTP server on a free local port. requests keeps (path, status) of every request answered
+
+    def __init__(self, fixtures=fixtures_dir):
+        self.fixtures = fixtures
+        self.requests = []
+        # Scheduled failures: list of [path prefix, status, remaining times (None for always)]
+        self.failures = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    def __enter__(self):
+        return(self.start())
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.stub = self
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return(self)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def base_url(self):
+        return(f'http://127.0.0.1:{self.server.server_address[1]}')
+
+    @property
+    def bacen_url(self):
+        # Value for bacen.bacen_api_url
+        return(self.base_url + '/bcb/sgs.{series_id}/dados?formato=json&dataInicial={start_date:%d/%m/%Y}&dataFinal={end_date:%d/%m/%Y}')
+
+    @property
+    def ibge_url(self):
+        # Value for ibge.ibge_api_url
+        return(self.base_url + '/ibge/agregados/1737/periodos/{date_list}/variaveis/{series_id}?localidades=N1[all]')
+
+    def fail(self, path_prefix, status=503, times=1):
+        # Answers the next times requests whose path starts with path_prefix with status (every request, if times is None)
+        with self.lock:
+            self.failures.append([path_prefix, status, times])
+
+    def count(self, path_prefix, status=None):
+        # Number of requests answered whose path starts with path_prefix (and were answered with status, if given)
+        with self.lock:
+            return(sum(1 for path, answer in self.requests if path.startswith(path_prefix) and status in (None, answer)))
+
+    def scheduled_failure(self, path):
+        with self.lock:
+            for failure in self.failures:
+                prefix, status, times = failure
+                if path.startswith(prefix) and times != 0:
+                    if times is not None:
+                        failure[2] = times - 1
+                    return(status)
+        return(None)
+
+    def load_fixture(self, name):
+        try:
+            with open(os.path.join(self.fixtures, name), encoding='utf-8') as fixture:
+                return(json.load(fixture))
+        except FileNotFoundError:
+            return(None)
+
+    def answer(self, path):
+        # Returns (status, body) of the request of path
+        status = self.scheduled_failure(path)
+        if status is not None:
+            body = b''
+        elif path.startswith('/bcb/'):
+            status, body = self.answer_bacen(path)
+        elif path.startswith('/ibge/'):
+            status, body = self.answer_ibge(path)
+        else:
+            status, body = 404, b''
+
+        with self.lock:
+            self.requests.append((path, status))
+        return(status, body)
+
+    def answer_bacen(self, path):
+        parts = urllib.parse.urlsplit(path)
+        series_id = parts.path.split('sgs.')[1].split('/')[0]
+        query = urllib.parse.parse_qs(parts.query)
+        start_date = pd.to_datetime(query['dataInicial'][0], format='%d/%m/%Y')
+        end_date = pd.to_datetime(query['dataFinal'][0], format='%d/%m/%Y')
+
+        rows = self.load_fixture(f'bcb_{series_id}.json')
+        if rows is None:
+            return(404, b'')
+        rows = [row for row in rows if start_date <= pd.to_datetime(row['data'], format='%d/%m/%Y') <= end_date]
+        if not rows:
+            return(404, b'')
+        return(200, json.dumps(rows).encode())
+
+    def answer_ibge(self, path):
+        # /ibge/agregados/1737/periodos/<months>/variaveis/<variable>
+        parts = urllib.parse.unquote(urllib.parse.urlsplit(path).path).split('/')
+        months = set(parts[5].split('|'))
+        variable = parts[7]
+
+        payload = self.load_fixture(f'ibge_{variable}.json')
+        if payload is None:
+            return(500, b'')
+        for result in payload[0]['resultados']:
+            for series in result['series']:
+                series['serie'] = {month: value for month, value in series['serie'].items() if month in months}
+        return(200, json.dumps(payload).encode())
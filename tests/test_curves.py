@@ -0,0 +1,99 @@
+# Tests of curves.PreCurve: DI1 vertices, flat-forward 252 interpolation, forward rates, the splice of the realized CDI with the
+# projected part and the roll of a curve date that is not a business day
+# The calendar and the CDI are the synthetic databases of the benchmarks, up to 2022-09-01
+#
+# Usage (from the root of the repository):
+#   python -m pytest tests
+#   python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import synthetic
+import registry
+import br_workdays as wd
+import cdi
+import curves
+
+curve_date = pd.Timestamp('2022-08-01')
+maturities = pd.DatetimeIndex(['2022-10-03', '2023-01-02', '2024-01-02'])
+rates = np.array([0.1350, 0.1375, 0.1290])
+
+
+class PreCurveTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp(prefix='curry_test_')
+        synthetic.generate(cls.data_dir, years=2)
+        registry.set_data_dir(cls.data_dir)
+
+        cls.bdays = np.array([wd.num_br_bdays(curve_date, maturity) for maturity in maturities])
+        prices = curves.di1_notional / (1 + rates) ** (cls.bdays / 252)
+        cls.curve = curves.PreCurve.from_di1(curve_date, maturities, prices)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def test_vertices(self):
+        # The DI1 prices give back the rates and discount factors of the vertices
+        np.testing.assert_allclose(self.curve.rate(maturities), rates, rtol=1e-12)
+        np.testing.assert_allclose(self.curve.discount(maturities), (1 + rates) ** (-self.bdays / 252), rtol=1e-12)
+
+    def test_flat_forward(self):
+        # Between two vertices the log of the discount factor is linear in business days, so the forward rate is constant
+        days = wd.list_of_br_bdays(maturities[0], maturities[1])
+        bdays = np.array([wd.num_br_bdays(curve_date, day) for day in days])
+        discounts = self.curve.discount(days)
+
+        weights = (bdays - self.bdays[0]) / (self.bdays[1] - self.bdays[0])
+        vertex_discounts = (1 + rates[:2]) ** (-self.bdays[:2] / 252)
+        np.testing.assert_allclose(discounts, vertex_discounts[0] * (vertex_discounts[1] / vertex_discounts[0]) ** weights, rtol=1e-12)
+
+        forward = (vertex_discounts[0] / vertex_discounts[1]) ** (252 / (self.bdays[1] - self.bdays[0])) - 1
+        np.testing.assert_allclose(self.curve.forward_rate(days[:-1], days[1:]), forward, rtol=1e-10)
+        np.testing.assert_allclose(self.curve.forward_rate(maturities[:1], maturities[1:2]), forward, rtol=1e-12)
+
+    def test_after_last_vertex(self):
+        # The forward rate of the last segment is kept after the last vertex
+        last_forward = self.curve.forward_rate(maturities[1:2], maturities[2:3])
+        later = pd.DatetimeIndex(['2024-07-01', '2025-01-02'])
+        np.testing.assert_allclose(self.curve.forward_rate(maturities[2:3], later[:1]), last_forward, rtol=1e-10)
+        np.testing.assert_allclose(self.curve.forward_rate(later[:1], later[1:]), last_forward, rtol=1e-10)
+
+    def test_accum_splice(self):
+        # An interval that starts before the curve date uses the realized CDI up to it and the curve after it
+        df_cdi = registry.get_series('CDI')
+        start, end = pd.Timestamp('2022-03-02'), pd.Timestamp('2023-06-01')
+        for percentage in (1.0, 1.1):
+            realized = cdi.cdi_accum(df_cdi, start, curve_date, percentage)
+            projected = self.curve.forward_accum(curve_date, end, percentage)
+            np.testing.assert_allclose(self.curve.accum(df_cdi, [start], [end], percentage), realized * projected, rtol=1e-13)
+
+        # Intervals all before or all after the curve date
+        np.testing.assert_allclose(self.curve.accum(df_cdi, [start], [curve_date]), cdi.cdi_accum(df_cdi, start, curve_date), rtol=1e-13)
+        np.testing.assert_allclose(self.curve.accum(df_cdi, [maturities[0]], [end]), self.curve.forward_accum(maturities[0], end), rtol=1e-13)
+
+    def test_curve_date_roll(self):
+        # A curve dated on a Saturday is the curve of the following Monday
+        saturday = curves.PreCurve(pd.Timestamp('2022-07-30'), maturities, rates)
+        monday = curves.PreCurve(curve_date, maturities, rates)
+        self.assertEqual(saturday.curve_date, curve_date)
+        np.testing.assert_array_equal(saturday.discount(maturities), monday.discount(maturities))
+
+        df_cdi = registry.get_series('CDI')
+        start, end = ['2022-03-02'], ['2023-06-01']
+        np.testing.assert_array_equal(saturday.accum(df_cdi, start, end), monday.accum(df_cdi, start, end))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+# Tests of ipca: the batch accrual (ipca_accum_batch) against the scalar ipca_accum
+# The IPCA is the synthetic database of the benchmarks, with months from 2020-09 to 2022-09
+#
+# Usage (from the root of the repository):
+#   python -m pytest tests
+#   python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import synthetic
+import registry
+import storage
+import ipca
+
+
+class IpcaAccumBatchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp(prefix='curry_test_')
+        synthetic.generate(cls.data_dir, years=2)
+        registry.set_data_dir(cls.data_dir)
+        cls.ipca = registry.get_series('IPCA')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def test_batch_matches_scalar(self):
+        # Random intervals (some of them empty) with every combination of reset day and accrual type. Reset day 0 is the day of the
+        # end date, which must exist in the months of the accruals, so the dates are up to the 28th
+        rng = np.random.default_rng(5)
+        days = pd.date_range('2020-10-20', '2022-07-31')
+        days = days[days.day <= 28]
+        st = rng.integers(0, len(days), 200)
+        end = np.minimum(st + rng.integers(0, 400, 200), len(days) - 1)
+        end[:5] = st[:5]
+        start_dates, end_dates = days[st], days[end]
+
+        for reset_day in (0, 15):
+            for accrual_type in ('cd', 'bd'):
+                batch = ipca.ipca_accum_batch(self.ipca, start_dates, end_dates, reset_day, accrual_type)
+                scalar = [ipca.ipca_accum(self.ipca, start, end_date, reset_day, accrual_type) for start, end_date in zip(start_dates, end_dates)]
+                np.testing.assert_allclose(batch, scalar, rtol=1e-15, atol=0)
+
+        # One reset day and accrual type per interval
+        reset_days = rng.choice([0, 15], len(st))
+        accrual_types = rng.choice(['cd', 'bd'], len(st))
+        batch = ipca.ipca_accum_batch(self.ipca, start_dates, end_dates, reset_days, accrual_types)
+        scalar = [ipca.ipca_accum(self.ipca, start, end_date, reset_day, accrual_type)
+                  for start, end_date, reset_day, accrual_type in zip(start_dates, end_dates, reset_days, accrual_types)]
+        np.testing.assert_allclose(batch, scalar, rtol=1e-15, atol=0)
+
+    def test_error_rows(self):
+        # Rows that the scalar function rejects make the batch fail too
+        valid = (pd.Timestamp('2021-01-10'), pd.Timestamp('2021-06-10'), 0, 'cd')
+        errors = [(pd.Timestamp('2021-06-10'), pd.Timestamp('2021-01-10'), 0, 'cd'),
+                  (pd.Timestamp('2019-01-10'), pd.Timestamp('2021-06-10'), 0, 'cd'),
+                  (pd.Timestamp('2021-01-10'), pd.Timestamp('2023-06-10'), 0, 'bd'),
+                  (pd.Timestamp('2021-01-10'), pd.Timestamp('2021-06-10'), 0, 'xx'),
+                  (pd.Timestamp('2021-04-10'), pd.Timestamp('2021-06-10'), 31, 'cd')]
+
+        for row in errors:
+            with self.assertRaises(Exception):
+                ipca.ipca_accum(self.ipca, *row)
+            start_dates, end_dates, reset_days, accrual_types = zip(valid, row)
+            with self.assertRaises(Exception):
+                ipca.ipca_accum_batch(self.ipca, pd.DatetimeIndex(start_dates), pd.DatetimeIndex(end_dates), np.array(reset_days),
+                                      np.array(accrual_types))
+
+    def test_empty_batch(self):
+        self.assertEqual(len(ipca.ipca_accum_batch(self.ipca, pd.DatetimeIndex([]), pd.DatetimeIndex([]))), 0)
+
+
+class NoProjectionsTest(unittest.TestCase):
+    # Databases without projected months: the synthetic one (official rates and the placeholder month) and the same database
+    # without its placeholder month, where every rate is official
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='curry_test_')
+        synthetic.generate(self.data_dir, years=2)
+        registry.set_data_dir(self.data_dir)
+        self.db_path = registry.series_path('IPCA')
+        self.proj_path = os.path.join(self.data_dir, 'IPCA_proj.csv')
+        self.ipca = ipca.load_ipca(self.db_path, mmap=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def write_official(self):
+        official = self.ipca.iloc[:-1]
+        storage.write_series(official, self.db_path)
+        return(official)
+
+    def test_official_rows(self):
+        self.assertEqual(ipca.first_unofficial_row(self.ipca), len(self.ipca) - 1)
+        self.assertEqual(ipca.last_official_date(self.ipca), pd.Timestamp('2022-09-01'))
+
+        official = self.write_official()
+        self.assertEqual(ipca.first_unofficial_row(official), len(official))
+        self.assertEqual(ipca.last_official_date(official), pd.Timestamp('2022-08-01'))
+
+    def test_accum_without_projections(self):
+        # With no projected months, use_projections does not change the dates available or the results
+        official = self.write_official()
+        for df in (self.ipca, official):
+            end_date = df.index[-1]
+            self.assertEqual(ipca.ipca_accum(df, pd.Timestamp('2021-01-10'), end_date, use_projections=False),
+                             ipca.ipca_accum(df, pd.Timestamp('2021-01-10'), end_date))
+            np.testing.assert_array_equal(ipca.ipca_accum_batch(df, [pd.Timestamp('2021-01-10')], [end_date], use_projections=False),
+                                          ipca.ipca_accum_batch(df, [pd.Timestamp('2021-01-10')], [end_date]))
+
+    def test_apply_without_projections(self):
+        # The placeholder month is rebuilt as it was
+        ipca.apply_ipca_projections(self.db_path, self.proj_path)
+        pd.testing.assert_frame_equal(ipca.load_ipca(self.db_path, mmap=False), self.ipca)
+
+        # A database with only official rates gets the placeholder month after its last rate
+        self.write_official()
+        ipca.apply_ipca_projections(self.db_path, self.proj_path)
+        pd.testing.assert_frame_equal(ipca.load_ipca(self.db_path, mmap=False), self.ipca)
+
+    def test_apply_to_official(self):
+        # Projections of the months after the last official rate of a database with only official rates
+        self.write_official()
+        ipca.save_ipca_projections(pd.Series([0.005, 0.004], index=pd.DatetimeIndex(['2022-09-01', '2022-10-01'])), 'anbima', self.proj_path)
+        ipca.apply_ipca_projections(self.db_path, self.proj_path)
+
+        df = ipca.load_ipca(self.db_path, mmap=False)
+        self.assertEqual(df.index[-3:].tolist(), pd.DatetimeIndex(['2022-09-01', '2022-10-01', '2022-11-01']).tolist())
+        self.assertEqual(df.Source.values[-3:].tolist(), [ipca.projected, ipca.projected, ipca.placeholder])
+        pd.testing.assert_frame_equal(df.iloc[:-3], self.ipca.iloc[:-1])
+        self.assertEqual(df.IPCA.values[-3:].tolist(), [0.005, 0.004, 0.0])
+        self.assertEqual(df.Accum.values[-3:].tolist(), [self.ipca.Accum.iloc[-1], self.ipca.Accum.iloc[-1] * 1.005,
+                                                         self.ipca.Accum.iloc[-1] * 1.005 * 1.004])
+        self.assertEqual(ipca.last_official_date(df), pd.Timestamp('2022-09-01'))
+
+
+if __name__ == '__main__':
+    unittest.main()
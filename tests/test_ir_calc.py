@@ -0,0 +1,74 @@
+# Tests of ir_calc: the exact B3 accumulation against a reference calculated with Python fractions
+#
+# Usage (from the root of the repository):
+#   python -m pytest tests
+#   python -m unittest discover tests
+
+import os
+import sys
+import unittest
+from decimal import Decimal, localcontext, ROUND_HALF_EVEN
+from fractions import Fraction
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ir_calc as ir
+
+
+def reference_daily_rate(rate):
+    # Daily rate (TDI) of the annual rate base 252 rounded to 8 decimals, calculated with 40 digits
+    with localcontext() as ctx:
+        ctx.prec = 40
+        daily = ((1 + Decimal(float(rate))).ln() / 252).exp() - 1
+        return(Fraction(daily.quantize(Decimal('1e-8'), rounding=ROUND_HALF_EVEN)))
+
+def reference_b3_accum(daily_rates, st_pos, end_pos, percentage):
+    # Product of the daily factors 1 + daily rate * percentage from st_pos to end_pos (exclusive), truncated to 16 decimals each day
+    percent = Fraction(round(percentage * 1e8), 10**8)
+    product = Fraction(1)
+    for daily_rate in daily_rates[st_pos:end_pos]:
+        product = Fraction((product * (1 + daily_rate * percent) * 10**16).__floor__(), 10**16)
+    return(product)
+
+
+class B3AccumTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.rates = np.round(rng.uniform(0.02, 0.15, 300), 4)
+        self.daily_rates = [reference_daily_rate(rate) for rate in self.rates]
+        self.st_pos = rng.integers(0, 300, 60)
+        self.end_pos = np.minimum(self.st_pos + rng.integers(0, 250, 60), 300)
+        # Intervals with no days and intervals that share their start
+        self.st_pos[:3], self.end_pos[:3] = [10, 10, 10], [10, 11, 200]
+        self.percentages = rng.choice([1.0, 1.1, 0.85, 1.2345], 60)
+
+    def test_daily_rates(self):
+        self.assertEqual(ir.b3_daily_rates(self.rates).tolist(), [int(daily_rate * 10**8) for daily_rate in self.daily_rates])
+
+    def test_accum_b3_batch(self):
+        units = ir.accum_b3_batch(self.rates, self.st_pos, self.end_pos, self.percentages, units=True)
+        floats = ir.accum_b3_batch(self.rates, self.st_pos, self.end_pos, self.percentages)
+
+        for i in range(len(self.st_pos)):
+            expected = reference_b3_accum(self.daily_rates, self.st_pos[i], self.end_pos[i], self.percentages[i])
+            self.assertEqual(Fraction(int(units[i]), 10**16), expected)
+            self.assertEqual(floats[i], float(expected.numerator // expected.denominator) + float(expected % 1 * 10**16) / 1e16)
+
+    def test_accum_b3_path(self):
+        # The products continued in chunks are the ones of accum_b3_batch from the first row
+        for percentage in (1.0, 1.1):
+            products = []
+            for first in range(0, 300, 70):
+                products += ir.accum_b3_path(self.rates[first:first + 70], percentage, products[-1] if products else 10**16)
+            expected = ir.accum_b3_batch(self.rates, 0, np.arange(1, 301), percentage, units=True)
+            self.assertEqual(products, expected.tolist())
+
+    def test_inverted_interval(self):
+        with self.assertRaises(Exception):
+            ir.accum_b3_batch(self.rates, [5], [4])
+
+
+if __name__ == '__main__':
+    unittest.main()
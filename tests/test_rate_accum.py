@@ -0,0 +1,69 @@
+# Tests of the batch accumulation of the CDI and the Selic (cdi_accum_batch, selic_accum_batch) against the scalar functions
+# The databases are the synthetic ones of the benchmarks, up to 2022-09-01
+#
+# Usage (from the root of the repository):
+#   python -m pytest tests
+#   python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import synthetic
+import registry
+import cdi
+import selic
+
+
+class RateAccumBatchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp(prefix='curry_test_')
+        synthetic.generate(cls.data_dir, years=2)
+        registry.set_data_dir(cls.data_dir)
+        cls.functions = [(registry.get_series('CDI'), cdi.cdi_accum, cdi.cdi_accum_batch),
+                         (registry.get_series('Selic'), selic.selic_accum, selic.selic_accum_batch)]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def test_batch_matches_scalar(self):
+        # Random intervals, with dates that are not business days, for every method and percentages other than 1
+        rng = np.random.default_rng(11)
+        days = pd.date_range('2020-09-10', '2022-08-31')
+        st = rng.integers(0, len(days), 50)
+        end = np.minimum(st + rng.integers(0, 300, 50), len(days) - 1)
+        start_dates, end_dates = days[st], days[end]
+
+        for df, accum, accum_batch in self.functions:
+            for method in ('cumprod', 'log', 'b3'):
+                for percent in (1.0, 1.1):
+                    batch = accum_batch(df, start_dates, end_dates, percent, method)
+                    scalar = [accum(df, start, end_date, percent, method) for start, end_date in zip(start_dates, end_dates)]
+                    np.testing.assert_allclose(batch, scalar, rtol=1e-15, atol=0)
+
+    def test_empty_batch(self):
+        for df, accum, accum_batch in self.functions:
+            result = accum_batch(df, pd.DatetimeIndex([]), pd.DatetimeIndex([]), 1.1)
+            self.assertEqual(result.shape, (0,))
+            self.assertEqual(result.dtype, np.float64)
+            self.assertEqual(accum_batch(df, np.array([], dtype='datetime64[D]'), pd.Timestamp('2022-01-03')).shape, (0,))
+
+    def test_inverted_interval(self):
+        for df, accum, accum_batch in self.functions:
+            for method in ('cumprod', 'log', 'b3'):
+                with self.assertRaises(Exception):
+                    accum_batch(df, [pd.Timestamp('2022-01-10')], [pd.Timestamp('2022-01-03')], 1.1, method)
+
+
+if __name__ == '__main__':
+    unittest.main()
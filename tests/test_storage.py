@@ -0,0 +1,100 @@
+# Tests of the versioned commits of storage.commit_series, for the csv and .cols formats
+#
+# Usage (from the root of the repository):
+#   python -m pytest tests
+#   python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+
+dtypes = {'Rate': float, 'Accum': float}
+
+
+def make_rows(rng, num_rows, first_date):
+    index = pd.bdate_range(first_date, periods=num_rows, name=storage.index_name)
+    return(pd.DataFrame({'Rate': rng.random(num_rows), 'Accum': rng.random(num_rows)}, index=index))
+
+def assert_same_rows(df, expected):
+    # Same dates and values. The resolution of the dates depends on the format
+    pd.testing.assert_frame_equal(df, expected, check_index_type=False, check_freq=False)
+
+
+class CommitSeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='curry_test_')
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def commit_versions(self, db_path, updates=12):
+        # Commits a database and updates that replace the last rows (as the placeholder row) and append new ones
+        # Returns the expected dataframe of every version
+        df = make_rows(self.rng, 50, '2020-01-01')
+        storage.commit_series(df, db_path, 0)
+        expected = [df]
+        for _ in range(updates):
+            from_row = len(df) - int(self.rng.integers(0, 3))
+            new_rows = make_rows(self.rng, int(self.rng.integers(0, 5)), df.index[from_row - 1] + pd.offsets.BDay())
+
+            mapped = storage.read_series(db_path, dtypes, mmap=True)
+            storage.commit_series(new_rows, db_path, from_row)
+            df = pd.concat([df.iloc[:from_row], new_rows])
+            expected.append(df)
+
+            # A frame loaded (or memory mapped) before the commit keeps the version it loaded
+            assert_same_rows(mapped, expected[-2])
+        return(expected)
+
+    def check_versions(self, db_path, expected):
+        assert_same_rows(storage.read_series(db_path, dtypes, mmap=True), expected[-1])
+        self.assertEqual(storage.current_version(db_path), len(expected))
+        for version, df in enumerate(expected, 1):
+            assert_same_rows(storage.read_series(db_path, dtypes, version=version), df)
+
+    def test_versions_csv(self):
+        db_path = os.path.join(self.data_dir, 'CDI.csv')
+        self.check_versions(db_path, self.commit_versions(db_path))
+
+    def test_versions_cols(self):
+        db_path = os.path.join(self.data_dir, 'CDI.cols')
+        expected = self.commit_versions(db_path)
+        self.check_versions(db_path, expected)
+        self.assertLessEqual(len(storage.read_meta(db_path)['segments']), storage.max_segments)
+
+    def test_failed_write_cols(self):
+        # A write that fails before the meta file is switched leaves the database and its versions unchanged
+        db_path = os.path.join(self.data_dir, 'CDI.cols')
+        expected = self.commit_versions(db_path, updates=3)
+
+        with mock.patch.object(storage, 'write_meta', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                storage.commit_series(make_rows(self.rng, 3, '2030-01-01'), db_path, len(expected[-1]) - 1)
+
+        self.check_versions(db_path, expected)
+
+    def test_failed_write_csv(self):
+        # A write that fails before the temporary file is renamed over the database leaves it and its versions unchanged
+        db_path = os.path.join(self.data_dir, 'CDI.csv')
+        expected = self.commit_versions(db_path, updates=3)
+
+        with mock.patch.object(storage.os, 'replace', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                storage.commit_series(make_rows(self.rng, 3, '2030-01-01'), db_path, len(expected[-1]) - 1)
+
+        self.check_versions(db_path, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# Tests of the taxes on redemptions of ir_calc: IR and IOF brackets, the order they are applied and the FIFO matching of lots
+# redeem_lots runs on the synthetic databases of the benchmarks, up to 2022-09-01
+#
+# Usage (from the root of the repository):
+#   python -m pytest tests
+#   python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import synthetic
+import registry
+import ir_calc as ir
+import cdi
+
+
+class TaxRatesTest(unittest.TestCase):
+
+    def test_ir_brackets(self):
+        days = [1, 180, 181, 360, 361, 720, 721, 5000]
+        self.assertEqual(ir.calc_ir_rates(np.array(days)).tolist(), [0.225, 0.225, 0.20, 0.20, 0.175, 0.175, 0.15, 0.15])
+
+    def test_iof_brackets(self):
+        days = [0, 1, 2, 29, 30, 31, 181]
+        self.assertEqual(ir.calc_iof_rates(np.array(days)).tolist(), [1.0, 0.96, 0.93, 0.03, 0.0, 0.0, 0.0])
+
+    def test_iof_before_ir(self):
+        # The IOF is due on the income, and the IR on the income net of the IOF
+        iof, tax = ir.calc_taxes(np.array([100.0, 100.0, 100.0]), np.array([110.0, 110.0, 90.0]), np.array([10, 31, 10]))
+        np.testing.assert_allclose(iof, [10 * 0.66, 0.0, 0.0])
+        np.testing.assert_allclose(tax, [(10 - 10 * 0.66) * 0.225, 10 * 0.225, 0.0])
+
+
+class MatchFifoTest(unittest.TestCase):
+
+    def test_partial_redemptions(self):
+        # Account 1 has lots of 10, 5 and 20 and redeems 12 and then 10. Account 2 has a lot of 7 and redeems 3
+        lots, reds, quantities = ir.match_fifo([1, 1, 1, 2], [10, 5, 20, 7], [1, 1, 2], [12, 10, 3])
+        self.assertEqual(lots.tolist(), [0, 1, 1, 2, 3])
+        self.assertEqual(reds.tolist(), [0, 0, 1, 1, 2])
+        np.testing.assert_allclose(quantities, [10, 2, 3, 7, 3])
+
+    def test_redemption_over_held(self):
+        with self.assertRaises(Exception):
+            ir.match_fifo([1, 1], [10, 5], [1], [16])
+        with self.assertRaises(Exception):
+            ir.match_fifo([1], [10], [2], [1])
+
+
+class RedeemLotsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='curry_test_')
+        synthetic.generate(self.data_dir, years=2)
+        registry.set_data_dir(self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def test_redeem_lots(self):
+        lots = pd.DataFrame({'purchase_date': ['2021-01-04', '2021-06-01', '2022-08-01'], 'quantity': [100.0, 100.0, 100.0],
+                             'cost': [1000.0, 1100.0, 1200.0], 'indexer': 'CDI'}, index=['L1', 'L2', 'L3'])
+        # The first redemption takes all of L1 and half of L2, the second the rest of L2 and 70 of L3, 21 days after its purchase
+        redemptions = pd.DataFrame({'redemption_date': ['2022-01-03', '2022-08-22'], 'quantity': [150.0, 120.0]}, index=['R1', 'R2'])
+
+        result = ir.redeem_lots(lots, redemptions)
+
+        self.assertEqual(result.lot.tolist(), ['L1', 'L2', 'L2', 'L3'])
+        self.assertEqual(result.redemption.tolist(), ['R1', 'R1', 'R2', 'R2'])
+        np.testing.assert_allclose(result.quantity, [100, 50, 50, 70])
+        np.testing.assert_allclose(result.cost, [1000, 550, 550, 840])
+        self.assertEqual(result.holding_days.tolist(), [364, 216, 447, 21])
+
+        df_cdi = registry.get_series('CDI')
+        factors = [cdi.cdi_accum(df_cdi, pd.Timestamp(start), pd.Timestamp(end)) for start, end in
+                   [('2021-01-04', '2022-01-03'), ('2021-06-01', '2022-01-03'), ('2021-06-01', '2022-08-22'), ('2022-08-01', '2022-08-22')]]
+        np.testing.assert_allclose(result.gross, result.cost * factors, rtol=1e-14)
+
+        income = result.gross - result.cost
+        np.testing.assert_allclose(result.iof, [0, 0, 0, income.iloc[3] * 0.30])
+        np.testing.assert_allclose(result.ir, (income - result.iof) * [0.175, 0.20, 0.175, 0.225])
+        np.testing.assert_allclose(result.net, result.gross - result.iof - result.ir)
+
+
+if __name__ == '__main__':
+    unittest.main()
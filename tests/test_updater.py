@@ -0,0 +1,101 @@
+# Tests of updater.update_all_indexes against the local stub of the BCB and IBGE apis (see stub_server.py)
+# The databases are the synthetic ones of the benchmarks, up to 2022-09-01. The fixtures have the values of September 2022
+#
+# Usage (from the root of the repository):
+#   python -m pytest tests
+#   python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+import registry
+import storage
+import bacen
+import ibge
+import updater
+import cdi
+import ipca
+import fxrates
+from stub_server import StubServer
+
+
+class UpdateAllIndexesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='curry_test_')
+        synthetic.generate(self.data_dir, years=2)
+        registry.set_data_dir(self.data_dir)
+        self.db_paths = updater.default_db_paths()
+
+        self.stub = StubServer().start()
+        self.urls = (bacen.bacen_api_url, ibge.ibge_api_url, bacen.max_window_years)
+        bacen.bacen_api_url, ibge.ibge_api_url = self.stub.bacen_url, self.stub.ibge_url
+        # One year windows, so the period from 2022-09-01 to today has windows with no values (answered with 404)
+        bacen.max_window_years = 1
+
+    def tearDown(self):
+        bacen.bacen_api_url, ibge.ibge_api_url, bacen.max_window_years = self.urls
+        self.stub.stop()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def read_bytes(self, path):
+        with open(path, 'rb') as db_file:
+            return(db_file.read())
+
+    def update(self):
+        return(updater.update_all_indexes(self.db_paths, verify=True, max_connections=4, timeout=5, retries=2, backoff=0.01))
+
+    def test_update_all_indexes(self):
+        # The first request of the BRLUSD window with the new values is answered with a server error, and retried
+        self.stub.fail('/bcb/sgs.1/dados?formato=json&dataInicial=01/09/2022', status=503, times=1)
+        # The Selic api is down: its database must not be written
+        self.stub.fail('/bcb/sgs.1178/', status=500, times=None)
+        selic_before = self.read_bytes(self.db_paths['Selic'])
+
+        status = self.update()
+
+        # 21 business days of September 2022 for the daily series, September 2022 (the placeholder month) for the IPCA
+        self.assertEqual(status['CDI'], 21)
+        self.assertEqual(status['BRLUSD'], 21)
+        self.assertEqual(status['IPCA'], 1)
+        self.assertIsInstance(status['Selic'], Exception)
+
+        # Retry of the failed BRLUSD window
+        self.assertEqual(self.stub.count('/bcb/sgs.1/', 503), 1)
+        self.assertEqual(self.stub.count('/bcb/sgs.1/dados?formato=json&dataInicial=01/09/2022'), 2)
+
+        # Windows after September 2022 have no values
+        self.assertGreater(self.stub.count('/bcb/sgs.4389/', 404), 0)
+
+        # The Selic database was not committed
+        self.assertEqual(self.read_bytes(self.db_paths['Selic']), selic_before)
+        self.assertEqual(storage.current_version(self.db_paths['Selic']), 1)
+        self.assertEqual(self.stub.count('/bcb/sgs.1178/dados?formato=json&dataInicial=01/09/2022', 500), 3)
+
+        # The other databases got the new values as a new version
+        df_cdi = cdi.load_cdi(self.db_paths['CDI'], mmap=False)
+        self.assertEqual(df_cdi.index[-1], pd.Timestamp('2022-10-03'))
+        self.assertEqual(df_cdi.Rate.iloc[-2], 0.1365)
+        self.assertEqual(storage.current_version(self.db_paths['CDI']), 2)
+
+        df_brlusd = fxrates.load_brlusd(self.db_paths['BRLUSD'], mmap=False)
+        self.assertEqual(df_brlusd.index[-1], pd.Timestamp('2022-09-30'))
+        self.assertEqual(df_brlusd.BRLUSD.iloc[-1], 5.3980)
+
+        df_ipca = ipca.load_ipca(self.db_paths['IPCA'], mmap=False)
+        self.assertEqual(ipca.last_official_date(df_ipca), pd.Timestamp('2022-10-01'))
+        self.assertAlmostEqual(df_ipca.loc['2022-09-01', 'IPCA'], -0.0029)
+        self.assertEqual(df_ipca.loc['2022-09-01', 'Num_IPCA'], 6370.34)
+
+
+if __name__ == '__main__':
+    unittest.main()
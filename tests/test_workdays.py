@@ -0,0 +1,71 @@
+# Tests of the business day counts of br_workdays against the original loop (pd.bdate_range of the dates moved to the following
+# business day), inside the precomputed range of the calendar and across its boundaries, where numpy's busday functions are used
+# The calendar is the synthetic one of the benchmarks, with holidays from 2019 to 2032
+#
+# Usage (from the root of the repository):
+#   python -m pytest tests
+#   python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import synthetic
+import registry
+import br_workdays as wd
+
+
+def baseline_num_bdays(st_date, end_date, holidays):
+    # Number of business days as the original num_br_bdays calculated it
+    days = np.busday_offset(np.array([st_date, end_date], dtype='datetime64[D]'), 0, roll='forward', holidays=holidays)
+    return(len(pd.bdate_range(start=pd.Timestamp(days[0]), end=pd.Timestamp(days[1]), freq='C', holidays=holidays)) - 1)
+
+
+class NumBdaysTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp(prefix='curry_test_')
+        synthetic.generate(cls.data_dir, years=2)
+        registry.set_data_dir(cls.data_dir)
+        cls.calendar = registry.get_calendar('br')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def check_window(self, first, last):
+        # Every pair (inverted ones too) of a sample of the days between first and last
+        rng = np.random.default_rng(3)
+        days = np.sort(rng.choice(pd.date_range(first, last).values.astype('datetime64[D]'), 30, replace=False))
+        st_days, end_days = [grid.reshape(-1) for grid in np.meshgrid(days, days)]
+
+        expected = [baseline_num_bdays(st, end, self.calendar.holidays) for st, end in zip(st_days, end_days)]
+        scalar = [wd.num_br_bdays(pd.Timestamp(st), pd.Timestamp(end)) for st, end in zip(st_days, end_days)]
+        self.assertEqual(scalar, expected)
+        self.assertEqual(wd.num_br_bdays_array(st_days, end_days).tolist(), expected)
+
+    def test_first_day(self):
+        self.assertEqual(self.calendar.first_day, np.datetime64('2019-01-01'))
+        self.check_window('2018-12-10', '2019-01-20')
+
+    def test_last_day(self):
+        self.assertEqual(self.calendar.last_day, np.datetime64('2032-12-31'))
+        self.check_window('2032-12-10', '2033-01-20')
+
+    def test_inverted_outside(self):
+        # Saturday after Friday, outside the precomputed range: the interval is inverted
+        self.assertEqual(wd.num_br_bdays(pd.Timestamp('2035-12-15'), pd.Timestamp('2035-12-14')), -1)
+        self.assertEqual(wd.num_br_bdays_array(np.array(['2035-12-15'], dtype='datetime64[D]'),
+                                               np.array(['2035-12-14'], dtype='datetime64[D]')).tolist(), [-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# This module updates all the index databases (CDI, Selic, IPCA and BRLUSD) at once
+# The new values of every series are fetched concurrently from the BCB and IBGE apis, then each database is
+# updated with its new values. A database is only written after the fetch of its series succeeded.
+
+import asyncio
+import pandas as pd
+import http_client
+import registry
+import bacen as bc
+import ibge
+import cdi
+import selic
+import ipca
+import fxrates
+
+# Functions that load each database
+loaders = {'CDI': cdi.load_cdi, 'Selic': selic.load_selic, 'IPCA': ipca.load_ipca, 'BRLUSD': fxrates.load_brlusd}
+
+
+def default_db_paths():
+    # Databases of all the series in the registry's data directory
+    return({series_name: registry.series_path(series_name) for series_name in loaders})
+
+def last_stored_date(series_name, db_path):
+    # Returns the last date stored in the database of series_name. The new values are fetched from this date on
+    # For the IPCA, the projected months at the end of the database are fetched again
+    if series_name == 'IPCA':
+        return(ipca.last_official_date(ipca.load_ipca(db_path)))
+    return(loaders[series_name](db_path).last_valid_index())
+
+async def fetch_series(client, series_name, start_date, end_date):
+    # Fetches the values of series_name published between start_date and end_date
+    if series_name == 'IPCA':
+        return(await ibge.get_ipca_from_ibge_async(client, start_date, end_date))
+    return(await bc.get_bacen_data_async(client, series_name, start_date, end_date))
+
+def commit_series(series_name, db_path, new_values, verify=False):
+    # Stores the fetched values in the database of series_name
+    if series_name == 'CDI':
+        cdi.update_cdi_db(db_path, verify, novos_cdi=new_values)
+    elif series_name == 'Selic':
+        selic.update_selic_db(db_path, verify, novos_selic=new_values)
+    elif series_name == 'IPCA':
+        ipca.update_ipca_db(db_path, verify, novos_ipca=new_values)
+    elif series_name == 'BRLUSD':
+        fxrates.update_brlusd_db(db_path, novos_brlusd=new_values)
+    else:
+        raise KeyError(series_name)
+
+async def update_all_indexes_async(client, db_paths=None, verify=False):
+    # Asynchronous version of update_all_indexes. client is a http_client.AsyncClient
+    if db_paths is None:
+        db_paths = default_db_paths()
+
+    end_date = pd.to_datetime("today").normalize()
+    status = {}
+
+    start_dates = {}
+    for series_name, db_path in db_paths.items():
+        try:
+            start_dates[series_name] = last_stored_date(series_name, db_path)
+        except Exception as err:
+            status[series_name] = err
+
+    series_names = list(start_dates)
+    results = await asyncio.gather(*[fetch_series(client, series_name, start_dates[series_name], end_date) for series_name in series_names],
+                                   return_exceptions=True)
+
+    for series_name, new_values in zip(series_names, results):
+        if isinstance(new_values, Exception):
+            status[series_name] = new_values
+            continue
+        try:
+            commit_series(series_name, db_paths[series_name], new_values, verify)
+            status[series_name] = len(new_values)
+        except Exception as err:
+            status[series_name] = err
+
+    return(status)
+
+def update_all_indexes(db_paths=None, verify=False, max_connections=8, timeout=http_client.default_timeout,
+                       retries=http_client.default_retries, backoff=http_client.default_backoff):
+    # Updates the databases of all the series in db_paths (dict series name -> database path), fetching their new values concurrently
+    # Returns a dict with the number of values fetched for each series, or the exception that stopped its update
+    # The api urls are in bacen.bacen_api_url and ibge.ibge_api_url, and can point to a local server
+
+    async def run():
+        async with http_client.AsyncClient(max_connections, timeout, retries, backoff) as client:
+            return(await update_all_indexes_async(client, db_paths, verify))
+
+    return(asyncio.run(run()))
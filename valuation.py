@@ -0,0 +1,228 @@
+# This module values books of positions indexed to the CDI, Selic, IPCA and BRLUSD
+# A book is a dataframe with one row per position and the columns:
+#   indexer      - 'CDI', 'Selic', 'IPCA' or 'BRLUSD'
+#   start_date   - date the position started to accrue
+#   notional     - value of the position at start_date
+#   percent      - percentage of the rate (CDI and Selic only). Optional, default 1
+#   spread       - annual spread (exponential, base 252 business days) over the index. Optional, default 0
+#   reset_day    - IPCA reset day (see ipca.ipca_accum). Optional, default 0
+#   accrual_type - IPCA accrual type, cd or bd. Optional, default cd
+# The positions of each indexer are valued together by a batch function. Large books are split in chunks valued by a pool of
+# processes that share the index series through the registry's shared memory
+# value_history gives the value of every position on every business day of a period, in chunks of days
+
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import registry
+import ir_calc as ir
+import cdi
+import selic
+import ipca
+import fxrates
+import br_workdays as wd
+
+book_defaults = {'percent': 1.0, 'spread': 0.0, 'reset_day': 0, 'accrual_type': 'cd'}
+
+
+def cdi_kernel(book, ref_date):
+    return(cdi.cdi_accum_batch(registry.get_series('CDI'), book.start_date.values, ref_date, book.percent.values))
+
+def selic_kernel(book, ref_date):
+    return(selic.selic_accum_batch(registry.get_series('Selic'), book.start_date.values, ref_date, book.percent.values))
+
+def ipca_kernel(book, ref_date):
+    return(ipca.ipca_accum_batch(registry.get_series('IPCA'), book.start_date.values, ref_date, book.reset_day.values, book.accrual_type.values))
+
+def brlusd_kernel(book, ref_date):
+    return(fxrates.brlusd_accum_batch(registry.get_series('BRLUSD'), book.start_date.values, ref_date))
+
+# Batch function that calculates the cumulative return of the index for the positions of each indexer
+kernels = {'CDI': cdi_kernel, 'Selic': selic_kernel, 'IPCA': ipca_kernel, 'BRLUSD': brlusd_kernel}
+
+
+def prepare_book(positions):
+    # Checks the columns of the book and fills the optional ones with their default values
+    missing = {'indexer', 'start_date', 'notional'} - set(positions.columns)
+    if missing:
+        raise Exception(f'Book of positions is missing the columns: {", ".join(sorted(missing))}')
+
+    unknown = set(positions.indexer.unique()) - set(kernels)
+    if unknown:
+        raise Exception(f'Unknown indexers: {", ".join(sorted(map(str, unknown)))}. Use one of: {", ".join(kernels)}')
+
+    book = positions.assign(**{column: value for column, value in book_defaults.items() if column not in positions.columns})
+    book['start_date'] = pd.to_datetime(book.start_date)
+    return(book)
+
+def value_book(book, ref_date, timings=None):
+    # Values the positions of book at ref_date. Returns a dataframe with the cumulative return of the index (factor) and the value
+    # of each position. If timings is a dict, the time spent on each stage is added to it (seconds)
+    # ref_date can also be an array with one date for each position (e.g. the redemption dates of ir_calc.redeem_lots)
+    if timings is None:
+        timings = {}
+
+    def add_time(stage, start):
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+    start = time.perf_counter()
+    if np.ndim(ref_date) == 0:
+        ref_day = np.datetime64(pd.Timestamp(ref_date), 'D')
+    else:
+        ref_day = wd.to_days(ref_date)
+    groups = book.groupby('indexer', sort=False).indices
+    add_time('group', start)
+
+    factors = np.empty(len(book))
+    for indexer, rows in groups.items():
+        start = time.perf_counter()
+        registry.get_series(indexer)
+        add_time('load', start)
+
+        start = time.perf_counter()
+        factors[rows] = kernels[indexer](book.iloc[rows], ref_day if ref_day.ndim == 0 else ref_day[rows])
+        add_time(f'kernel {indexer}', start)
+
+    start = time.perf_counter()
+    spreads = book.spread.values.astype(float)
+    if spreads.any():
+        bdays = wd.num_br_bdays_array(wd.to_days(book.start_date.values), ref_day)
+        factors = factors * (1 + spreads) ** (bdays / 252)
+    add_time('spread', start)
+
+    return(pd.DataFrame({'factor': factors, 'value': book.notional.values * factors}, index=book.index))
+
+def value_chunk(book, ref_date):
+    # Values one chunk of the book in a worker process. Returns the valuation and the timings of the worker
+    timings = {}
+    return(value_book(book, ref_date, timings), timings)
+
+def value_positions(positions, ref_date, workers=1, chunk_size=100000):
+    # Values the book of positions at ref_date (exclusive) and returns (valuation, timings)
+    # valuation has the columns of the book plus factor (cumulative return of the index, with the spread) and value (notional * factor)
+    # timings has the time (seconds) spent on each stage. Stages run by the workers are summed over all of them
+    # With workers > 1, books larger than chunk_size are split in chunks valued by a pool of workers processes
+    timings = {}
+
+    start = time.perf_counter()
+    book = prepare_book(positions)
+    timings['prepare'] = time.perf_counter() - start
+
+    if workers <= 1 or len(book) <= chunk_size:
+        valuation = value_book(book, ref_date, timings)
+    else:
+        # The index series are loaded once and shared with the workers, instead of being loaded by each of them
+        start = time.perf_counter()
+        indexers = [indexer for indexer in kernels if indexer in set(book.indexer.unique())]
+        handle = registry.export_shared(series_names=indexers)
+        timings['share'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            chunks = [book.iloc[i:i + chunk_size] for i in range(0, len(book), chunk_size)]
+            with ProcessPoolExecutor(workers, initializer=registry.attach_shared, initargs=(handle,)) as pool:
+                results = list(pool.map(value_chunk, chunks, [ref_date] * len(chunks)))
+        finally:
+            registry.release_shared()
+        timings['pool'] = time.perf_counter() - start
+
+        for chunk_valuation, chunk_timings in results:
+            for stage, seconds in chunk_timings.items():
+                timings[f'workers {stage}'] = timings.get(f'workers {stage}', 0.0) + seconds
+
+        start = time.perf_counter()
+        valuation = pd.concat([chunk_valuation for chunk_valuation, chunk_timings in results])
+        timings['assemble'] = time.perf_counter() - start
+
+    return(positions.join(valuation), timings)
+
+
+# Historical valuation
+
+def roll_start_dates(book):
+    # Start dates of the positions, moved to the following business day when they are not business days (as in cdi_accum)
+    st_days = wd.to_days(book.start_date.values)
+    return(np.where(wd.is_br_bday_array(st_days), st_days, wd.next_br_bday_array(st_days)).astype('datetime64[D]'))
+
+def series_positions(df, series_name, dates):
+    # Positions of dates in the index of the series
+    try:
+        return(ir.find_positions(df, dates))
+    except KeyError:
+        raise Exception(f'Dates out of available range of {series_name} dates')
+
+def rate_history(book, days, series_name):
+    # Cumulative return of the rate (CDI or Selic) of each position (columns) up to each day (rows), from the ratios of the cumulative factors
+    df = registry.get_series(series_name)
+    st_days = roll_start_dates(book)
+    started = st_days <= days[-1]
+    st_pos = np.zeros(len(book), dtype=np.int64)
+    st_pos[started] = series_positions(df, series_name, st_days[started])
+    day_pos = series_positions(df, series_name, days)
+
+    factors = np.empty((len(days), len(book)))
+    percents = book.percent.values.astype(float)
+    for percentage in np.unique(percents):
+        cols = percents == percentage
+        accum = ir.cached_accum_r252(df, percentage, series_name)
+        factors[:, cols] = accum[day_pos][:, None] / accum[st_pos[cols]][None, :]
+
+    return(factors)
+
+def brlusd_history(book, days):
+    df = registry.get_series('BRLUSD')
+    st_days = roll_start_dates(book)
+    started = st_days <= days[-1]
+    st_pos = np.zeros(len(book), dtype=np.int64)
+    st_pos[started] = series_positions(df, 'BRLUSD', st_days[started])
+
+    rates = df.BRLUSD.values
+    return(rates[series_positions(df, 'BRLUSD', days)][:, None] / rates[st_pos][None, :])
+
+def ipca_history(book, days):
+    # The IPCA accrual depends on the day of each date (pro-rata), so it is calculated for every (day, position) pair already started
+    st_days = wd.to_days(book.start_date.values)
+    factors = np.zeros((len(days), len(book)))
+    rows, cols = np.nonzero(st_days[None, :] <= days[:, None])
+    if len(rows):
+        factors[rows, cols] = ipca.ipca_accum_batch(registry.get_series('IPCA'), st_days[cols], days[rows],
+                                                    book.reset_day.values[cols], book.accrual_type.values[cols])
+    return(factors)
+
+# Functions that calculate the cumulative return of the index of each position (columns) up to each day (rows)
+history_kernels = {'CDI': lambda book, days: rate_history(book, days, 'CDI'),
+                   'Selic': lambda book, days: rate_history(book, days, 'Selic'),
+                   'IPCA': ipca_history,
+                   'BRLUSD': brlusd_history}
+
+def value_history_chunks(positions, st_date, end_date, chunk_days=250):
+    # Generates the daily values of the positions for the business days between st_date and end_date (inclusive), chunk_days days at a time
+    # Each chunk is a dataframe with the days in the index and the positions (index of the book) in the columns
+    # The value of a position on a day is its notional times the cumulative return of its index from start_date up to that day
+    # (the day itself excluded, as in cdi_accum). Before the start_date of a position its value is 0
+    book = prepare_book(positions)
+    all_days = wd.list_of_br_bdays(st_date, end_date).values.astype('datetime64[D]')
+    groups = book.groupby('indexer', sort=False).indices
+
+    st_days = roll_start_dates(book)
+    notionals = book.notional.values.astype(float)
+    spreads = book.spread.values.astype(float)
+
+    for first in range(0, len(all_days), chunk_days):
+        days = all_days[first:first + chunk_days]
+        factors = np.empty((len(days), len(book)))
+        for indexer, cols in groups.items():
+            factors[:, cols] = history_kernels[indexer](book.iloc[cols], days)
+
+        if spreads.any():
+            bdays = wd.num_br_bdays_array(st_days[None, :], days[:, None])
+            factors = factors * (1 + spreads) ** (bdays / 252)
+
+        values = np.where(st_days[None, :] <= days[:, None], factors * notionals, 0.0)
+        yield pd.DataFrame(values, index=pd.DatetimeIndex(days.astype('datetime64[ns]'), name='TradeDate'), columns=book.index)
+
+def value_history(positions, st_date, end_date, chunk_days=250):
+    # Returns the dataframe with the daily values of the positions for the business days between st_date and end_date (inclusive)
+    # For long periods or large books, value_history_chunks gives the same values one chunk at a time
+    return(pd.concat(value_history_chunks(positions, st_date, end_date, chunk_days)))